@@ -0,0 +1,184 @@
+import os
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# downstream stage scripts live in scripts/
+_SCRIPTS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"
+)
+if _SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, _SCRIPTS_DIR)
+
+import manifest_store  # noqa: E402
+import silver_clean_transform  # noqa: E402
+import gold_integration  # noqa: E402
+import refresh_mv  # noqa: E402
+
+# -----------------------------
+# Batch DAG (bronze -> silver -> gold -> MV)
+# -----------------------------
+# The batch is the unit of work. Bronze of batch N+1 (driven by
+# batch_processing) does not conflict with silver/gold/MV of batch N: every
+# procedure deletes and inserts only rows with its own dwh_batch_id, and each
+# stage gets the batch JSON by explicit path instead of "the one file in the
+# folder". The same downstream stage running twice for one client does
+# conflict (silver procs ALTER the silver tables, facts look up the current
+# dimensions, an MV refresh rebuilds the whole view), so every downstream stage
+# has a single worker per client. Queues are FIFO, so batches leave each stage
+# in submission order. Batches waiting for the MV worker are coalesced into one
+# refresh, since a refresh rebuilds the whole view anyway.
+
+DOWNSTREAM_STAGES = ("silver", "gold", "mv")
+
+# the "mv" stage goes through _drain_mv (coalesced refresh)
+STAGE_FNS = {
+    "silver": silver_clean_transform.run_silver_transform,
+    "gold": gold_integration.run_gold_integration,
+}
+
+
+def open_dag(client_schema):
+    """One single-worker executor per downstream stage for client_schema."""
+    return {
+        "client_schema": client_schema,
+        "pools": {
+            stage: ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f"{client_schema}-{stage}"
+            )
+            for stage in DOWNSTREAM_STAGES
+        },
+        "batches": [],
+        "mv_pending": [],  # (batch_info_path, results) waiting for the MV worker
+        "mv_lock": threading.Lock(),
+    }
+
+
+def _run_stage(dag, stage, batch_info_path, results):
+    """
+    Run one downstream stage; on success queue the next stage with the JSON's
+    new location and return that future (None when the chain ends here).
+    """
+    client_schema = dag["client_schema"]
+    try:
+        result = STAGE_FNS[stage](client_schema, batch_info_path)
+    except Exception as e:
+        traceback.print_exc()
+        result = {
+            "stage": stage,
+            "status": "FAILED",
+            "batch_id": None,
+            "batch_info_path": batch_info_path,
+            "error": str(e),
+        }
+    results.append(result)
+    print(f"[{client_schema}] DAG {stage} {result['batch_id']} {result['status']}")
+
+    idx = DOWNSTREAM_STAGES.index(stage)
+    if result["status"] != "SUCCESS" or idx + 1 == len(DOWNSTREAM_STAGES):
+        return None
+    next_stage = DOWNSTREAM_STAGES[idx + 1]
+    if next_stage == "mv":
+        with dag["mv_lock"]:
+            dag["mv_pending"].append((result["batch_info_path"], results))
+        return dag["pools"]["mv"].submit(_drain_mv, dag)
+    return dag["pools"][next_stage].submit(
+        _run_stage, dag, next_stage, result["batch_info_path"], results
+    )
+
+
+def _drain_mv(dag):
+    """
+    Refresh MVs once for every batch queued so far. A later drain task finds
+    the queue empty when its batch was already covered by an earlier refresh.
+    """
+    client_schema = dag["client_schema"]
+    with dag["mv_lock"]:
+        pending, dag["mv_pending"] = dag["mv_pending"], []
+    if not pending:
+        return None
+    paths = [path for path, _ in pending]
+    try:
+        mv_results = refresh_mv.run_refresh_mv_batches(client_schema, paths)
+    except Exception as e:
+        traceback.print_exc()
+        mv_results = [
+            {
+                "stage": "mv",
+                "status": "FAILED",
+                "batch_id": None,
+                "batch_info_path": path,
+                "error": str(e),
+            }
+            for path in paths
+        ]
+    for (_, results), result in zip(pending, mv_results):
+        results.append(result)
+        print(f"[{client_schema}] DAG mv {result['batch_id']} {result['status']}")
+    return None
+
+
+def submit_batch(dag, batch_id, batch_info_path=None):
+    """Queue a bronze-complete batch for silver -> gold -> MV; returns immediately."""
+    path = batch_info_path or manifest_store.batch_info_path(
+        dag["client_schema"], batch_id
+    )
+    results = []
+    batch = {
+        "batch_id": batch_id,
+        "future": dag["pools"]["silver"].submit(
+            _run_stage, dag, "silver", path, results
+        ),
+        "results": results,
+    }
+    dag["batches"].append(batch)
+    return batch
+
+
+def _advance(batch, wait):
+    """Follow the stage chain; True once the last queued stage has finished."""
+    fut = batch["future"]
+    while fut is not None:
+        if not wait and not fut.done():
+            batch["future"] = fut
+            return False
+        fut = fut.result()
+    batch["future"] = None
+    return True
+
+
+def dag_summary(batch):
+    """Downstream result of one batch: first failing stage wins."""
+    stages = {r["stage"]: r["status"] for r in batch["results"]}
+    failed = next((r for r in batch["results"] if r["status"] != "SUCCESS"), None)
+    done = len(stages) == len(DOWNSTREAM_STAGES) and failed is None
+    return {
+        "batch_id": batch["batch_id"],
+        "status": "SUCCESS" if done else "FAILED",
+        "stages": stages,
+        "error": failed["error"] if failed else None,
+    }
+
+
+def collect_finished(dag):
+    """Pop batches whose chain has ended (non-blocking); returns their summaries."""
+    finished, pending = [], []
+    for batch in dag["batches"]:
+        (finished if _advance(batch, wait=False) else pending).append(batch)
+    dag["batches"] = pending
+    return [dag_summary(b) for b in finished]
+
+
+def close_dag(dag):
+    """Wait for every queued batch, then shut the stage workers down."""
+    summaries = []
+    try:
+        for batch in dag["batches"]:
+            _advance(batch, wait=True)
+            summaries.append(dag_summary(batch))
+        dag["batches"] = []
+    finally:
+        for pool in dag["pools"].values():
+            pool.shutdown(wait=True)
+    return summaries
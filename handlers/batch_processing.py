@@ -1,51 +1,50 @@
 import os
 import sys
+import argparse
 import shutil
-import subprocess
-import psycopg2
+from psycopg2.extras import execute_values
 import json
 import getpass
+import hashlib
 import tempfile
 import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from dotenv import load_dotenv
+
+# stage modules live in handlers/ and scripts/; import them in-process instead of
+# spawning one interpreter per stage per file
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _stage_dir in ("handlers", "scripts"):
+    _stage_path = os.path.join(BASE_DIR, _stage_dir)
+    if _stage_path not in sys.path:
+        sys.path.insert(0, _stage_path)
+
+import db  # noqa: E402
+import log_sink  # noqa: E402
+import manifest_store  # noqa: E402
+import resolver  # noqa: E402
+import watcher  # noqa: E402
+import batch_dag  # noqa: E402
+import convert_to_parquet  # noqa: E402
+import validate_mapping  # noqa: E402
+import validate_row  # noqa: E402
+import load_to_bronze  # noqa: E402
 
 # -----------------------------
 # DB connection
 # -----------------------------
-load_dotenv()
-
-# validate DB_PORT presence and cast to int
-db_port = os.getenv("DB_PORT")
-if db_port is None:
-    raise ValueError("DB_PORT not set in .env")
-
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST"),
-    "port": int(db_port),
-    "dbname": os.getenv("DB_NAME"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-}
-
-
 def get_connection():
     """
-    Return a new psycopg2 connection using DB_CONFIG.
-    Caller is responsible to close the connection (conn.close()).
+    Check out a connection from the shared "batch" pool (see handlers/db.py).
+    Caller is responsible to give it back (db.release(conn)).
     """
-    missing = [k for k, v in DB_CONFIG.items() if v in (None, "")]
-    if missing:
-        raise ValueError(f"Missing DB config values: {missing}")
-    return psycopg2.connect(**DB_CONFIG)
+    return db.get_connection("batch")
 
 
 # -----------------------------
 # Utilities
 # -----------------------------
-BATCH_SUFFIX_PREFIX = "_BATCH"
-
-
 def increment_batch_id(batch_id):
     prefix = batch_id[:-6] if batch_id and len(batch_id) > 6 else "BATCH"
     try:
@@ -56,27 +55,27 @@ def increment_batch_id(batch_id):
     return f"{prefix}{new_number:06d}"
 
 
-def normalize_name(s: str):
-    if s is None:
-        return ""
-    base = os.path.splitext(s)[0]
-    return base.strip().lower().replace(" ", "_").replace("-", "_")
-
-
-def strip_batch_suffix(filename: str) -> str:
-    """Remove trailing _BATCH###### before extension, if present."""
-    if not filename:
-        return filename
-    name, ext = os.path.splitext(filename)
-    up = name.upper()
-    # exact _BATCH (unlikely) or _BATCHNNNNNN
-    if up.endswith(BATCH_SUFFIX_PREFIX) and len(name) >= len(BATCH_SUFFIX_PREFIX) + 6:
-        return name[: -len(BATCH_SUFFIX_PREFIX)] + ext
-    if "_BATCH" in up:
-        base, suf = name.rsplit("_", 1)
-        if suf.upper().startswith("BATCH") and len(suf) >= 11 and suf[5:].isdigit():
-            return base + ext
-    return filename
+def index_raw_files(
+    client_schema, source_systems, kinds=("incoming", "failed", "success")
+):
+    """
+    Single os.scandir pass over raw/<client>/<ss>/<kind>.
+    Returns {file_name: [(source_system, kind, path), ...]} in source_systems/kinds order.
+    """
+    index = {}
+    for ss in source_systems:
+        for kind in kinds:
+            folder = os.path.join("raw", client_schema, ss, kind)
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.is_file():
+                            index.setdefault(entry.name, []).append(
+                                (ss, kind, entry.path)
+                            )
+            except FileNotFoundError:
+                continue
+    return index
 
 
 def ensure_raw_dirs(client_schema, source_system):
@@ -125,118 +124,29 @@ def read_json_retry(path, retries: int = 10, delay: float = 0.15):
             raise last_exc
 
 
-def wait_for_parquet_name(
-    batch_info_path, physical_file_name, timeout=30.0, poll_interval=0.25
-):
+def run_stage(stage_fn, client_schema, physical_file_name):
     """
-    Poll batch_info until file entry has 'parquet_name' key populated for given physical_file_name.
-    Returns True if found within timeout, False otherwise.
+    Call a stage function (run_convert, run_validate_mapping, ...) in-process.
+    Unexpected exceptions are turned into a FAILED stage result so one bad file
+    cannot take the whole batch down (same as a non-zero subprocess exit before).
+    The log records the stage buffered are flushed when it ends, so its audit
+    status is in the DB before the next stage (or a restart) reads it.
     """
-    deadline = time.time() + timeout
-    while time.time() < deadline:
-        try:
-            bi = read_json_retry(batch_info_path, retries=3, delay=0.05)
-        except Exception:
-            # wait and retry polling
-            time.sleep(poll_interval)
-            continue
-        # ensure bi is a dict
-        if not isinstance(bi, dict):
-            time.sleep(poll_interval)
-            continue
-        files = bi.get("files", []) or []
-        for f in files:
-            if f.get("physical_file_name") == physical_file_name:
-                if f.get("parquet_name"):
-                    return True
-                break
-        time.sleep(poll_interval)
-    return False
-
-
-# -----------------------------
-# Merge-on-read helper (fix for parquet_name overwrite)
-# -----------------------------
-def upsert_file_entry_batch_info(
-    batch_info_path, new_entry, max_attempts=6, delay=0.08
-):
-    """
-    Merge-on-read upsert that:
-     - does NOT inject batch-level metadata into each file entry,
-     - preserves existing parquet_name if present,
-     - only updates allowed file-level keys.
-    """
-    allowed_keys = {
-        "physical_file_name",
-        "logical_source_file",
-        "source_system",
-        "source_type",
-        "target_schema",
-        "target_table",
-        "source_config",
-        "parquet_name",
-    }
-
-    # ensure new_entry contains only allowed keys (defensive)
-    clean_entry = {k: v for k, v in new_entry.items() if k in allowed_keys}
-
-    for attempt in range(max_attempts):
-        try:
-            if os.path.exists(batch_info_path):
-                current = read_json_retry(batch_info_path)
-            else:
-                # create top-level skeleton, but DO NOT include batch fields in file entries
-                current = {
-                    "client_schema": None,
-                    "client_id": None,
-                    "batch_id": None,
-                    "files": [],
-                }
-        except Exception:
-            current = {
-                "client_schema": None,
-                "client_id": None,
-                "batch_id": None,
-                "files": [],
-            }
-
-        if not isinstance(current, dict):
-            current = {
-                "client_schema": None,
-                "client_id": None,
-                "batch_id": None,
-                "files": [],
-            }
-
-        files = current.setdefault("files", [])
-        found = False
-        for f in files:
-            if str(f.get("physical_file_name")) == str(
-                clean_entry.get("physical_file_name")
-            ):
-                existing_parquet = f.get("parquet_name", None)
-                # update only allowed keys
-                for k, v in clean_entry.items():
-                    # If parquet_name is None in clean_entry, don't overwrite existing non-null value
-                    if k == "parquet_name" and (v is None) and existing_parquet:
-                        continue
-                    f[k] = v
-                found = True
-                break
-
-        if not found:
-            files.append(clean_entry)
-
-        # Do NOT overwrite top-level client_schema/client_id/batch_id if present in current.
-        # (we only update files section here)
-        try:
-            write_json_atomic(batch_info_path, current)
-            return True
-        except Exception:
-            time.sleep(delay * (1 + attempt * 0.3))
-            continue
-
-    return False
+    try:
+        return stage_fn(client_schema, physical_file_name)
+    except Exception as e:
+        traceback.print_exc()
+        return {
+            "stage": getattr(stage_fn, "__name__", "stage"),
+            "status": "FAILED",
+            "physical_file_name": physical_file_name,
+            "parquet_name": None,
+            "parquet_path": None,
+            "total_rows": None,
+            "error": str(e),
+        }
+    finally:
+        log_sink.flush()
 
 
 # -----------------------------
@@ -278,7 +188,7 @@ def find_client_configs(cur, client_id):
                 "source_config": r[4],
                 "logical_source_file": r[5],
                 "source_system": r[6],
-                "logical_norm": normalize_name(r[5]) if r[5] else None,
+                "logical_norm": resolver.normalize_name(r[5]) if r[5] else None,
             }
         )
     return configs
@@ -286,15 +196,21 @@ def find_client_configs(cur, client_id):
 
 def insert_file_audit(cur, conn, rec):
     """
-    Write into tools.file_audit_log.
+    Write into tools.file_audit_log and return (file_audit_id, file_received_time
+    as ISO text): together the primary key of the (partitioned) row.
     The table has many columns; we explicitly set relevant columns and leave others NULL.
+    content_hash is only written when a hash was computed (dedup on), so the
+    column is needed only where sql/tools/file_audit_content_hash.sql ran.
     """
+    hashed = rec.get("content_hash") is not None
     cur.execute(
-        """
+        f"""
         INSERT INTO tools.file_audit_log
         (convert_status, mapping_validation_status, row_validation_status, load_status, total_rows, valid_rows, invalid_rows,
-         processed_by, logical_source_file, physical_file_name, batch_id, file_received_time, source_type, source_system, config_validation_status, client_id)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+         processed_by, logical_source_file, physical_file_name, batch_id, file_received_time, source_type, source_system, config_validation_status, client_id
+         {", content_hash" if hashed else ""})
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s{", %s" if hashed else ""})
+        RETURNING file_audit_id, file_received_time
         """,
         (
             rec.get("convert_status"),
@@ -313,38 +229,728 @@ def insert_file_audit(cur, conn, rec):
             rec.get("source_system"),
             rec.get("config_validation_status"),
             rec.get("client_id"),
-        ),
+        )
+        + ((rec["content_hash"],) if hashed else ()),
     )
+    file_audit_id, received = cur.fetchone()
     conn.commit()
+    return file_audit_id, received.isoformat() if received else None
+
+
+def reconcile_file_audit(cur, conn, client_id, batch_id, candidates, config_index):
+    """
+    Restart reconciliation in bulk: one SELECT ... ANY(%s) for the latest audit row
+    per physical_file_name, one UPDATE ... FROM (VALUES ...) and one commit.
+    Only config_validation_status (and an empty logical_source_file) are updated.
+    Returns {physical_file_name: (logical_source_file, matched_cfg)} for files
+    that have an audit record.
+    """
+    names = list(
+        {c["physical_file_name"] for c in candidates if c.get("physical_file_name")}
+    )
+    if not names:
+        return {}
+    by_name = {c["physical_file_name"]: c for c in candidates}
+    try:
+        cur.execute(
+            """
+            SELECT DISTINCT ON (physical_file_name)
+                   physical_file_name, logical_source_file, source_system, source_type
+            FROM tools.file_audit_log
+            WHERE client_id = %s AND batch_id = %s AND physical_file_name = ANY(%s)
+            ORDER BY physical_file_name, file_received_time DESC NULLS LAST, ctid DESC
+            """,
+            (client_id, batch_id, names),
+        )
+        found = {}
+        values = []
+        for phys, logical_sf_db, ss_db, st_db in cur.fetchall():
+            c = by_name[phys]
+            matched_cfg = resolver.resolve_config(
+                config_index,
+                phys,
+                c.get("source_system") or ss_db,
+                c.get("source_type") or (st_db or ""),
+            )
+            new_status = "SUCCESS" if matched_cfg else "FAILED"
+            # fill logical_source_file only when the audit row has none
+            set_logical = (
+                matched_cfg.get("logical_source_file")
+                if matched_cfg and not logical_sf_db
+                else None
+            )
+            values.append((phys, new_status, set_logical, client_id, batch_id))
+            found[phys] = (
+                logical_sf_db
+                or (matched_cfg.get("logical_source_file") if matched_cfg else None),
+                matched_cfg,
+            )
+
+        if values:
+            execute_values(
+                cur,
+                """
+                UPDATE tools.file_audit_log AS a
+                SET config_validation_status = v.status,
+                    logical_source_file = COALESCE(v.logical_source_file, a.logical_source_file)
+                FROM (VALUES %s) AS v(physical_file_name, status, logical_source_file, client_id, batch_id)
+                WHERE a.client_id = v.client_id AND a.batch_id = v.batch_id
+                  AND a.physical_file_name = v.physical_file_name
+                """,
+                values,
+                template="(%s::text, %s::text, %s::text, %s::int, %s::text)",
+                page_size=len(values),
+            )
+        conn.commit()
+        return found
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def fetch_stage_statuses(cur, client_id, batch_id):
+    """
+    {physical_file_name: {stage: status, "file_audit_id": id,
+    "file_received_time": iso}} from the latest audit row per file.
+    """
+    cur.execute(
+        """
+        SELECT DISTINCT ON (physical_file_name)
+               physical_file_name, convert_status, mapping_validation_status,
+               row_validation_status, load_status, file_audit_id, file_received_time
+        FROM tools.file_audit_log
+        WHERE client_id = %s AND batch_id = %s
+        ORDER BY physical_file_name, file_received_time DESC NULLS LAST, ctid DESC
+        """,
+        (client_id, batch_id),
+    )
+    return {
+        r[0]: {
+            "convert": r[1],
+            "validate_mapping": r[2],
+            "validate_row": r[3],
+            "load": r[4],
+            "file_audit_id": r[5],
+            "file_received_time": r[6].isoformat() if r[6] else None,
+        }
+        for r in cur.fetchall()
+    }
 
 
 def log_batch_status(
     client_id, status, batch_id, job_name, error_message=None, start_time=None
 ):
-    conn = get_connection()
-    cur = conn.cursor()
+    """
+    Batch-level job_execution_log row. Called once per batch (end or abort),
+    so it also flushes whatever is still buffered in log_sink (intake records).
+    """
     now = datetime.now()
+    log_sink.record(
+        "job_execution_log",
+        {
+            "job_name": job_name,
+            "client_id": client_id,
+            "status": status,
+            "start_time": start_time or now,
+            "end_time": now,
+            "error_message": error_message,
+            "file_name": None,
+            "batch_id": batch_id,
+        },
+    )
+    log_sink.flush()
+
+
+# stage types with their own worker pool in process_client; validate_mapping and
+# validate_row share "validate"
+STAGE_POOLS = ("convert", "validate", "load")
+
+# intake dedup (opt-in per source or via env): a file whose content hash
+# matches a loaded file of the same logical source reuses that file's archived
+# parquet (reuse), is archived without processing (skip), or is processed as
+# new (off, no hashing). Needs sql/tools/file_audit_content_hash.sql.
+DEDUP_POLICIES = ("off", "reuse", "skip")
+DEDUP_POLICY = os.getenv("DEDUP_POLICY", "off").lower()
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def resolve_stage_workers(max_workers=1, stage_workers=None):
+    """{stage type: worker count}; unset stage types default to max_workers."""
+    stage_workers = stage_workers or {}
+    return {
+        name: max(1, int(stage_workers.get(name) or max_workers or 1))
+        for name in STAGE_POOLS
+    }
+
+
+def run_stage_in(pools, pool_name, stage_fn, client_schema, physical_file_name):
+    """run_stage on the given stage pool (or inline when pools is None) and wait for it."""
+    if not pools:
+        return run_stage(stage_fn, client_schema, physical_file_name)
+    return (
+        pools[pool_name]
+        .submit(run_stage, stage_fn, client_schema, physical_file_name)
+        .result()
+    )
+
+
+# -----------------------------
+# Client summary
+# -----------------------------
+
+
+def client_summary(
+    client_schema, batch_id, status, files_total=0, files_success=0, error=None
+):
+    """Result of one process_client run (also what a client worker process returns)."""
+    return {
+        "client_schema": client_schema,
+        "batch_id": batch_id,
+        "status": status,
+        "files_total": files_total,
+        "files_success": files_success,
+        "error": error,
+    }
+
+
+def run_client(
+    client_schema,
+    mode,
+    max_workers=1,
+    include_files=None,
+    stage_workers=None,
+    downstream=False,
+    batch_id=None,
+):
+    """
+    Entry point for one client worker process. Never raises: an unexpected error
+    becomes a FAILED summary so the other clients keep running. With downstream,
+    a successful batch also runs silver -> gold -> MV before returning.
+    """
+    started = time.time()
+    try:
+        summary = process_client(
+            client_schema,
+            mode,
+            max_workers=max_workers,
+            include_files=include_files,
+            stage_workers=stage_workers,
+            batch_id=batch_id,
+        )
+        if downstream:
+            dag = batch_dag.open_dag(client_schema)
+            submit_downstream(dag, summary)
+            for d in batch_dag.close_dag(dag):
+                summary["downstream"] = d
+    except Exception as e:
+        traceback.print_exc()
+        summary = client_summary(client_schema, None, "FAILED", error=str(e))
+    summary["duration_sec"] = round(time.time() - started, 2)
+    return summary
+
+
+def submit_downstream(dag, summary):
+    """
+    Hand a bronze-complete batch to the DAG. A FAILED batch keeps its JSON in
+    batch_info/<client>/incoming for restart, as before.
+    """
+    if summary["status"] != "SUCCESS" or not summary["files_success"]:
+        print(
+            f"[{summary['client_schema']}] Batch {summary['batch_id']} tidak diteruskan ke silver "
+            f"(status={summary['status']}, files_success={summary['files_success']})"
+        )
+        return None
+    return batch_dag.submit_batch(dag, summary["batch_id"])
+
+
+def print_dag_summary(client_schema, d):
+    line = f"[{client_schema}] DAG {d['batch_id']} {d['status']} " + " ".join(
+        f"{k}={v}" for k, v in d["stages"].items()
+    )
+    if d.get("error"):
+        line += f" error={d['error']}"
+    print(line)
+
+
+def print_client_summaries(summaries):
+    print("\n===== Ringkasan per client =====")
+    for s in summaries:
+        # None when the worker process died
+        duration = "-" if s.get("duration_sec") is None else f"{s['duration_sec']}s"
+        line = (
+            f"{s['client_schema']:<20} {s['status']:<8} batch={s['batch_id']} "
+            f"files={s['files_success']}/{s['files_total']} {duration}"
+        )
+        if s.get("error"):
+            line += f" error={s['error']}"
+        if s.get("downstream"):
+            line += f" downstream={s['downstream']['status']}"
+        print(line)
+    failed = sum(1 for s in summaries if s["status"] not in ("SUCCESS", "SKIPPED"))
+    print(f"Total client: {len(summaries)}, gagal: {failed}")
 
+
+# -----------------------------
+# Per-file pipeline
+# -----------------------------
+
+
+def content_hash(path):
+    """BLAKE2b-256 of the file contents (hex), read in HASH_CHUNK_BYTES chunks."""
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def dedup_policy(cfg):
+    """off | reuse | skip, from source_config.dedup_policy or env DEDUP_POLICY."""
+    policy = (cfg.get("source_config") or {}).get("dedup_policy") or DEDUP_POLICY
+    policy = str(policy).lower()
+    if policy not in DEDUP_POLICIES:
+        print(f"⚠️ dedup_policy '{policy}' tidak dikenal, dianggap 'off'")
+        return "off"
+    return policy
+
+
+def find_loaded_duplicate(cur, client_id, logical_source_file, digest):
+    """Latest successfully loaded file of the logical source with the same content hash."""
     cur.execute(
         """
-        INSERT INTO tools.job_execution_log 
-            (job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        SELECT batch_id, physical_file_name, source_system
+        FROM tools.file_audit_log
+        WHERE client_id = %s AND logical_source_file = %s
+          AND content_hash = %s AND load_status = 'SUCCESS'
+        ORDER BY file_received_time DESC NULLS LAST
+        LIMIT 1
         """,
-        (
-            job_name,
-            client_id,
-            status,
-            start_time or now,
-            now,
-            error_message,
-            None,
-            batch_id,
-        ),
+        (client_id, logical_source_file, digest),
     )
-    conn.commit()
-    cur.close()
-    conn.close()
+    row = cur.fetchone()
+    if not row:
+        return None
+    return {"batch_id": row[0], "physical_file_name": row[1], "source_system": row[2]}
+
+
+def workbook_sheets(cfg):
+    """
+    source_config.convert.sheets of a workbook config: {sheet: logical_source_file}.
+    Each logical_source_file needs its own client_config row with
+    source_type parquet (target table, column mapping), like any parquet source.
+    """
+    if (cfg.get("source_type") or "").lower() not in convert_to_parquet.EXCEL_TYPES:
+        return None
+    convert_cfg = (cfg.get("source_config") or {}).get("convert") or {}
+    return convert_cfg.get("sheets") or None
+
+
+def split_workbook_file(client_schema, client_id, new_batch_id, ss, fn, cfg):
+    """
+    start: convert the mapped sheets of raw/<client>/<ss>/incoming/<fn> (in
+    parallel) to <logical_source_file>.parquet files next to it, so each sheet
+    is picked up as its own parquet source. The workbook itself is renamed with
+    the batch suffix and moved to archive (failed when a sheet fails), with one
+    audit row. Returns the sheet file names written.
+    """
+    incoming = f"raw/{client_schema}/{ss}/incoming"
+    path = os.path.join(incoming, fn)
+    sheets = workbook_sheets(cfg)
+    try:
+        options = convert_to_parquet.convert_options(cfg.get("source_config"))
+        written = convert_to_parquet.split_workbook(path, sheets, incoming, options)
+        status, target = "SUCCESS", f"raw/{client_schema}/{ss}/archive"
+        print(
+            f"[{client_schema}][{ss}] Workbook {fn} dipecah: "
+            + ", ".join(f"{sh} -> {os.path.basename(p)}" for sh, p in written.items())
+        )
+    except Exception as e:
+        written = {}
+        status, target = "FAILED", f"raw/{client_schema}/{ss}/failed"
+        print(f"[{client_schema}][{ss}] ❌ Gagal memecah workbook {fn}: {e}")
+
+    archive_raw_file(
+        client_schema,
+        client_id,
+        new_batch_id,
+        ss,
+        fn,
+        cfg,
+        target,
+        convert_status=status,
+    )
+    return [os.path.basename(p) for p in written.values()]
+
+
+def archive_raw_file(
+    client_schema, client_id, new_batch_id, ss, fn, cfg, target, **audit_values
+):
+    """
+    Intake without stages (split workbook, skipped duplicate): rename
+    raw/<client>/<ss>/incoming/<fn> with the batch suffix, move it to target
+    and record its audit row (audit_values: statuses, content_hash).
+    """
+    base, e = resolver.split_ext(fn)
+    base_std = base.strip().replace(" ", "_").replace("-", "_")
+    physical = f"{base_std}_{new_batch_id}{e}"
+    os.makedirs(target, exist_ok=True)
+    try:
+        shutil.move(
+            os.path.join(f"raw/{client_schema}/{ss}/incoming", fn),
+            os.path.join(target, physical),
+        )
+    except Exception:
+        physical = fn
+    audit_rec = {
+        "client_id": client_id,
+        "processed_by": os.getenv("PROCESS_USER") or getpass.getuser() or "autoloader",
+        "logical_source_file": cfg.get("logical_source_file"),
+        "physical_file_name": physical,
+        "batch_id": new_batch_id,
+        "file_received_time": datetime.now(),
+        "source_type": cfg.get("source_type"),
+        "source_system": ss,
+        "config_validation_status": "SUCCESS",
+    }
+    audit_rec.update(audit_values)
+    log_sink.record("file_audit_log", audit_rec)
+    return physical
+
+
+def prepare_file(cur, conn, client_schema, client_id, mode, new_batch_id, item):
+    """
+    Serial intake step for one file. Returns the work item consumed by
+    run_file_pipeline. Raises on failure (caller marks the batch FAILED).
+      - start: rename with batch suffix, insert audit row, move to raw/success, upsert batch_info
+      - restart: move to raw/success (no rename), upsert batch_info with matched config
+      - reprocessing: nothing to do, parquet is already in data/.../incoming
+    """
+    orig_path = item["orig_path"]
+    orig_name = item["orig_name"]  # for restart this already includes batch suffix
+    ss = item["ss"] or "unknown"
+    ext = item["ext"]
+    cfg = item["cfg"]
+
+    work = {
+        "orig_name": orig_name,
+        "physical_file_name": orig_name,
+        "batch_id": new_batch_id,
+        "ss": ss,
+        "ext": ext,
+    }
+    if mode == "reprocessing":
+        # orig_path is the parquet itself: data/<client>/<ss>/incoming/<parquet>
+        work["data_ss"] = os.path.basename(os.path.dirname(os.path.dirname(orig_path)))
+        work["parquet_name"] = os.path.basename(orig_path)
+        entry = manifest_store.get_file_entry(client_schema, new_batch_id, orig_name)
+        work["checkpoints"] = (entry or {}).get("checkpoints")
+        work["file_audit_id"] = (entry or {}).get("file_audit_id")
+        work["file_received_time"] = (entry or {}).get("file_received_time")
+        return work
+
+    raw_success = f"raw/{client_schema}/{ss}/success"
+    raw_failed = f"raw/{client_schema}/{ss}/failed"
+    raw_archive = f"raw/{client_schema}/{ss}/archive"
+    os.makedirs(raw_success, exist_ok=True)
+    os.makedirs(raw_failed, exist_ok=True)
+    os.makedirs(raw_archive, exist_ok=True)
+
+    file_audit_id = file_received_time = None
+    if mode == "restart" and cfg.get("existing_audit"):
+        # DO NOT rename. Just move (if necessary) to success and upsert batch_info with matched config.
+        physical = orig_name
+        dest_success = os.path.join(raw_success, orig_name)
+        try:
+            if os.path.abspath(orig_path) != os.path.abspath(dest_success):
+                if os.path.exists(dest_success):
+                    os.remove(dest_success)
+                shutil.move(orig_path, dest_success)
+        except Exception:
+            try:
+                shutil.copy2(orig_path, dest_success)
+            except Exception:
+                pass
+    else:
+        # START flow (or unexpected path). Rename, insert audit, move to success.
+        base, e = resolver.split_ext(orig_name)
+        base_std = base.strip().replace(" ", "_").replace("-", "_")
+        physical = f"{base_std}_{new_batch_id}{e}"
+        raw_in = f"raw/{client_schema}/{ss}/incoming"
+
+        new_full = os.path.join(raw_in, physical)
+        os.rename(orig_path, new_full)
+
+        audit_rec = {
+            "client_id": client_id,
+            "processed_by": os.getenv("PROCESS_USER")
+            or getpass.getuser()
+            or "batch_processing",
+            "logical_source_file": cfg.get("logical_source_file"),
+            "physical_file_name": physical,
+            "batch_id": new_batch_id,
+            "file_received_time": datetime.now(),
+            "source_type": ext,
+            "source_system": ss,
+            "config_validation_status": (
+                "SUCCESS" if cfg.get("logical_source_file") else "FAILED"
+            ),
+            "content_hash": item.get("content_hash"),
+        }
+
+        try:
+            file_audit_id, file_received_time = insert_file_audit(cur, conn, audit_rec)
+        except Exception:
+            try:
+                if os.path.exists(new_full):
+                    os.rename(new_full, orig_path)
+            except Exception:
+                pass
+            raise
+
+        shutil.move(new_full, os.path.join(raw_success, physical))
+
+    new_entry = {
+        "physical_file_name": physical,
+        "logical_source_file": cfg.get("logical_source_file"),
+        "source_system": ss,
+        "source_type": ext,
+        "target_schema": cfg.get("target_schema"),
+        "target_table": cfg.get("target_table"),
+        "source_config": cfg.get("source_config"),
+        "parquet_name": None,
+        # stages update their tools.file_audit_log row by this id (plus the
+        # partition key, so the UPDATE touches one monthly partition)
+        "file_audit_id": file_audit_id,
+        "file_received_time": file_received_time,
+        "content_hash": item.get("content_hash"),
+        # dedup_policy reuse: convert clones this parquet instead of converting
+        "reuse_parquet": item.get("reuse_parquet"),
+    }
+    try:
+        manifest_store.upsert_file_entry(client_schema, new_batch_id, new_entry)
+    except Exception as e:
+        print(
+            f"[{client_schema}] WARNING: gagal upsert batch_info untuk {physical}: {e}; continuing"
+        )
+
+    work["physical_file_name"] = physical
+    work["data_ss"] = ss
+    if mode == "restart":
+        entry = manifest_store.get_file_entry(client_schema, new_batch_id, physical)
+        work["parquet_name"] = (entry or {}).get("parquet_name")
+        work["checkpoints"] = (entry or {}).get("checkpoints")
+        work["file_audit_id"] = (entry or {}).get("file_audit_id")
+        work["file_received_time"] = (entry or {}).get("file_received_time")
+    return work
+
+
+def file_fingerprint(path):
+    """Cheap identity of a stage input: size + mtime (ns). None if missing."""
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def find_parquet(client_schema, source_system, parquet_name):
+    """Current location of a parquet: data/<client>/<ss>/{incoming,failed,archive}."""
+    if not parquet_name or not source_system:
+        return None
+    for kind in ("incoming", "failed", "archive"):
+        p = os.path.join("data", client_schema, source_system, kind, parquet_name)
+        if os.path.exists(p):
+            return p
+    return None
+
+
+def stage_input_path(client_schema, stage, work):
+    if stage == "convert":
+        return os.path.join(
+            "raw", client_schema, work["ss"], "success", work["physical_file_name"]
+        )
+    return find_parquet(client_schema, work["data_ss"], work.get("parquet_name"))
+
+
+def resume_index(client_schema, work, stages):
+    """
+    Index of the first stage that still has to run. A stage counts as done when
+    tools.file_audit_log has its status, the manifest checkpoint says it ran,
+    and the input it ran against (size + mtime) is unchanged. validate_row is
+    non-fatal, so any recorded outcome counts for it.
+    """
+    checkpoints = work.get("checkpoints") or {}
+    audit = work.get("audit_status") or {}
+    for i, stage in enumerate(stages):
+        cp = checkpoints.get(stage) or {}
+        if stage == "validate_row":
+            done = bool(cp.get("status")) and bool(audit.get(stage))
+        else:
+            done = cp.get("status") == "SUCCESS" and audit.get(stage) == "SUCCESS"
+        fp = file_fingerprint(stage_input_path(client_schema, stage, work))
+        if not done or fp is None or cp.get("input") != fp:
+            return i
+        if stage == "convert" and cp.get("output") != file_fingerprint(
+            find_parquet(client_schema, work["data_ss"], work.get("parquet_name"))
+        ):
+            # parquet was replaced or removed since conversion
+            return i
+    return len(stages)
+
+
+def run_file_pipeline(client_schema, mode, work, pools=None):
+    """
+    Run convert -> validate_mapping -> validate_row -> load_to_bronze for one file,
+    strictly in that order, and move the raw file to archive/failed accordingly.
+    restart/reprocessing resume from the first stage without a valid checkpoint.
+    With pools, each stage runs on its stage-type pool, so stages of different
+    files overlap. Safe to call for several files concurrently. Never raises.
+    Returns (ok, error_message).
+    """
+    orig_name = work["orig_name"]
+    name = work["physical_file_name"]
+    ss = work["ss"]
+    batch_id = work["batch_id"]
+
+    raw_success = f"raw/{client_schema}/{ss}/success"
+    raw_failed = f"raw/{client_schema}/{ss}/failed"
+    raw_archive = f"raw/{client_schema}/{ss}/archive"
+
+    def move_raw_to(target_dir):
+        src = os.path.join(raw_success, name)
+        if os.path.exists(src):
+            shutil.move(src, os.path.join(target_dir, name))
+
+    stages = []
+    if mode != "reprocessing":
+        # every source type goes through convert (parquet is passed through there)
+        stages.append("convert")
+    stages += ["validate_mapping", "validate_row", "load"]
+
+    try:
+        start_at = 0 if mode == "start" else resume_index(client_schema, work, stages)
+        if start_at:
+            print(
+                f"[{client_schema}] {name}: checkpoint valid, skip {', '.join(stages[:start_at])}"
+            )
+        if start_at < len(stages) and (start_at > 0 or "convert" not in stages):
+            # stages read the parquet from data/<ss>/incoming; bring it back if a
+            # previous run moved it to failed/archive
+            current = find_parquet(
+                client_schema, work["data_ss"], work.get("parquet_name")
+            )
+            if current and os.path.basename(os.path.dirname(current)) != "incoming":
+                dest = os.path.join(
+                    "data",
+                    client_schema,
+                    work["data_ss"],
+                    "incoming",
+                    work["parquet_name"],
+                )
+                shutil.move(current, dest)
+
+        for stage in stages[start_at:]:
+            input_fp = (
+                file_fingerprint(stage_input_path(client_schema, stage, work))
+                if stage != "convert"
+                else file_fingerprint(os.path.join(raw_success, name))
+            )
+            output_fp = None
+
+            if stage == "convert":
+                r = run_stage_in(
+                    pools,
+                    "convert",
+                    convert_to_parquet.run_convert,
+                    client_schema,
+                    name,
+                )
+                if r["status"] != "SUCCESS":
+                    move_raw_to(raw_failed)
+                    raise Exception("FAILED on convert_to_parquet")
+
+                # run_convert hands back parquet_name directly; no need to poll batch_info.
+                # The later stages still resolve parquet_name from batch_info, so the
+                # write must have succeeded.
+                if not r.get("parquet_name") or not r.get("batch_info_written"):
+                    move_raw_to(raw_failed)
+                    raise Exception(
+                        "FAILED: convert_to_parquet did not record parquet_name in batch_info"
+                    )
+                work["parquet_name"] = r["parquet_name"]
+                output_fp = file_fingerprint(r.get("parquet_path"))
+
+            elif stage == "validate_mapping":
+                r = run_stage_in(
+                    pools,
+                    "validate",
+                    validate_mapping.run_validate_mapping,
+                    client_schema,
+                    name,
+                )
+                if r["status"] != "SUCCESS":
+                    if mode == "reprocessing":
+                        print(f"[{client_schema}] validate_mapping FAILED for {name}")
+                        return False, f"{name} - validate_mapping failed"
+                    move_raw_to(raw_failed)
+                    raise Exception("FAILED on validate_mapping")
+
+            elif stage == "validate_row":
+                r = run_stage_in(
+                    pools,
+                    "validate",
+                    validate_row.run_validate_row,
+                    client_schema,
+                    name,
+                )
+                if r["status"] != "SUCCESS":
+                    print(
+                        f"[{client_schema}] WARNING validate_row failed for {name} (non-fatal)"
+                    )
+
+            else:
+                r = run_stage_in(
+                    pools,
+                    "load",
+                    load_to_bronze.run_load_to_bronze,
+                    client_schema,
+                    name,
+                )
+                if r["status"] != "SUCCESS":
+                    if mode == "reprocessing":
+                        print(f"[{client_schema}] load_to_bronze FAILED for {name}")
+                        return False, f"{name} - load_to_bronze failed"
+                    move_raw_to(raw_failed)
+                    raise Exception("FAILED on load_to_bronze")
+
+            try:
+                manifest_store.record_checkpoint(
+                    client_schema,
+                    batch_id,
+                    name,
+                    stage,
+                    r["status"],
+                    input_fp,
+                    output_fp,
+                )
+            except Exception as e:
+                print(
+                    f"[{client_schema}] WARNING: gagal menyimpan checkpoint {stage} untuk {name}: {e}"
+                )
+
+        if mode == "reprocessing":
+            if ss and ss != "unknown":
+                failed_path = f"raw/{client_schema}/{ss}/failed/{name}"
+                archive_path = f"raw/{client_schema}/{ss}/archive/{name}"
+                if os.path.exists(failed_path):
+                    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+                    shutil.move(failed_path, archive_path)
+        else:
+            move_raw_to(raw_archive)
+        return True, None
+    except Exception as e:
+        print(f"❌ [{client_schema}] Gagal memproses {orig_name} => {e}")
+        return False, f"{orig_name} - {str(e)}"
 
 
 # -----------------------------
@@ -352,7 +958,21 @@ def log_batch_status(
 # -----------------------------
 
 
-def process_client(client_schema, mode):
+def process_client(
+    client_schema,
+    mode,
+    max_workers=1,
+    include_files=None,
+    stage_workers=None,
+    batch_id=None,
+):
+    """
+    Run one batch for a client. include_files (start only) restricts the raw
+    incoming scan to those paths; watch mode uses it to hand over a micro-batch.
+    stage_workers overrides the per-stage pool sizes (see resolve_stage_workers).
+    batch_id (restart/reprocessing) picks the batch to rerun; default is the
+    client's last_batch_id.
+    """
     conn = get_connection()
     cur = conn.cursor()
     try:
@@ -360,6 +980,7 @@ def process_client(client_schema, mode):
         client_id = info["client_id"]
         last_batch = info["last_batch_id"] or "BATCH000000"
         configs = find_client_configs(cur, client_id)
+        config_index = resolver.build_config_index(configs)
         source_systems = ["crm", "erp", "api", "db"]
         for ss in source_systems:
             ensure_raw_dirs(client_schema, ss)
@@ -376,7 +997,9 @@ def process_client(client_schema, mode):
             job_name = "Batch Reprocessing"
         else:
             print("Mode tidak dikenali. Gunakan start | restart | reprocessing")
-            return
+            return client_summary(
+                client_schema, new_batch_id, "FAILED", error=f"UNKNOWN_MODE_{mode}"
+            )
 
         # START: increment batch_id and update
         if mode == "start":
@@ -387,39 +1010,89 @@ def process_client(client_schema, mode):
             )
             conn.commit()
 
+            # duplicates archived under dedup_policy skip (not in files_to_handle)
+            skipped_duplicates = []
+
             # scan incoming in raw for all source_systems
             for ss in source_systems:
                 incoming = f"raw/{client_schema}/{ss}/incoming"
                 if not os.path.isdir(incoming):
                     continue
-                for fn in os.listdir(incoming):
+                names = os.listdir(incoming)
+                split_outputs = set()  # sheet files written by split_workbook_file
+                for fn in names:
                     path = os.path.join(incoming, fn)
+                    if (
+                        include_files is not None
+                        and path not in include_files
+                        and fn not in split_outputs
+                    ):
+                        continue
                     if not os.path.isfile(path):
                         continue
-                    ext = os.path.splitext(fn)[1].lower().lstrip(".")
-                    logical_norm = normalize_name(strip_batch_suffix(fn))
-                    matched = None
-                    for cfg in configs:
-                        if (
-                            (cfg["source_system"] or "").lower() == ss.lower()
-                            and cfg["source_type"] == ext
-                            and cfg["logical_norm"] == logical_norm
+                    # compound extensions: sales.csv.gz matches the csv config
+                    ext = convert_to_parquet.raw_source_type(path)
+                    matched = resolver.resolve_config(config_index, fn, ss, ext)
+                    if matched and workbook_sheets(matched):
+                        # the sheets are scanned (matched as parquet) later in this loop
+                        for sheet_fn in split_workbook_file(
+                            client_schema, client_id, new_batch_id, ss, fn, matched
                         ):
-                            matched = cfg
-                            break
+                            split_outputs.add(sheet_fn)
+                            if sheet_fn not in names:
+                                names.append(sheet_fn)
+                        continue
                     if matched:
-                        files_to_handle.append(
-                            {
-                                "orig_path": path,
-                                "orig_name": fn,
-                                "ss": ss,
-                                "ext": ext,
-                                "cfg": matched,
-                            }
-                        )
+                        item = {
+                            "orig_path": path,
+                            "orig_name": fn,
+                            "ss": ss,
+                            "ext": ext,
+                            "cfg": matched,
+                        }
+                        policy = dedup_policy(matched)
+                        if policy != "off":
+                            item["content_hash"] = content_hash(path)
+                            dup = find_loaded_duplicate(
+                                cur,
+                                client_id,
+                                matched.get("logical_source_file"),
+                                item["content_hash"],
+                            )
+                            conn.rollback()
+                            if dup and policy == "skip":
+                                physical = archive_raw_file(
+                                    client_schema,
+                                    client_id,
+                                    new_batch_id,
+                                    ss,
+                                    fn,
+                                    matched,
+                                    f"raw/{client_schema}/{ss}/archive",
+                                    content_hash=item["content_hash"],
+                                    convert_status="SKIPPED",
+                                    mapping_validation_status="SKIPPED",
+                                    row_validation_status="SKIPPED",
+                                    load_status="SKIPPED",
+                                )
+                                print(
+                                    f"[{client_schema}][{ss}] SKIP duplikat {fn} -> {physical} "
+                                    f"(isi sama dengan {dup['physical_file_name']}, {dup['batch_id']})"
+                                )
+                                skipped_duplicates.append(physical)
+                                continue
+                            if dup:
+                                item["reuse_parquet"] = os.path.join(
+                                    "data",
+                                    client_schema,
+                                    dup["source_system"] or ss,
+                                    "archive",
+                                    f"{matched.get('logical_source_file')}_{dup['batch_id']}.parquet",
+                                )
+                        files_to_handle.append(item)
                     else:
                         # record audit for non-matching file (config failed) — rename with batch suffix then move to failed
-                        base, e = os.path.splitext(fn)
+                        base, e = resolver.split_ext(fn)
                         base_std = base.strip().replace(" ", "_").replace("-", "_")
                         new_name = f"{base_std}_{new_batch_id}{e}"
                         raw_failed = f"raw/{client_schema}/{ss}/failed"
@@ -446,15 +1119,39 @@ def process_client(client_schema, mode):
                             "source_system": ss,
                             "config_validation_status": "FAILED",
                         }
-                        try:
-                            insert_file_audit(cur, conn, audit_rec)
-                        except Exception as e:
-                            print(
-                                f"[{client_schema}] Gagal insert audit untuk no-match file {fn}: {e}"
-                            )
+                        # nothing downstream reads this row during the batch
+                        log_sink.record("file_audit_log", audit_rec)
                         print(
                             f"[{client_schema}][{ss}] SKIP no config match: {fn} -> recorded as {audit_rec['physical_file_name']}"
                         )
+                        if fn in split_outputs:
+                            print(
+                                f"[{client_schema}][{ss}] Sheet workbook {fn} butuh config sendiri di "
+                                f"tools.client_config (source_type parquet, logical_source_file "
+                                f"{resolver.split_ext(fn)[0]})"
+                            )
+
+            if not files_to_handle and skipped_duplicates:
+                # every matched file was already loaded: nothing for the stages or
+                # silver, so no batch_info JSON either
+                log_batch_status(
+                    client_id=client_id,
+                    status="SUCCESS",
+                    batch_id=new_batch_id,
+                    job_name=job_name,
+                    error_message=f"ALL FILES SKIPPED (DUPLICATE): {len(skipped_duplicates)}",
+                    start_time=datetime.now(),
+                )
+                print(
+                    f"[{client_schema}] Semua file ({len(skipped_duplicates)}) duplikat dan di-skip; "
+                    f"batch {new_batch_id} selesai tanpa stage."
+                )
+                return client_summary(
+                    client_schema,
+                    new_batch_id,
+                    "SKIPPED",
+                    files_total=len(skipped_duplicates),
+                )
 
             if not files_to_handle:
                 # Always create batch_info top-level even if there is no matching file
@@ -482,7 +1179,12 @@ def process_client(client_schema, mode):
                         start_time=batch_start,
                     )
                     print(f"[{client_schema}] Gagal menulis batch_info: {e}. Batal.")
-                    return
+                    return client_summary(
+                        client_schema,
+                        new_batch_id,
+                        "FAILED",
+                        error=f"BATCHINFO_WRITE_FAILED: {e}",
+                    )
 
                 batch_start = datetime.now()
                 log_batch_status(
@@ -496,11 +1198,13 @@ def process_client(client_schema, mode):
                 print(
                     f"[{client_schema}] Tidak ada file yang match config. Batch info dibuat: {batch_info_path}"
                 )
-                return
+                return client_summary(
+                    client_schema, new_batch_id, "FAILED", error="FILE CONFIG NOT FOUND"
+                )
 
         # RESTART: update-only flow (strictly update existing audit rows; do not insert new ones)
         elif mode == "restart":
-            new_batch_id = last_batch
+            new_batch_id = batch_id or last_batch
 
             # ensure batch_info exists in incoming for this batch
             batch_info_path = f"batch_info/{client_schema}/incoming/batch_output_{client_schema}_{new_batch_id}.json"
@@ -517,7 +1221,12 @@ def process_client(client_schema, mode):
                 print(
                     f"[{client_schema}] Tidak ada batch_info untuk batch {new_batch_id}. Pindahkan batch_info ke batch_info/{client_schema}/incoming lalu jalankan ulang restart."
                 )
-                return
+                return client_summary(
+                    client_schema,
+                    new_batch_id,
+                    "FAILED",
+                    error=f"NO_BATCH_INFO_FOR_{new_batch_id}",
+                )
 
             try:
                 batch_info = read_json_retry(batch_info_path)
@@ -534,90 +1243,12 @@ def process_client(client_schema, mode):
                     start_time=batch_start,
                 )
                 print(f"[{client_schema}] batch_info tidak valid. Batal restart.")
-                return
-
-            # Prepare a helper to match config using physical file name WITHOUT batch suffix
-            def match_config_for_physical(
-                physical_file_name, source_system, source_type
-            ):
-                phys_norm = normalize_name(strip_batch_suffix(physical_file_name))
-                for cfg_item in configs:
-                    if (
-                        (cfg_item.get("logical_norm") or "") == phys_norm
-                        and (cfg_item.get("source_system") or "").lower()
-                        == (source_system or "").lower()
-                        and (cfg_item.get("source_type") or "") == (source_type or "")
-                    ):
-                        return cfg_item
-                return None
-
-            # helper: fetch existing audit row (by client_id, batch_id, physical_file_name ONLY) and update only config_validation_status + logical_source_file
-            def fetch_and_update_file_audit(
-                client_id, batch_id, physical_file_name, source_system, source_type
-            ):
-                try:
-                    cur.execute(
-                        """
-                        SELECT logical_source_file, source_system, source_type
-                        FROM tools.file_audit_log
-                        WHERE client_id = %s AND batch_id = %s AND physical_file_name = %s
-                        ORDER BY file_received_time DESC NULLS LAST, ctid DESC
-                        LIMIT 1
-                        """,
-                        (client_id, batch_id, physical_file_name),
-                    )
-                    row = cur.fetchone()
-                    if not row:
-                        return (False, None, None)
-                    logical_sf_db, ss_db, st_db = row
-
-                    # decide config match
-                    matched_cfg = match_config_for_physical(
-                        physical_file_name,
-                        source_system or ss_db,
-                        source_type or (st_db or ""),
-                    )
-                    new_status = "SUCCESS" if matched_cfg else "FAILED"
-
-                    if matched_cfg and not logical_sf_db:
-                        cur.execute(
-                            """
-                            UPDATE tools.file_audit_log
-                            SET logical_source_file = %s, config_validation_status = %s
-                            WHERE client_id = %s AND batch_id = %s AND physical_file_name = %s
-                            """,
-                            (
-                                matched_cfg.get("logical_source_file"),
-                                new_status,
-                                client_id,
-                                batch_id,
-                                physical_file_name,
-                            ),
-                        )
-                    else:
-                        cur.execute(
-                            """
-                            UPDATE tools.file_audit_log
-                            SET config_validation_status = %s
-                            WHERE client_id = %s AND batch_id = %s AND physical_file_name = %s
-                            """,
-                            (
-                                new_status,
-                                client_id,
-                                batch_id,
-                                physical_file_name,
-                            ),
-                        )
-                    conn.commit()
-
-                    # logical_sf after update
-                    logical_sf_new = logical_sf_db or (
-                        matched_cfg.get("logical_source_file") if matched_cfg else None
-                    )
-                    return (True, logical_sf_new, matched_cfg)
-                except Exception:
-                    conn.rollback()
-                    raise
+                return client_summary(
+                    client_schema,
+                    new_batch_id,
+                    "FAILED",
+                    error=f"INVALID_BATCH_INFO_{new_batch_id}",
+                )
 
             # Build candidate list from batch_info.files (preferred)
             candidates = []
@@ -636,16 +1267,17 @@ def process_client(client_schema, mode):
                         }
                     )
 
-            # fallback: scan raw incoming for files (these files should already have batch suffix from start)
+            # one scandir pass over raw/<client>/<ss>/{incoming,failed,success}
+            # instead of up to 12 exists() probes per candidate
+            raw_index = index_raw_files(client_schema, source_systems)
+
+            # fallback: raw incoming files (these should already have batch suffix from start)
             if not candidates:
-                for ss in source_systems:
-                    incoming = f"raw/{client_schema}/{ss}/incoming"
-                    if not os.path.isdir(incoming):
-                        continue
-                    for fn in os.listdir(incoming):
-                        if not os.path.isfile(os.path.join(incoming, fn)):
+                for fn, hits in raw_index.items():
+                    for ss, kind, path in hits:
+                        if kind != "incoming":
                             continue
-                        ext = os.path.splitext(fn)[1].lower().lstrip(".")
+                        ext = convert_to_parquet.raw_source_type(path)
                         candidates.append(
                             {
                                 "physical_file_name": fn,
@@ -654,6 +1286,33 @@ def process_client(client_schema, mode):
                             }
                         )
 
+            try:
+                audit_rows = reconcile_file_audit(
+                    cur,
+                    conn,
+                    client_id,
+                    new_batch_id,
+                    candidates,
+                    config_index,
+                )
+            except Exception as e:
+                print(f"[{client_schema}] ERROR saat update file_audit: {e}")
+                batch_start = datetime.now()
+                log_batch_status(
+                    client_id=client_id,
+                    status="FAILED",
+                    batch_id=new_batch_id,
+                    job_name=job_name,
+                    error_message=f"UPDATE_FILE_AUDIT_ERROR: {e}",
+                    start_time=batch_start,
+                )
+                return client_summary(
+                    client_schema,
+                    new_batch_id,
+                    "FAILED",
+                    error=f"UPDATE_FILE_AUDIT_ERROR: {e}",
+                )
+
             missing_records = []
             processed_candidates = []
             for c in candidates:
@@ -661,83 +1320,56 @@ def process_client(client_schema, mode):
                 ss = c.get("source_system") or None
                 st = c.get("source_type") or None
 
-                try:
-                    updated, logical_sf, matched_cfg = fetch_and_update_file_audit(
-                        client_id, new_batch_id, phys, ss, st
-                    )
-                except Exception as e:
-                    print(
-                        f"[{client_schema}] ERROR saat update file_audit untuk {phys}: {e}"
-                    )
-                    batch_start = datetime.now()
-                    log_batch_status(
-                        client_id=client_id,
-                        status="FAILED",
-                        batch_id=new_batch_id,
-                        job_name=job_name,
-                        error_message=f"UPDATE_FILE_AUDIT_ERROR_{phys}: {e}",
-                        start_time=batch_start,
+                if phys not in audit_rows:
+                    missing_records.append((phys, ss, st))
+                    continue
+                logical_sf, matched_cfg = audit_rows[phys]
+
+                # find file on disk (may be in incoming/failed/success); prefer the
+                # recorded source_system, else the first one that has it
+                found_path = None
+                hits = raw_index.get(phys) or []
+                for hit_ss, _, hit_path in hits:
+                    if hit_ss == ss:
+                        found_path = hit_path
+                        break
+                if not found_path and hits:
+                    ss, _, found_path = hits[0]
+
+                # pass along matched metadata for batch_info upsert
+                cfg_meta = {
+                    "physical_file_name": phys,
+                    "source_type": st,
+                    "source_system": ss,
+                    "logical_source_file": logical_sf,
+                    "existing_audit": True,
+                }
+                if matched_cfg:
+                    cfg_meta.update(
+                        {
+                            "target_schema": matched_cfg.get("target_schema"),
+                            "target_table": matched_cfg.get("target_table"),
+                            "source_config": matched_cfg.get("source_config"),
+                            "logical_source_file": matched_cfg.get(
+                                "logical_source_file"
+                            ),
+                        }
                     )
-                    return
 
-                if not updated:
-                    missing_records.append((phys, ss, st))
+                if found_path:
+                    processed_candidates.append(
+                        {
+                            "orig_path": found_path,
+                            "orig_name": phys,
+                            "ss": ss,
+                            "ext": st,
+                            "cfg": cfg_meta,
+                        }
+                    )
                 else:
-                    # find file on disk (may be in incoming/failed/success)
-                    found_path = None
-                    if ss:
-                        for kind in ("incoming", "failed", "success"):
-                            p = os.path.join(f"raw/{client_schema}/{ss}", kind, phys)
-                            if os.path.exists(p):
-                                found_path = p
-                                break
-                    if not found_path:
-                        for root_ss in ("crm", "erp", "api", "db"):
-                            for kind in ("incoming", "failed", "success"):
-                                p = os.path.join(
-                                    f"raw/{client_schema}/{root_ss}", kind, phys
-                                )
-                                if os.path.exists(p):
-                                    found_path = p
-                                    ss = root_ss
-                                    break
-                            if found_path:
-                                break
-
-                    # pass along matched metadata for batch_info upsert
-                    cfg_meta = {
-                        "physical_file_name": phys,
-                        "source_type": st,
-                        "source_system": ss,
-                        "logical_source_file": logical_sf,
-                        "existing_audit": True,
-                    }
-                    if matched_cfg:
-                        cfg_meta.update(
-                            {
-                                "target_schema": matched_cfg.get("target_schema"),
-                                "target_table": matched_cfg.get("target_table"),
-                                "source_config": matched_cfg.get("source_config"),
-                                "logical_source_file": matched_cfg.get(
-                                    "logical_source_file"
-                                ),
-                            }
-                        )
-
-                    if found_path:
-                        processed_candidates.append(
-                            {
-                                "orig_path": found_path,
-                                "orig_name": phys,
-                                "ss": ss,
-                                "ext": st,
-                                "cfg": cfg_meta,
-                            }
-                        )
-                    else:
-                        print(
-                            f"[{client_schema}] WARNING: audit updated but file not found on disk for {phys} (batch {new_batch_id})."
-                        )
+                    print(
+                        f"[{client_schema}] WARNING: audit updated but file not found on disk for {phys} (batch {new_batch_id})."
+                    )
 
             if missing_records:
                 batch_start = datetime.now()
@@ -752,8 +1384,13 @@ def process_client(client_schema, mode):
                 print(
                     f"[{client_schema}] Gagal restart: beberapa file tidak punya record file_audit (belum pernah dijalankan mode start). Detail contoh: {missing_records[:5]}"
                 )
-                # Important: abort here and do NOT proceed to any subprocess
-                return
+                # Important: abort here and do NOT proceed to any stage
+                return client_summary(
+                    client_schema,
+                    new_batch_id,
+                    "FAILED",
+                    error=f"FILE_AUDIT_RECORD_NOT_FOUND for {len(missing_records)} files",
+                )
 
             files_to_handle.extend(processed_candidates)
 
@@ -770,11 +1407,16 @@ def process_client(client_schema, mode):
                 print(
                     f"[{client_schema}] Tidak ada berkas yang dapat diproses pada restart untuk batch {new_batch_id}."
                 )
-                return
+                return client_summary(
+                    client_schema,
+                    new_batch_id,
+                    "FAILED",
+                    error="NO_FILES_TO_PROCESS_ON_RESTART",
+                )
 
         # REPROCESSING: scan data/...incoming for parquet and correlate with batch_info
         elif mode == "reprocessing":
-            new_batch_id = last_batch
+            new_batch_id = batch_id or last_batch
             batch_info_path = f"batch_info/{client_schema}/incoming/batch_output_{client_schema}_{new_batch_id}.json"
             if not os.path.exists(batch_info_path):
                 batch_start = datetime.now()
@@ -789,7 +1431,12 @@ def process_client(client_schema, mode):
                 print(
                     f"[{client_schema}] Tidak ada batch_info untuk batch {new_batch_id}. Batal reprocessing."
                 )
-                return
+                return client_summary(
+                    client_schema,
+                    new_batch_id,
+                    "FAILED",
+                    error=f"NO_BATCH_INFO_FOR_{new_batch_id}",
+                )
 
             try:
                 batch_info = read_json_retry(batch_info_path)
@@ -810,15 +1457,14 @@ def process_client(client_schema, mode):
                 print(
                     f"[{client_schema}] Gagal baca batch_info {batch_info_path}. Batal."
                 )
-                return
+                return client_summary(
+                    client_schema,
+                    new_batch_id,
+                    "FAILED",
+                    error=f"INVALID_BATCH_INFO_{new_batch_id}",
+                )
 
-            parquet_map = {}
-            for f in batch_info.get("files") or []:
-                if not isinstance(f, dict):
-                    continue
-                pn = f.get("parquet_name")
-                if pn:
-                    parquet_map[str(pn)] = f
+            manifest_index = resolver.build_manifest_index(batch_info.get("files"))
 
             data_root = f"data/{client_schema}"
             candidates = []
@@ -838,23 +1484,9 @@ def process_client(client_schema, mode):
                         continue
                     parquet_filename = fn
                     parquet_path = os.path.join(d, fn)
-                    matched_entry = None
-
-                    if parquet_filename in parquet_map:
-                        matched_entry = parquet_map[parquet_filename]
-                    else:
-                        lower_map = {k.lower(): v for k, v in parquet_map.items()}
-                        if parquet_filename.lower() in lower_map:
-                            matched_entry = lower_map[parquet_filename.lower()]
-
-                    if not matched_entry:
-                        base = os.path.splitext(parquet_filename)[0]
-                        base_norm = base.lower().replace("_batch", "").strip()
-                        for k, v in parquet_map.items():
-                            kb = os.path.splitext(k)[0].lower()
-                            if kb.replace("_batch", "").strip() == base_norm:
-                                matched_entry = v
-                                break
+                    matched_entry = resolver.resolve_parquet(
+                        manifest_index, parquet_filename
+                    )
 
                     if not matched_entry:
                         print(
@@ -893,7 +1525,12 @@ def process_client(client_schema, mode):
                 print(
                     f"[{client_schema}] Tidak ditemukan parquet untuk direprocessing pada batch {new_batch_id}."
                 )
-                return
+                return client_summary(
+                    client_schema,
+                    new_batch_id,
+                    "FAILED",
+                    error="FILES NOT FOUND TO REPROCESS",
+                )
 
         # prepare batch_info path (atomic writes when updating)
         batch_info_dir = f"batch_info/{client_schema}/incoming"
@@ -901,6 +1538,11 @@ def process_client(client_schema, mode):
         batch_info_path = os.path.join(
             batch_info_dir, f"batch_output_{client_schema}_{new_batch_id}.json"
         )
+        # file entries go to the manifest store during the run (per-entry upserts);
+        # pick up the JSON first (restart/reprocessing, operator edits) and make
+        # sure the batch carries client_id/batch_id before the first upsert
+        manifest_store.sync_from_json(client_schema, new_batch_id, batch_info_path)
+        manifest_store.init_batch(client_schema, new_batch_id, client_id)
 
         # processing loop (shared)
         batch_start = datetime.now()
@@ -908,23 +1550,18 @@ def process_client(client_schema, mode):
         batch_error_message = None
         success_files = []
 
-        for item in files_to_handle:
-            orig_path = item["orig_path"]
-            orig_name = item[
-                "orig_name"
-            ]  # for restart this already includes batch suffix
-            ss = item["ss"] or "unknown"
-            ext = item["ext"]
-            cfg = item["cfg"]
-
-            # NEW GUARD:
-            # If we're in restart mode, ensure this file came from an existing audit row.
-            # If not, abort the whole run immediately (no subprocesses).
-            if mode == "restart" and not cfg.get("existing_audit"):
-                batch_status = "FAILED"
-                batch_error_message = f"{orig_name} - FILE_AUDIT_RECORD_NOT_FOUND"
+        # NEW GUARD:
+        # If we're in restart mode, ensure every file came from an existing audit row.
+        # If not, abort the whole run immediately (no stages are run).
+        if mode == "restart":
+            for item in files_to_handle:
+                if item["cfg"].get("existing_audit"):
+                    continue
+                batch_error_message = (
+                    f"{item['orig_name']} - FILE_AUDIT_RECORD_NOT_FOUND"
+                )
                 print(
-                    f"[{client_schema}] Abort restart: found file without existing audit record: {orig_name}. Tidak akan menjalankan subprocess."
+                    f"[{client_schema}] Abort restart: found file without existing audit record: {item['orig_name']}. Tidak akan menjalankan stage."
                 )
                 log_batch_status(
                     client_id=client_id,
@@ -934,315 +1571,109 @@ def process_client(client_schema, mode):
                     error_message=batch_error_message,
                     start_time=batch_start,
                 )
-                # close DB cursor/conn in finally and return
-                cur.close()
-                conn.close()
-                return
+                return client_summary(
+                    client_schema, new_batch_id, "FAILED", error=batch_error_message
+                )
 
+        # 1) intake (rename, audit row, move to success, batch_info entry) runs
+        #    serially: it shares this connection and the batch_info file
+        work_items = []
+        for item in files_to_handle:
             try:
-                if mode == "reprocessing":
-                    r = subprocess.run(
-                        [
-                            sys.executable,
-                            "scripts/validate_mapping.py",
-                            client_schema,
-                            orig_name,
-                        ]
+                work_items.append(
+                    prepare_file(
+                        cur,
+                        conn,
+                        client_schema,
+                        client_id,
+                        mode,
+                        new_batch_id,
+                        item,
                     )
-                    if r.returncode != 0:
-                        print(
-                            f"[{client_schema}] validate_mapping FAILED for {orig_name}"
-                        )
-                        batch_status = "FAILED"
-                        batch_error_message = f"{orig_name} - validate_mapping failed"
-                        continue
-
-                    r = subprocess.run(
-                        [
-                            sys.executable,
-                            "scripts/validate_row.py",
-                            client_schema,
-                            orig_name,
-                        ]
-                    )
-                    if r.returncode != 0:
-                        print(
-                            f"[{client_schema}] WARNING validate_row failed for {orig_name} (non-fatal)"
-                        )
-
-                    r = subprocess.run(
-                        [
-                            sys.executable,
-                            "scripts/load_to_bronze.py",
-                            client_schema,
-                            orig_name,
-                        ]
-                    )
-                    if r.returncode != 0:
-                        print(
-                            f"[{client_schema}] load_to_bronze FAILED for {orig_name}"
-                        )
-                        batch_status = "FAILED"
-                        batch_error_message = f"{orig_name} - load_to_bronze failed"
-                        continue
+                )
+            except Exception as e:
+                print(
+                    f"❌ [{client_schema}] Gagal memproses {item['orig_name']} => {e}"
+                )
+                batch_status = "FAILED"
+                batch_error_message = f"{item['orig_name']} - {str(e)}"
 
-                    success_files.append(orig_name)
-
-                    if ss and ss != "unknown":
-                        failed_path = f"raw/{client_schema}/{ss}/failed/{orig_name}"
-                        archive_path = f"raw/{client_schema}/{ss}/archive/{orig_name}"
-                        if os.path.exists(failed_path):
-                            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
-                            shutil.move(failed_path, archive_path)
-
-                elif mode == "restart" and cfg.get("existing_audit"):
-                    # DO NOT rename. Just move (if necessary) to success, upsert batch_info with matched config, then run pipeline.
-                    raw_success = f"raw/{client_schema}/{ss}/success"
-                    raw_failed = f"raw/{client_schema}/{ss}/failed"
-                    raw_archive = f"raw/{client_schema}/{ss}/archive"
-                    os.makedirs(raw_success, exist_ok=True)
-                    os.makedirs(raw_failed, exist_ok=True)
-                    os.makedirs(raw_archive, exist_ok=True)
-
-                    dest_success = os.path.join(raw_success, orig_name)
+        # checkpoints are only trusted when file_audit_log agrees (one query)
+        if mode in ("restart", "reprocessing") and work_items:
+            try:
+                statuses = fetch_stage_statuses(cur, client_id, new_batch_id)
+            except Exception as e:
+                conn.rollback()
+                print(f"[{client_schema}] WARNING: gagal baca status stage: {e}")
+                statuses = {}
+            for w in work_items:
+                w["audit_status"] = statuses.get(w["physical_file_name"])
+                # manifests written before file_audit_id was recorded
+                audit_id = (w["audit_status"] or {}).get("file_audit_id")
+                if audit_id is not None and (
+                    w.get("file_audit_id") != audit_id
+                    or not w.get("file_received_time")
+                ):
                     try:
-                        if os.path.abspath(orig_path) != os.path.abspath(dest_success):
-                            if os.path.exists(dest_success):
-                                os.remove(dest_success)
-                            shutil.move(orig_path, dest_success)
-                    except Exception:
-                        try:
-                            shutil.copy2(orig_path, dest_success)
-                        except Exception:
-                            pass
-
-                    new_entry = {
-                        "physical_file_name": orig_name,
-                        "logical_source_file": cfg.get("logical_source_file"),
-                        "source_system": ss,
-                        "source_type": ext,
-                        "target_schema": cfg.get("target_schema"),
-                        "target_table": cfg.get("target_table"),
-                        "source_config": cfg.get("source_config"),
-                        "parquet_name": None,
-                    }
-                    ok = upsert_file_entry_batch_info(batch_info_path, new_entry)
-                    if not ok:
-                        print(
-                            f"[{client_schema}] WARNING: gagal upsert batch_info untuk {orig_name}; continuing"
-                        )
-
-                    if ext.lower() == "csv":
-                        r = subprocess.run(
-                            [
-                                sys.executable,
-                                "handlers/convert_to_parquet.py",
-                                client_schema,
-                                orig_name,
-                            ]
-                        )
-                        if r.returncode != 0:
-                            src = os.path.join(raw_success, orig_name)
-                            if os.path.exists(src):
-                                shutil.move(src, os.path.join(raw_failed, orig_name))
-                            raise Exception("FAILED on convert_to_parquet")
-
-                        ok = wait_for_parquet_name(
-                            batch_info_path, orig_name, timeout=30.0, poll_interval=0.25
-                        )
-                        if not ok:
-                            src = os.path.join(raw_success, orig_name)
-                            if os.path.exists(src):
-                                shutil.move(src, os.path.join(raw_failed, orig_name))
-                            raise Exception(
-                                "FAILED: convert_to_parquet did not update batch_info with parquet_name within timeout"
-                            )
-
-                    r = subprocess.run(
-                        [
-                            sys.executable,
-                            "scripts/validate_mapping.py",
+                        manifest_store.set_file_audit_id(
                             client_schema,
-                            orig_name,
-                        ]
-                    )
-                    if r.returncode != 0:
-                        src = os.path.join(raw_success, orig_name)
-                        if os.path.exists(src):
-                            shutil.move(src, os.path.join(raw_failed, orig_name))
-                        raise Exception("FAILED on validate_mapping")
-
-                    r = subprocess.run(
-                        [
-                            sys.executable,
-                            "scripts/validate_row.py",
-                            client_schema,
-                            orig_name,
-                        ]
-                    )
-                    if r.returncode != 0:
-                        print(
-                            f"[{client_schema}] WARNING validate_row failed for {orig_name} (non-fatal)"
-                        )
-
-                    r = subprocess.run(
-                        [
-                            sys.executable,
-                            "scripts/load_to_bronze.py",
-                            client_schema,
-                            orig_name,
-                        ]
-                    )
-                    if r.returncode != 0:
-                        src = os.path.join(raw_success, orig_name)
-                        if os.path.exists(src):
-                            shutil.move(src, os.path.join(raw_failed, orig_name))
-                        raise Exception("FAILED on load_to_bronze")
-
-                    src = os.path.join(raw_success, orig_name)
-                    if os.path.exists(src):
-                        shutil.move(src, os.path.join(raw_archive, orig_name))
-
-                    success_files.append(orig_name)
-
-                else:
-                    # START flow (or unexpected path). Rename, insert audit, then pipeline.
-                    base, e = os.path.splitext(orig_name)
-                    base_std = base.strip().replace(" ", "_").replace("-", "_")
-                    new_name = f"{base_std}_{new_batch_id}{e}"
-                    raw_in = f"raw/{client_schema}/{ss}/incoming"
-                    raw_success = f"raw/{client_schema}/{ss}/success"
-                    raw_failed = f"raw/{client_schema}/{ss}/failed"
-                    raw_archive = f"raw/{client_schema}/{ss}/archive"
-                    os.makedirs(raw_success, exist_ok=True)
-                    os.makedirs(raw_failed, exist_ok=True)
-                    os.makedirs(raw_archive, exist_ok=True)
-
-                    new_full = os.path.join(raw_in, new_name)
-                    os.rename(orig_path, new_full)
-
-                    audit_rec = {
-                        "client_id": client_id,
-                        "processed_by": os.getenv("PROCESS_USER")
-                        or getpass.getuser()
-                        or "batch_processing",
-                        "logical_source_file": cfg.get("logical_source_file"),
-                        "physical_file_name": new_name,
-                        "batch_id": new_batch_id,
-                        "file_received_time": datetime.now(),
-                        "source_type": ext,
-                        "source_system": ss,
-                        "config_validation_status": (
-                            "SUCCESS" if cfg.get("logical_source_file") else "FAILED"
-                        ),
-                    }
-
-                    try:
-                        insert_file_audit(cur, conn, audit_rec)
-                    except Exception:
-                        try:
-                            if os.path.exists(new_full):
-                                os.rename(new_full, orig_path)
-                        except Exception:
-                            pass
-                        raise
-
-                    shutil.move(new_full, os.path.join(raw_success, new_name))
-
-                    new_entry = {
-                        "physical_file_name": new_name,
-                        "logical_source_file": cfg.get("logical_source_file"),
-                        "source_system": ss,
-                        "source_type": ext,
-                        "target_schema": cfg.get("target_schema"),
-                        "target_table": cfg.get("target_table"),
-                        "source_config": cfg.get("source_config"),
-                        "parquet_name": None,
-                    }
-
-                    ok = upsert_file_entry_batch_info(batch_info_path, new_entry)
-                    if not ok:
-                        print(
-                            f"[{client_schema}] WARNING: gagal upsert batch_info untuk {new_name}; continuing"
-                        )
-
-                    if ext.lower() == "csv":
-                        r = subprocess.run(
-                            [
-                                sys.executable,
-                                "handlers/convert_to_parquet.py",
-                                client_schema,
-                                new_name,
-                            ]
+                            new_batch_id,
+                            w["physical_file_name"],
+                            audit_id,
+                            w["audit_status"].get("file_received_time"),
                         )
-                        if r.returncode != 0:
-                            src = os.path.join(raw_success, new_name)
-                            if os.path.exists(src):
-                                shutil.move(src, os.path.join(raw_failed, new_name))
-                            raise Exception("FAILED on convert_to_parquet")
-
-                        ok = wait_for_parquet_name(
-                            batch_info_path, new_name, timeout=30.0, poll_interval=0.25
+                        w["file_audit_id"] = audit_id
+                        w["file_received_time"] = w["audit_status"].get(
+                            "file_received_time"
                         )
-                        if not ok:
-                            src = os.path.join(raw_success, new_name)
-                            if os.path.exists(src):
-                                shutil.move(src, os.path.join(raw_failed, new_name))
-                            raise Exception(
-                                "FAILED: convert_to_parquet did not update batch_info with parquet_name within timeout"
-                            )
-
-                    r = subprocess.run(
-                        [
-                            sys.executable,
-                            "scripts/validate_mapping.py",
-                            client_schema,
-                            new_name,
-                        ]
-                    )
-                    if r.returncode != 0:
-                        src = os.path.join(raw_success, new_name)
-                        if os.path.exists(src):
-                            shutil.move(src, os.path.join(raw_failed, new_name))
-                        raise Exception("FAILED on validate_mapping")
-
-                    r = subprocess.run(
-                        [
-                            sys.executable,
-                            "scripts/validate_row.py",
-                            client_schema,
-                            new_name,
-                        ]
-                    )
-                    if r.returncode != 0:
+                    except Exception as e:
                         print(
-                            f"[{client_schema}] WARNING validate_row failed for {new_name} (non-fatal)"
+                            f"[{client_schema}] WARNING: gagal simpan file_audit_id {w['physical_file_name']}: {e}"
                         )
 
-                    r = subprocess.run(
-                        [
-                            sys.executable,
-                            "scripts/load_to_bronze.py",
-                            client_schema,
-                            new_name,
-                        ]
-                    )
-                    if r.returncode != 0:
-                        src = os.path.join(raw_success, new_name)
-                        if os.path.exists(src):
-                            shutil.move(src, os.path.join(raw_failed, new_name))
-                        raise Exception("FAILED on load_to_bronze")
-
-                    src = os.path.join(raw_success, new_name)
-                    if os.path.exists(src):
-                        shutil.move(src, os.path.join(raw_archive, new_name))
-
-                    success_files.append(new_name)
+        # 2) per-file stage chains; files are independent until silver. Each stage
+        #    type has its own pool (e.g. several converters, 2 COPY writers), and
+        #    one lightweight driver thread per in-flight file moves it from pool to
+        #    pool, so file B converts while file A is loading. Each file keeps its
+        #    own stage order.
+        workers = resolve_stage_workers(max_workers, stage_workers)
+        # one pooled DB connection per stage worker (DB_POOL_<STAGE> overrides)
+        for name, n in workers.items():
+            db.configure(name, n)
+        pools = {
+            name: ThreadPoolExecutor(
+                max_workers=n, thread_name_prefix=f"{client_schema}-{name}"
+            )
+            for name, n in workers.items()
+        }
+        drivers = max(1, min(sum(workers.values()), len(work_items) or 1))
+        try:
+            with ThreadPoolExecutor(
+                max_workers=drivers, thread_name_prefix=f"{client_schema}-file"
+            ) as pool:
+                futures = [
+                    pool.submit(run_file_pipeline, client_schema, mode, w, pools)
+                    for w in work_items
+                ]
+                # collect in submission order so the reported error is deterministic
+                for w, fut in zip(work_items, futures):
+                    ok, err = fut.result()
+                    if ok:
+                        success_files.append(w["physical_file_name"])
+                    else:
+                        batch_status = "FAILED"
+                        batch_error_message = err
+        finally:
+            for p in pools.values():
+                p.shutdown(wait=True)
 
-            except Exception as e:
-                print(f"❌ [{client_schema}] Gagal memproses {orig_name} => {e}")
-                batch_status = "FAILED"
-                batch_error_message = f"{orig_name} - {str(e)}"
+        # publish batch_info JSON once for silver/gold/refresh_mv and the webapp
+        try:
+            manifest_store.export_json(client_schema, new_batch_id, batch_info_path)
+        except Exception as e:
+            print(f"[{client_schema}] Gagal menulis batch_info {batch_info_path}: {e}")
+            batch_status = "FAILED"
+            batch_error_message = f"BATCHINFO_WRITE_FAILED: {e}"
 
         log_batch_status(
             client_id=client_id,
@@ -1255,6 +1686,14 @@ def process_client(client_schema, mode):
         print(
             f"[{client_schema}] Done. batch_id={new_batch_id} status={batch_status} files_success={len(success_files)}"
         )
+        return client_summary(
+            client_schema,
+            new_batch_id,
+            batch_status,
+            files_total=len(files_to_handle),
+            files_success=len(success_files),
+            error=batch_error_message,
+        )
 
     finally:
         # make sure cursor/conn are closed if not closed already
@@ -1263,9 +1702,76 @@ def process_client(client_schema, mode):
         except Exception:
             pass
         try:
-            conn.close()
+            db.release(conn)
         except Exception:
             pass
+        # batch boundary: stage logs of this batch (no-op when already flushed)
+        log_sink.flush()
+
+
+# -----------------------------
+# Watch mode
+# -----------------------------
+
+
+def watch_client(
+    client_schema,
+    max_workers=1,
+    settle_seconds=2.0,
+    batch_max_files=50,
+    batch_window_seconds=5.0,
+    poll_interval=1.0,
+    stage_workers=None,
+    downstream=False,
+):
+    """
+    Long-running ingest: wait for files in raw/<client>/<ss>/incoming to settle,
+    cut micro-batches and run each through process_client(..., "start").
+    With downstream, each successful micro-batch is queued on the batch DAG, so
+    silver/gold of batch N run while batch N+1 converts and loads.
+    """
+    source_systems = ["crm", "erp", "api", "db"]
+    for ss in source_systems:
+        ensure_raw_dirs(client_schema, ss)
+    dirs = watcher.incoming_dirs(client_schema, source_systems)
+    dag = batch_dag.open_dag(client_schema) if downstream else None
+    try:
+        for paths in watcher.iter_micro_batches(
+            dirs,
+            settle_seconds=settle_seconds,
+            max_files=batch_max_files,
+            window_seconds=batch_window_seconds,
+            poll_interval=poll_interval,
+        ):
+            print(f"[{client_schema}] Micro-batch: {len(paths)} file")
+            summary = run_client(
+                client_schema,
+                "start",
+                max_workers,
+                include_files=set(paths),
+                stage_workers=stage_workers,
+            )
+            print(
+                f"[{client_schema}] Micro-batch {summary['batch_id']} {summary['status']} "
+                f"files={summary['files_success']}/{summary['files_total']} {summary['duration_sec']}s"
+            )
+            if summary["status"] == "FAILED" and summary["batch_id"]:
+                # later micro-batches move last_batch_id on: restart by id
+                print(
+                    f"[{client_schema}] Restart batch ini: python batch_processing.py "
+                    f"{client_schema} restart --batch-id {summary['batch_id']}"
+                )
+            if dag is not None:
+                submit_downstream(dag, summary)
+                for d in batch_dag.collect_finished(dag):
+                    print_dag_summary(client_schema, d)
+    except KeyboardInterrupt:
+        print(f"[{client_schema}] Watch mode dihentikan.")
+    finally:
+        if dag is not None:
+            print(f"[{client_schema}] Menunggu batch di DAG selesai...")
+            for d in batch_dag.close_dag(dag):
+                print_dag_summary(client_schema, d)
 
 
 # -----------------------------
@@ -1274,25 +1780,164 @@ def process_client(client_schema, mode):
 
 
 def main():
-    args = sys.argv[1:]
-    if len(args) == 2:
-        client, mode = args[0], args[1]
-        if mode not in ("start", "restart", "reprocessing"):
-            print("Gunakan mode: start | restart | reprocessing")
-            return
-        process_client(client, mode)
-    elif len(args) == 0:
+    parser = argparse.ArgumentParser(
+        description="Batch processing raw -> parquet -> bronze per client"
+    )
+    parser.add_argument(
+        "client", nargs="?", help="client_schema (kosong = semua client)"
+    )
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        choices=("start", "restart", "reprocessing", "watch"),
+        help="start | restart | reprocessing | watch",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=int(os.getenv("BATCH_MAX_WORKERS", "1")),
+        help="ukuran default pool tiap stage (convert/validate/load) dalam satu batch (default 1)",
+    )
+    for stage, help_text in (
+        ("convert", "worker convert_to_parquet (CPU)"),
+        ("validate", "worker validate_mapping/validate_row"),
+        ("load", "worker load_to_bronze (COPY ke Postgres)"),
+    ):
+        env_default = os.getenv(f"BATCH_{stage.upper()}_WORKERS")
+        parser.add_argument(
+            f"--{stage}-workers",
+            type=int,
+            default=int(env_default) if env_default else None,
+            help=f"{help_text}; default = --max-workers",
+        )
+    parser.add_argument(
+        "--batch-id",
+        help="restart/reprocessing: batch yang dijalankan ulang (default last_batch_id client)",
+    )
+    parser.add_argument(
+        "--max-clients",
+        type=int,
+        default=int(os.getenv("BATCH_MAX_CLIENTS", "1")),
+        help="tanpa argumen client: jumlah client yang diproses paralel (proses terpisah, default 1)",
+    )
+    parser.add_argument(
+        "--downstream",
+        action="store_true",
+        default=os.getenv("BATCH_DOWNSTREAM", "").lower() in ("1", "true", "yes"),
+        help="lanjutkan batch yang sukses ke silver -> gold -> MV (DAG per batch)",
+    )
+    parser.add_argument(
+        "--settle-seconds",
+        type=float,
+        default=float(os.getenv("WATCH_SETTLE_SECONDS", "2")),
+        help="watch: file dianggap selesai ditulis bila ukuran tidak berubah selama N detik",
+    )
+    parser.add_argument(
+        "--batch-max-files",
+        type=int,
+        default=int(os.getenv("WATCH_BATCH_MAX_FILES", "50")),
+        help="watch: micro-batch dipotong bila jumlah file siap mencapai N",
+    )
+    parser.add_argument(
+        "--batch-window",
+        type=float,
+        default=float(os.getenv("WATCH_BATCH_WINDOW_SECONDS", "5")),
+        help="watch: micro-batch dipotong bila file siap tertua sudah menunggu N detik",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=float(os.getenv("WATCH_POLL_INTERVAL", "1")),
+        help="watch: interval scan folder incoming (detik)",
+    )
+    args = parser.parse_args()
+
+    if args.max_workers < 1:
+        parser.error("--max-workers harus >= 1")
+    if args.max_clients < 1:
+        parser.error("--max-clients harus >= 1")
+    if args.batch_id and args.mode not in ("restart", "reprocessing"):
+        parser.error("--batch-id hanya untuk mode restart | reprocessing")
+    stage_workers = {
+        "convert": args.convert_workers,
+        "validate": args.validate_workers,
+        "load": args.load_workers,
+    }
+    for stage, n in stage_workers.items():
+        if n is not None and n < 1:
+            parser.error(f"--{stage}-workers harus >= 1")
+
+    if args.client and args.mode == "watch":
+        watch_client(
+            args.client,
+            max_workers=args.max_workers,
+            settle_seconds=args.settle_seconds,
+            batch_max_files=args.batch_max_files,
+            batch_window_seconds=args.batch_window,
+            poll_interval=args.poll_interval,
+            stage_workers=stage_workers,
+            downstream=args.downstream,
+        )
+    elif args.client and args.mode:
+        summary = run_client(
+            args.client,
+            args.mode,
+            args.max_workers,
+            stage_workers=stage_workers,
+            downstream=args.downstream,
+            batch_id=args.batch_id,
+        )
+        if summary.get("downstream"):
+            print_dag_summary(args.client, summary["downstream"])
+    elif not args.client and not args.mode:
         conn = get_connection()
         cur = conn.cursor()
         cur.execute("SELECT client_schema FROM tools.client_reference")
         clients = cur.fetchall()
         cur.close()
-        conn.close()
-        for (client_schema,) in clients:
-            process_client(client_schema, "start")
+        db.release(conn)
+        client_schemas = [c for (c,) in clients]
+        summaries = []
+        if args.max_clients <= 1 or len(client_schemas) <= 1:
+            for client_schema in client_schemas:
+                summaries.append(
+                    run_client(
+                        client_schema,
+                        "start",
+                        args.max_workers,
+                        stage_workers=stage_workers,
+                        downstream=args.downstream,
+                    )
+                )
+        else:
+            # one process per client: raw/{client} and batch_info/{client} trees are
+            # disjoint, so tenants do not wait behind each other's large files
+            with ProcessPoolExecutor(
+                max_workers=min(args.max_clients, len(client_schemas))
+            ) as pool:
+                futures = {
+                    c: pool.submit(
+                        run_client,
+                        c,
+                        "start",
+                        args.max_workers,
+                        stage_workers=stage_workers,
+                        downstream=args.downstream,
+                    )
+                    for c in client_schemas
+                }
+                for c, fut in futures.items():
+                    try:
+                        summaries.append(fut.result())
+                    except Exception as e:
+                        # worker process died (e.g. killed / OOM)
+                        summary = client_summary(c, None, "FAILED", error=str(e))
+                        summary["duration_sec"] = None
+                        summaries.append(summary)
+        print_client_summaries(summaries)
     else:
         print(
-            "Format: python batch_processing.py [client] [start|restart|reprocessing]"
+            "Format: python batch_processing.py [client] [start|restart|reprocessing|watch] [--batch-id BATCHnnnnnn] [--max-workers N] [--max-clients N] [--downstream]"
         )
 
 
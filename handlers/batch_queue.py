@@ -0,0 +1,36 @@
+import os
+import json
+
+# -----------------------------
+# Batch JSON queue (silver, gold, MV)
+# -----------------------------
+# The downstream scripts each drain one folder of batch_info/{client}:
+# silver reads incoming/, gold success/, MV archive/.
+
+
+def load_batch_queue(client_schema, folder):
+    """
+    Every batch JSON in batch_info/{client_schema}/{folder}, ordered by
+    batch_id: [(data, file_name, file_path)]. A file that cannot be read is
+    queued last with data {} so its run is recorded as FAILED.
+    """
+    folder_path = os.path.join("batch_info", client_schema, folder)
+    json_files = [f for f in os.listdir(folder_path) if f.lower().endswith(".json")]
+
+    if len(json_files) == 0:
+        raise FileNotFoundError(f"Tidak ada file JSON batch di folder {folder_path}")
+
+    queue = []
+    for file_name in json_files:
+        file_path = os.path.join(folder_path, file_name)
+        try:
+            with open(file_path, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Error membaca batch file {file_name}: {e}")
+            data = {}
+        queue.append((data, file_name, file_path))
+    queue.sort(
+        key=lambda q: (not q[0].get("batch_id"), str(q[0].get("batch_id")), q[1])
+    )
+    return queue
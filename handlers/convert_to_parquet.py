@@ -1,79 +1,37 @@
 #!/usr/bin/env python3
 import os
+import io
 import sys
 import re
 import json
-import tempfile
 import shutil
 import uuid
-import time
+import zipfile
+import tempfile
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import getpass
 
+import duckdb
+import openpyxl
 import pandas as pd
-import psycopg2
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# -----------------------------
-# DB config & helper
-# -----------------------------
-db_port = os.getenv("DB_PORT")
-if db_port is None:
-    raise ValueError("DB_PORT not set in .env")
-
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST"),
-    "port": int(db_port),
-    "dbname": os.getenv("DB_NAME"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-}
-
-
-def get_connection():
-    missing = [k for k, v in DB_CONFIG.items() if v in (None, "")]
-    if missing:
-        raise ValueError(f"Missing DB config values: {missing}")
-    return psycopg2.connect(**DB_CONFIG)
-
-
-# -----------------------------
-# FS / JSON helpers
-# -----------------------------
-def write_json_atomic(path, data):
-    dirn = os.path.dirname(path)
-    os.makedirs(dirn, exist_ok=True)
-    fd, tmp = tempfile.mkstemp(prefix=".tmp_batchinfo_", dir=dirn, text=True)
-    try:
-        with os.fdopen(fd, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-            f.flush()
-            os.fsync(f.fileno())
-        os.replace(tmp, path)
-    except Exception:
-        try:
-            if os.path.exists(tmp):
-                os.remove(tmp)
-        except Exception:
-            pass
-        raise
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.json as pajson
+import pyarrow.parquet as pq
 
+import db
+import log_sink
+import manifest_store
+import resolver
 
-def read_json_retry(path, retries: int = 6, delay: float = 0.12):
-    last_exc = None
-    for i in range(retries):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception as e:
-            last_exc = e
-            if i < retries - 1:
-                time.sleep(delay)
-                continue
-            raise last_exc
+# fcntl is POSIX only; without it parquet passthrough skips the reflink attempt
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 # -----------------------------
@@ -84,27 +42,10 @@ def extract_batch_id(filename: str):
     return m.group(1).upper() if m else None
 
 
-def find_file_entry(batch_info: dict, physical_file_name: str):
-    files = batch_info.get("files") or []
-    for f in files:
-        if f.get("physical_file_name") == physical_file_name:
-            return f
-    return None
-
-
-def _normalize_name_for_match(name: str):
-    if not name:
-        return ""
-    base = os.path.splitext(name)[0]
-    base = re.sub(r"_?BATCH\d{6}$", "", base, flags=re.IGNORECASE)
-    return base.strip().lower()
-
-
 # -----------------------------
 # DB audit helpers
 # -----------------------------
 def update_file_audit_convert_status(
-    conn,
     client_id,
     physical_file_name,
     source_system,
@@ -112,38 +53,24 @@ def update_file_audit_convert_status(
     logical_source_file,
     batch_id,
     status,
+    file_audit_id=None,
+    file_received_time=None,
 ):
-    cur = conn.cursor()
-    sql = """
-        UPDATE tools.file_audit_log
-        SET convert_status = %s
-        WHERE client_id = %s
-          AND physical_file_name = %s
-          AND source_system = %s
-          AND source_type = %s
-          AND logical_source_file = %s
-          AND batch_id = %s
-    """
-    cur.execute(
-        sql,
-        (
-            status,
-            client_id,
-            physical_file_name,
-            source_system,
-            source_type,
-            logical_source_file,
-            batch_id,
-        ),
+    # buffered; written by log_sink.flush() when the stage ends
+    log_sink.update_file_audit(
+        client_id,
+        physical_file_name,
+        source_system,
+        source_type,
+        logical_source_file,
+        batch_id,
+        file_audit_id=file_audit_id,
+        file_received_time=file_received_time,
+        convert_status=status,
     )
-    affected = cur.rowcount
-    conn.commit()
-    cur.close()
-    return affected
 
 
 def insert_job_execution_log(
-    conn,
     client_id,
     job_name,
     status,
@@ -153,80 +80,1265 @@ def insert_job_execution_log(
     start_time,
     end_time,
 ):
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO tools.job_execution_log
-         (client_id, job_name, status, error_message, file_name, batch_id, start_time, end_time)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """,
-        (
-            client_id,
-            job_name,
-            status,
-            error_message,
-            file_name,
-            batch_id,
-            start_time,
-            end_time,
-        ),
+    log_sink.record(
+        "job_execution_log",
+        {
+            "client_id": client_id,
+            "job_name": job_name,
+            "status": status,
+            "error_message": error_message,
+            "file_name": file_name,
+            "batch_id": batch_id,
+            "start_time": start_time,
+            "end_time": end_time,
+        },
     )
-    conn.commit()
-    cur.close()
 
 
 # -----------------------------
 # Conversion
 # -----------------------------
-def convert_to_parquet(src_path, dest_path, src_type):
+# Engines: "pandas" (default) reads the whole file into a DataFrame, "arrow"
+# streams CSV/JSON/XLSX (convert_csv_streaming and friends), "duckdb" runs
+# CSV/JSON through DuckDB (convert_with_duckdb); other source types always
+# use pandas. Parquet sources are passed through when possible
+# (parquet_passthrough_check). Options per source: convert_options.
+
+CONVERT_ENGINES = ("pandas", "arrow", "duckdb")
+DEFAULT_ENGINE = os.getenv("CONVERT_ENGINE", "pandas")
+DEFAULT_BLOCK_SIZE_MB = float(os.getenv("CONVERT_BLOCK_SIZE_MB", "1"))
+DEFAULT_ROW_GROUP_ROWS = int(os.getenv("CONVERT_ROW_GROUP_ROWS", "131072"))
+# 0 / unset: DuckDB defaults (all cores, 80% of RAM)
+DEFAULT_DUCKDB_THREADS = int(os.getenv("CONVERT_DUCKDB_THREADS", "0"))
+DEFAULT_DUCKDB_MEMORY_LIMIT = os.getenv("CONVERT_DUCKDB_MEMORY_LIMIT")
+DEFAULT_PASSTHROUGH_CODECS = os.getenv(
+    "CONVERT_PARQUET_PASSTHROUGH_CODECS", "SNAPPY,ZSTD"
+)
+
+DEFAULT_XLSX_BLOCK_ROWS = int(os.getenv("CONVERT_XLSX_BLOCK_ROWS", "16384"))
+DEFAULT_SHEET_WORKERS = int(os.getenv("CONVERT_SHEET_WORKERS", "0"))
+EXCEL_TYPES = ("xlsx", "xls", "excel")
+DEFAULT_PIN_SCHEMA = os.getenv("CONVERT_PIN_SCHEMA", "false")
+SCHEMA_CACHE_TTL = int(os.getenv("CONVERT_SCHEMA_CACHE_TTL", "3600"))
+JSON_SNIFF_BYTES = 64 * 1024  # json_layout reads no more than this
+PARQUET_CODECS = ("snappy", "zstd", "gzip", "brotli", "lz4", "none")
+DEFAULT_PARQUET_COMPRESSION = os.getenv("CONVERT_PARQUET_COMPRESSION", "snappy")
+# unset: the codec's default level
+DEFAULT_PARQUET_COMPRESSION_LEVEL = os.getenv("CONVERT_PARQUET_COMPRESSION_LEVEL")
+DEFAULT_WRITE_OPTIONS = {"compression": "snappy"}
+# codecs DuckDB's read_csv/read_json decompress themselves
+DUCKDB_COMPRESSIONS = (None, "gzip", "zstd")
+
+FICLONE = 0x40049409  # linux/fs.h: reflink dst to src
+
+# pandas.read_csv default na_values / boolean literals
+PANDAS_NA_VALUES = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+PANDAS_BOOL_VALUES = ["True", "TRUE", "true", "False", "FALSE", "false"]
+
+
+def convert_options(source_config=None):
+    """
+    Conversion options for one source: source_config["convert"] over env
+    defaults, e.g. {"convert": {"engine": "arrow", "block_size_mb": 1,
+    "row_group_rows": 131072}} or {"engine": "duckdb", "threads": 4,
+    "memory_limit": "2GB"}. Missing keys come from env CONVERT_ENGINE,
+    CONVERT_BLOCK_SIZE_MB, CONVERT_ROW_GROUP_ROWS, CONVERT_DUCKDB_THREADS,
+    CONVERT_DUCKDB_MEMORY_LIMIT, CONVERT_PARQUET_PASSTHROUGH_CODECS (empty:
+    always re-encode), CONVERT_PARQUET_COMPRESSION(_LEVEL). With several
+    convert workers, keep threads x workers within the host's cores.
+    """
+    cfg = (source_config or {}).get("convert") or {}
+    options = {
+        "engine": (cfg.get("engine") or DEFAULT_ENGINE).lower(),
+        "block_size_mb": float(cfg.get("block_size_mb") or DEFAULT_BLOCK_SIZE_MB),
+        "row_group_rows": int(cfg.get("row_group_rows") or DEFAULT_ROW_GROUP_ROWS),
+        "threads": int(cfg.get("threads") or DEFAULT_DUCKDB_THREADS),
+        "memory_limit": cfg.get("memory_limit") or DEFAULT_DUCKDB_MEMORY_LIMIT,
+        # rows DuckDB samples to sniff CSV types (-1: whole file)
+        "sample_size": cfg.get("sample_size"),
+        "passthrough_codecs": cfg.get(
+            "passthrough_codecs", cfg.get("compression") or DEFAULT_PASSTHROUGH_CODECS
+        ),
+        # workbook sheet to convert (name or 0-based index)
+        "sheet": cfg.get("sheet", 0),
+        # parallel processes for split_workbook (0: one per CPU)
+        "sheet_workers": int(cfg.get("sheet_workers") or DEFAULT_SHEET_WORKERS),
+        # CSV typed from tools.column_mapping + bronze types (pinned_column_types)
+        "pin_schema": str(cfg.get("pin_schema", DEFAULT_PIN_SCHEMA)).lower()
+        in ("1", "true", "yes"),
+        # null tokens / strptime formats for pinned CSV (None: pandas tokens, ISO 8601)
+        "null_values": cfg.get("null_values"),
+        "date_formats": cfg.get("date_formats"),
+        # Parquet layout policy (see parquet_write_options / sort_parquet)
+        "compression": (cfg.get("compression") or DEFAULT_PARQUET_COMPRESSION).lower(),
+        "compression_level": cfg.get(
+            "compression_level", DEFAULT_PARQUET_COMPRESSION_LEVEL
+        ),
+        "sort_by": cfg.get("sort_by") or [],
+        # None: dictionary-encode every column (pyarrow default)
+        "dictionary_columns": cfg.get("dictionary_columns"),
+    }
+    if options["engine"] not in CONVERT_ENGINES:
+        raise ValueError(
+            f"Unknown convert engine '{options['engine']}' (expected one of {CONVERT_ENGINES})"
+        )
+    if options["compression"] not in PARQUET_CODECS:
+        raise ValueError(
+            f"Unknown Parquet compression '{options['compression']}' (expected one of {PARQUET_CODECS})"
+        )
+    if isinstance(options["sort_by"], str):
+        options["sort_by"] = [options["sort_by"]]
+    return options
+
+
+def parquet_write_options(options):
+    """
+    pq.ParquetWriter / write_table keyword arguments for the layout policy
+    ("compression", "compression_level", "dictionary_columns"; every writer
+    uses them, DuckDB's COPY picks its own dictionaries). A compression
+    setting is also the default passthrough_codecs, and sort_by or
+    dictionary_columns disable passthrough.
+    """
+    kwargs = {"compression": options["compression"]}
+    if options["compression_level"] not in (None, ""):
+        kwargs["compression_level"] = int(options["compression_level"])
+    if options["dictionary_columns"] is not None:
+        kwargs["use_dictionary"] = list(options["dictionary_columns"])
+    return kwargs
+
+
+def zip_member(zf):
+    """Name of the one data file in a zip (directories, __MACOSX/, dotfiles ignored)."""
+    names = [
+        i.filename
+        for i in zf.infolist()
+        if not i.is_dir()
+        and not i.filename.startswith("__MACOSX/")
+        and not os.path.basename(i.filename).startswith(".")
+    ]
+    if len(names) != 1:
+        raise ValueError(
+            f"{zf.filename}: expected exactly one data file in the zip, found {len(names)}"
+        )
+    return names[0]
+
+
+def raw_source_type(path):
+    """Source type of a raw file: 'a.csv.gz' -> 'csv'; a bare 'a.zip' by its member."""
+    source_type = resolver.source_type_of(path)
+    if not source_type and resolver.compression_of(path) == "zip":
+        try:
+            with zipfile.ZipFile(path) as zf:
+                source_type = resolver.source_type_of(zip_member(zf))
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return ""
+    return source_type
+
+
+def open_source(src_path):
+    """
+    Binary stream of a raw file, decompressed on the fly when compressed
+    (.gz/.bz2/.zst via pyarrow's codecs, .zip with one data file); no
+    decompressed copy is written. DuckDB reads gzip/zstd itself; for .zip and
+    .bz2 the duckdb engine falls back to the arrow readers.
+    """
+    codec = resolver.compression_of(src_path)
+    if codec == "zip":
+        with zipfile.ZipFile(src_path) as zf:
+            # the member stream keeps the archive open after zf is closed
+            return zf.open(zip_member(zf))
+    if codec:
+        return io.BufferedReader(pa.input_stream(src_path, compression=codec))
+    return open(src_path, "rb")
+
+
+def reader_source(src_path):
+    """What the pyarrow readers get: the path, or a decompressing stream."""
+    return open_source(src_path) if resolver.compression_of(src_path) else src_path
+
+
+def pandas_string_type():
+    """Arrow type pandas.to_parquet uses for text columns (string or large_string)."""
+    sample = pd.DataFrame({"s": pd.Series(["x"])})
+    return pa.Schema.from_pandas(sample, preserve_index=False).field("s").type
+
+
+def pandas_column_names(names):
+    """Header names as read_csv returns them: blanks -> 'Unnamed: i', duplicates -> 'x.1'."""
+    result, seen = [], set()
+    for i, name in enumerate(names):
+        name = name or f"Unnamed: {i}"
+        unique, n = name, 0
+        while unique in seen:
+            n += 1
+            unique = f"{name}.{n}"
+        seen.add(unique)
+        result.append(unique)
+    return result
+
+
+def open_csv_as_text(src_path, block_size, null_values=None):
+    """Streaming reader with every column as text and pandas' null markers (or null_values)."""
+    block = max(int(block_size), 1 << 16)
+    with pacsv.open_csv(
+        reader_source(src_path), read_options=pacsv.ReadOptions(block_size=block)
+    ) as head:
+        names = pandas_column_names(head.schema.names)
+    return pacsv.open_csv(
+        reader_source(src_path),
+        read_options=pacsv.ReadOptions(
+            block_size=block, skip_rows=1, column_names=names
+        ),
+        convert_options=pacsv.ConvertOptions(
+            column_types={n: pa.string() for n in names},
+            null_values=PANDAS_NA_VALUES if null_values is None else null_values,
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=True,
+        ),
+    )
+
+
+def numeric_text(col):
+    # read_csv accepts surrounding blanks and a leading '+' in numbers
+    return pc.replace_substring_regex(
+        pc.utf8_trim_whitespace(col), pattern=r"^\+", replacement=""
+    )
+
+
+def castable(col, typ):
+    try:
+        pc.cast(col, typ)
+        return True
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return False
+
+
+def infer_csv_schema(src_path, block_size):
+    """First pass: the Arrow schema read_csv + to_parquet would produce."""
+    state = None
+    rows = 0
+    with open_csv_as_text(src_path, block_size) as reader:
+        names = reader.schema.names
+        state = {
+            n: {
+                "nulls": False,
+                "values": False,
+                "int": True,
+                "float": True,
+                "bool": True,
+            }
+            for n in names
+        }
+        for batch in reader:
+            rows += batch.num_rows
+            for name, col in zip(names, batch.columns):
+                st = state[name]
+                if col.null_count:
+                    st["nulls"] = True
+                values = col.drop_null()
+                if not len(values):
+                    continue
+                st["values"] = True
+                num = numeric_text(values)
+                if st["int"]:
+                    st["int"] = castable(num, pa.int64())
+                if not st["int"] and st["float"]:
+                    st["float"] = castable(num, pa.float64())
+                if st["bool"]:
+                    st["bool"] = pc.all(
+                        pc.is_in(values, value_set=pa.array(PANDAS_BOOL_VALUES))
+                    ).as_py()
+
+    text = pandas_string_type()
+    fields = []
+    for name in names:
+        st = state[name]
+        if not rows:
+            typ = text
+        elif not st["values"]:
+            typ = pa.float64()  # all NaN
+        elif st["int"]:
+            typ = pa.float64() if st["nulls"] else pa.int64()
+        elif st["float"]:
+            typ = pa.float64()
+        elif st["bool"]:
+            typ = pa.bool_()
+        else:
+            typ = text
+        fields.append(pa.field(name, typ))
+    return pa.schema(fields)
+
+
+def parse_datetimes(col, typ, date_formats=None):
+    """Text -> timestamp/date: ISO 8601, or the first of date_formats that matches."""
+    text = pc.utf8_trim_whitespace(col)
+    if not date_formats:
+        parsed = pc.cast(text, pa.timestamp("us"))
+    else:
+        parsed = pc.coalesce(
+            *[
+                pc.strptime(text, format=f, unit="us", error_is_null=True)
+                for f in date_formats
+            ]
+        )
+        bad = pc.sum(pc.and_(pc.is_valid(text), pc.is_null(parsed))).as_py()
+        if bad:
+            raise ValueError(f"{bad} values match none of date_formats {date_formats}")
+    # date targets drop the time of day on purpose
+    return pc.cast(parsed, typ, safe=not pa.types.is_date(typ))
+
+
+def cast_numeric(col, typ):
+    """
+    Text -> pinned numeric type, as lenient as the bronze COPY: decimals with
+    more scale than the target are rounded half away from zero (like
+    Postgres numeric), integers accept integral floats such as "1.0".
+    """
+    num = numeric_text(col)
+    try:
+        return pc.cast(num, typ)
+    except pa.ArrowInvalid:
+        if pa.types.is_integer(typ):
+            floats = pc.cast(num, pa.float64())
+            fraction = pc.not_equal(pc.floor(floats), floats)
+            if pc.any(fraction).as_py():
+                raise
+            return pc.cast(floats, typ)
+        if not pa.types.is_decimal(typ) or typ.precision >= 38:
+            raise
+        # widest scale that still holds the target's integer digits
+        wide = pc.cast(num, pa.decimal128(38, 38 - (typ.precision - typ.scale)))
+        rounded = pc.round(wide, ndigits=typ.scale, round_mode="half_towards_infinity")
+        return pc.cast(rounded, typ)
+
+
+def cast_batch(batch, schema, date_formats=None):
+    columns = []
+    for col, field in zip(batch.columns, schema):
+        try:
+            if (
+                pa.types.is_integer(field.type)
+                or pa.types.is_floating(field.type)
+                or pa.types.is_decimal(field.type)
+            ):
+                col = cast_numeric(col, field.type)
+            elif pa.types.is_timestamp(field.type) or pa.types.is_date(field.type):
+                col = parse_datetimes(col, field.type, date_formats)
+            else:
+                col = pc.cast(col, field.type)
+        except (pa.ArrowInvalid, ValueError) as e:
+            raise ValueError(f"column '{field.name}' as {field.type}: {e}") from e
+        columns.append(col)
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def convert_csv_streaming(
+    src_path,
+    out_path,
+    block_size_mb=DEFAULT_BLOCK_SIZE_MB,
+    row_group_rows=DEFAULT_ROW_GROUP_ROWS,
+    pinned_types=None,
+    null_values=None,
+    date_formats=None,
+    write_options=None,
+):
+    """
+    CSV -> Parquet in bounded memory. Types are inferred pandas-style in a
+    first pass, or, with pinned_types ({column key: Arrow type}, see
+    pinned_column_types), taken from it in a single pass: mapped columns get
+    their pinned type, other columns stay text. Returns row count.
+
+    Memory does not grow with the file: the reader keeps a readahead of a few
+    dozen blocks, so peak is roughly 40 x block size plus one row group.
+    Inferred types follow pandas' read_csv rules (int64, float64 when an int
+    column has nulls, bool, otherwise string; same null markers and header
+    renaming), so the output matches the pandas engine.
+    """
+    block_size = int(block_size_mb * 1024 * 1024)
+    if pinned_types:
+        with open_csv_as_text(src_path, block_size, null_values) as reader:
+            names = reader.schema.names
+        text = pandas_string_type()
+        schema = pa.schema(
+            pa.field(n, pinned_types.get(column_key(n), text)) for n in names
+        )
+    else:
+        schema = infer_csv_schema(src_path, block_size)
+    with pq.ParquetWriter(
+        out_path, schema, **(write_options or DEFAULT_WRITE_OPTIONS)
+    ) as writer:
+        with open_csv_as_text(src_path, block_size, null_values) as reader:
+            return write_row_groups(
+                writer,
+                (cast_batch(b, schema, date_formats) for b in reader if b.num_rows),
+                schema,
+                row_group_rows,
+            )
+
+
+# -----------------------------
+# Pinned CSV schema (tools.column_mapping + bronze column types)
+# -----------------------------
+PINNED_SCHEMA_SQL = """
+    SELECT m.source_column, c.data_type, c.numeric_precision, c.numeric_scale
+    FROM tools.column_mapping m
+    LEFT JOIN information_schema.columns c
+      ON c.table_schema = %s
+     AND c.table_name = %s
+     AND lower(c.column_name) = lower(m.target_column)
+    WHERE m.client_id = %s
+      AND m.logical_source_file = %s
+      AND m.source_system = %s
+      AND m.source_type = %s
+      AND m.is_active = true
+    ORDER BY m.mapping_id
+"""
+
+PG_ARROW_TYPES = {
+    "smallint": pa.int64(),
+    "integer": pa.int64(),
+    "bigint": pa.int64(),
+    "real": pa.float64(),
+    "double precision": pa.float64(),
+    "boolean": pa.bool_(),
+    "date": pa.date32(),
+    "timestamp without time zone": pa.timestamp("us"),
+}
+
+
+def column_key(name):
+    # same normalization load_to_bronze uses to match mapping and parquet columns
+    return str(name).strip().lower().replace(" ", "_").replace("-", "_")
+
+
+def pg_arrow_type(data_type, precision=None, scale=None):
+    """
+    Arrow type for a bronze column type; unknown / text types -> None (text).
+    numeric(p,s) up to p=38 becomes decimal128; unconstrained numeric and
+    p>38 stay text so no digits are lost (DuckDB reads decimal256 Parquet
+    as DOUBLE in load_to_bronze) and Postgres parses the value on COPY.
+    timestamptz stays text too: sources mix zone offsets, "Z" and local times,
+    which only Postgres resolves (with the session time zone).
+    """
+    if data_type == "numeric":
+        if precision and precision <= 38:
+            return pa.decimal128(precision, scale or 0)
+        return None
+    return PG_ARROW_TYPES.get(data_type)
+
+
+def pinned_column_types(client_schema, client_id, file_entry):
+    """
+    {column key: Arrow type} for the mapped source columns of a file entry,
+    from tools.column_mapping and the information_schema types of its bronze
+    table; None when the source has no mapping. Cached per source_system and
+    logical_source_file in the manifest store for SCHEMA_CACHE_TTL seconds.
+    """
+    logical = file_entry.get("logical_source_file")
+    source_system = file_entry.get("source_system")
+    blob = manifest_store.get_cached_schema(
+        client_schema, source_system, logical, "csv_pinned", max_age=SCHEMA_CACHE_TTL
+    )
+    if blob:
+        schema = pa.ipc.read_schema(pa.py_buffer(blob))
+    else:
+        conn = db.get_connection("convert")
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    PINNED_SCHEMA_SQL,
+                    (
+                        file_entry.get("target_schema"),
+                        file_entry.get("target_table"),
+                        client_id,
+                        logical,
+                        source_system,
+                        file_entry.get("source_type"),
+                    ),
+                )
+                rows = cur.fetchall()
+        finally:
+            db.release(conn)
+        if not rows:
+            return None
+        schema = pa.schema(
+            pa.field(src, pg_arrow_type(*rest) or pa.string()) for src, *rest in rows
+        )
+        manifest_store.set_cached_schema(
+            client_schema,
+            source_system,
+            logical,
+            "csv_pinned",
+            schema.serialize().to_pybytes(),
+        )
+    text = pandas_string_type()
+    return {
+        column_key(f.name): text if pa.types.is_string(f.type) else f.type
+        for f in schema
+    }
+
+
+def write_row_groups(writer, batches, schema, row_group_rows):
+    """Write batches as row groups of row_group_rows rows. Returns row count."""
+    rows = 0
+    pending, pending_rows = [], 0
+    for batch in batches:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        rows += batch.num_rows
+        if pending_rows >= row_group_rows:
+            # full row groups only; the remainder waits for the next blocks
+            table = pa.Table.from_batches(pending, schema=schema)
+            full = pending_rows - pending_rows % row_group_rows
+            writer.write_table(table.slice(0, full), row_group_size=row_group_rows)
+            pending = table.slice(full).to_batches()
+            pending_rows -= full
+    if pending_rows:
+        writer.write_table(pa.Table.from_batches(pending, schema=schema))
+    return rows
+
+
+def quote_path_literal(p: str) -> str:
+    # put into single-quoted SQL literal, escape single quotes
+    return p.replace("'", "''")
+
+
+def convert_with_duckdb(
+    src_path,
+    out_path,
+    src_type,
+    threads=0,
+    memory_limit=None,
+    row_group_rows=DEFAULT_ROW_GROUP_ROWS,
+    sample_size=None,
+    compression="snappy",
+    compression_level=None,
+):
+    """
+    CSV/JSON -> Parquet with DuckDB's parallel readers, `threads` threads and
+    a `memory_limit` (spills beyond it). Column types come from DuckDB's
+    sniffer (e.g. ISO dates become DATE), so the output is not identical to
+    the pandas engine. Returns row count.
+    """
+    src_sql = quote_path_literal(os.path.abspath(src_path))
+    if src_type == "csv":
+        sample = f", sample_size = {int(sample_size)}" if sample_size else ""
+        source = f"read_csv('{src_sql}', header = true{sample})"
+    else:
+        source = f"read_json_auto('{src_sql}')"
+
+    dconn = duckdb.connect(database=":memory:")
+    try:
+        if threads:
+            dconn.execute(f"SET threads = {int(threads)}")
+        if memory_limit:
+            dconn.execute(
+                f"SET memory_limit = '{quote_path_literal(str(memory_limit))}'"
+            )
+        codec = "UNCOMPRESSED" if compression == "none" else compression.upper()
+        level = (
+            f", COMPRESSION_LEVEL {int(compression_level)}"
+            if compression_level not in (None, "")
+            else ""
+        )
+        dconn.execute(
+            f"COPY (SELECT * FROM {source}) TO '{quote_path_literal(os.path.abspath(out_path))}' "
+            f"(FORMAT PARQUET, COMPRESSION {codec}{level}, ROW_GROUP_SIZE {int(row_group_rows)})"
+        )
+        return dconn.fetchone()[0]
+    finally:
+        dconn.close()
+
+
+def parquet_passthrough_check(src_path, codecs):
+    """
+    Decide from the Parquet footer alone: ("passthrough", None), ("reencode",
+    reason) for other codecs, or ("pandas", reason) for nested columns and
+    duplicate/empty column names. Raises when the file is not readable Parquet.
+    A passthrough file is cloned into data/.../incoming (clone_file), other
+    codecs are re-encoded row group by row group (reencode_parquet). Column
+    names are not compared with tools.column_mapping here; that is
+    validate_mapping's job, as for every other source type.
+    """
+    if isinstance(codecs, str):
+        codecs = codecs.split(",")
+    codecs = {c.strip().upper() for c in codecs or () if c.strip()}
+    md = pq.read_metadata(src_path)
+    schema = md.schema.to_arrow_schema()
+    names = schema.names
+    nested = [f.name for f in schema if pa.types.is_nested(f.type)]
+    if nested:
+        return "pandas", f"nested columns {nested}"
+    if len(set(names)) != len(names) or not all(names):
+        return "pandas", "duplicate or empty column names"
+    used = {
+        md.row_group(i).column(j).compression.upper()
+        for i in range(md.num_row_groups)
+        for j in range(md.num_columns)
+    }
+    if not used <= codecs:
+        return "reencode", f"codec {sorted(used - codecs)} not in passthrough list"
+    return "passthrough", None
+
+
+def clone_file(src_path, dest_path):
+    """Hardlink, else reflink (same filesystem), else copy. Returns the method used."""
+    try:
+        os.link(src_path, dest_path)
+        return "hardlink"
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            with open(src_path, "rb") as src, open(dest_path, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return "reflink"
+        except OSError:
+            pass
+    shutil.copyfile(src_path, dest_path)
+    return "copy"
+
+
+def reencode_parquet(
+    src_path, out_path, row_group_rows=DEFAULT_ROW_GROUP_ROWS, write_options=None
+):
+    """Rewrite one row group at a time (bounded memory). Returns row count."""
+    src = pq.ParquetFile(src_path)
+    rows = 0
+    with pq.ParquetWriter(
+        out_path, src.schema_arrow, **(write_options or DEFAULT_WRITE_OPTIONS)
+    ) as writer:
+        for batch in src.iter_batches(batch_size=row_group_rows):
+            writer.write_batch(batch, row_group_size=row_group_rows)
+            rows += batch.num_rows
+    return rows
+
+
+def sort_parquet(
+    src_path,
+    out_path,
+    sort_by,
+    row_group_rows=DEFAULT_ROW_GROUP_ROWS,
+    write_options=None,
+    threads=0,
+    memory_limit=None,
+):
+    """
+    Rewrite src_path ordered by the sort_by columns (ascending, nulls last).
+    DuckDB does the sort (spilling beyond memory_limit), pyarrow writes the
+    result with the original schema and the order in the footer
+    (sorting_columns), so row group min/max statistics let validate_row and
+    load_to_bronze skip row groups. Returns row count.
+    """
+    schema = pq.read_schema(src_path)
+    missing = [c for c in sort_by if c not in schema.names]
+    if missing:
+        raise ValueError(f"sort_by columns not in file: {missing}")
+    order = ", ".join('"' + c.replace('"', '""') + '" NULLS LAST' for c in sort_by)
+    sorting = pq.SortingColumn.from_ordering(
+        schema, [(c, "ascending") for c in sort_by], null_placement="at_end"
+    )
+
+    dconn = duckdb.connect(database=":memory:")
+    try:
+        if threads:
+            dconn.execute(f"SET threads = {int(threads)}")
+        if memory_limit:
+            dconn.execute(
+                f"SET memory_limit = '{quote_path_literal(str(memory_limit))}'"
+            )
+        # the sort has to see every row before the first one comes out
+        dconn.execute("SET preserve_insertion_order = false")
+        src_sql = quote_path_literal(os.path.abspath(src_path))
+        reader = dconn.execute(
+            f"SELECT * FROM read_parquet('{src_sql}') ORDER BY {order}"
+        ).to_arrow_reader(row_group_rows)
+        with pq.ParquetWriter(
+            out_path,
+            schema,
+            sorting_columns=sorting,
+            **(write_options or DEFAULT_WRITE_OPTIONS),
+        ) as writer:
+            # Table.cast: RecordBatch.cast needs pyarrow 16
+            batches = (
+                cast
+                for b in reader
+                for cast in pa.Table.from_batches([b]).cast(schema).to_batches()
+            )
+            return write_row_groups(writer, batches, schema, row_group_rows)
+    finally:
+        dconn.close()
+
+
+def parquet_layout(path):
+    """
+    Effective layout of a Parquet file, read back from its footer: codecs,
+    row groups, largest row group, sort columns and dictionary-encoded columns.
+    """
+    md = pq.read_metadata(path)
+    codecs, dictionary, sort_by = set(), [], []
+    for i in range(md.num_row_groups):
+        rg = md.row_group(i)
+        for j in range(rg.num_columns):
+            col = rg.column(j)
+            codecs.add(col.compression)
+            if i == 0 and any("DICTIONARY" in e for e in col.encodings):
+                dictionary.append(col.path_in_schema)
+        if i == 0:
+            sort_by = [
+                md.schema.column(c.column_index).path for c in rg.sorting_columns
+            ]
+    return {
+        "compression": sorted(codecs),
+        "row_groups": md.num_row_groups,
+        "row_group_rows": max(
+            (md.row_group(i).num_rows for i in range(md.num_row_groups)), default=0
+        ),
+        "sort_by": sort_by,
+        "dictionary_columns": dictionary,
+    }
+
+
+def json_layout(src_path):
+    """
+    'ndjson', 'array' or 'document', decided from the first JSON_SNIFF_BYTES
+    only: '[' starts an array; '{' is NDJSON when the first line ends inside
+    that prefix and is a complete object (a longer first record counts as a
+    document), so single-line dumps are never read whole here.
+    """
+    with open_source(src_path) as fh:
+        prefix = fh.read(JSON_SNIFF_BYTES)
+    head = prefix.lstrip(b"\xef\xbb\xbf").lstrip()
+    if head.startswith(b"["):
+        return "array"
+    if head.startswith(b"{"):
+        end = head.find(b"\n")
+        if end == -1 and len(prefix) < JSON_SNIFF_BYTES:
+            end = len(head)  # whole (small) file is one line
+        if end != -1:
+            try:
+                json.loads(head[:end])
+                return "ndjson"
+            except ValueError:
+                pass
+    return "document"
+
+
+def flatten_table(table):
+    """Nested records -> columns: struct field b of column a becomes 'a.b'."""
+    while any(pa.types.is_struct(t) for t in table.schema.types):
+        table = table.flatten()
+    return table
+
+
+def infer_ndjson_schema(src_path, block_size):
+    """
+    Schema of the whole NDJSON file: blocks of whole lines are read one at a
+    time and their schemas unified (int + float -> float, null + x -> x,
+    struct fields merged). Raises when a field changes kind (number vs text).
+    """
+    schema = None
+    tail = b""
+    with open_source(src_path) as fh:
+        while True:
+            data = fh.read(block_size)
+            buf = tail + data
+            if data:
+                cut = buf.rfind(b"\n") + 1
+                buf, tail = buf[:cut], buf[cut:]
+            else:
+                tail = b""
+            if buf.strip():
+                part = pajson.read_json(
+                    io.BytesIO(buf),
+                    read_options=pajson.ReadOptions(block_size=len(buf) + 1),
+                ).schema
+                schema = (
+                    part
+                    if schema is None
+                    else pa.unify_schemas([schema, part], promote_options="permissive")
+                )
+            if not data:
+                return schema or pa.schema([])
+
+
+def open_ndjson(src_path, schema, block_size):
+    """Streaming reader with a fixed schema; fields outside it raise."""
+    return pajson.open_json(
+        reader_source(src_path),
+        read_options=pajson.ReadOptions(block_size=block_size),
+        parse_options=pajson.ParseOptions(
+            explicit_schema=schema, unexpected_field_behavior="error"
+        ),
+    )
+
+
+def write_json_batches(reader, out_path, row_group_rows, write_options=None):
+    """Flatten every batch of reader and write it as row groups. Returns row count."""
+    schema = flatten_table(reader.schema.empty_table()).schema
+
+    def flat():
+        for batch in reader:
+            if batch.num_rows:
+                table = flatten_table(pa.Table.from_batches([batch]))
+                yield from table.cast(schema).to_batches()
+
+    with pq.ParquetWriter(
+        out_path, schema, **(write_options or DEFAULT_WRITE_OPTIONS)
+    ) as writer:
+        return write_row_groups(writer, flat(), schema, row_group_rows)
+
+
+def convert_json_streaming(
+    src_path,
+    out_path,
+    layout,
+    block_size_mb=DEFAULT_BLOCK_SIZE_MB,
+    row_group_rows=DEFAULT_ROW_GROUP_ROWS,
+    schema_key=None,
+    threads=0,
+    memory_limit=None,
+    write_options=None,
+):
+    """
+    JSON (layout 'ndjson' or 'array', see json_layout) -> Parquet in bounded
+    memory, nested records flattened to columns.
+    NDJSON goes through pyarrow.json; its schema is inferred in a first pass
+    and, with schema_key=(client_schema, source_system, logical_source_file),
+    cached in the manifest store for SCHEMA_CACHE_TTL seconds so later files of the source are read in one pass (a file
+    that does not fit the cached schema is inferred again). JSON arrays and
+    NDJSON whose fields change kind are streamed by DuckDB read_json.
+    Returns a description of the path taken.
+    """
+    block_size = max(int(block_size_mb * 1024 * 1024), 1 << 16)
+    if layout == "ndjson":
+        cached = None
+        if schema_key:
+            blob = manifest_store.get_cached_schema(
+                *schema_key, "json", max_age=SCHEMA_CACHE_TTL
+            )
+            if blob:
+                cached = pa.ipc.read_schema(pa.py_buffer(blob))
+        if cached is not None:
+            try:
+                with open_ndjson(src_path, cached, block_size) as reader:
+                    write_json_batches(reader, out_path, row_group_rows, write_options)
+                return "arrow ndjson (cached schema)"
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                print(
+                    f"ℹ️ Cached JSON schema does not fit {src_path} ({e}); re-inferring"
+                )
+        try:
+            schema = infer_ndjson_schema(src_path, block_size)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            print(f"ℹ️ NDJSON field types vary in {src_path} ({e}); using DuckDB")
+        else:
+            with open_ndjson(src_path, schema, block_size) as reader:
+                write_json_batches(reader, out_path, row_group_rows, write_options)
+            if schema_key:
+                manifest_store.set_cached_schema(
+                    *schema_key, "json", schema.serialize().to_pybytes()
+                )
+            return "arrow ndjson"
+
+    codec = resolver.compression_of(src_path)
+    if codec not in DUCKDB_COMPRESSIONS:
+        raise ValueError(
+            f"JSON {layout} in {src_path} needs DuckDB, which cannot read {codec} files; "
+            f"send it uncompressed, .gz or .zst"
+        )
+    fmt = "array" if layout == "array" else "newline_delimited"
+    dconn = duckdb.connect(database=":memory:")
+    try:
+        if threads:
+            dconn.execute(f"SET threads = {int(threads)}")
+        if memory_limit:
+            dconn.execute(
+                f"SET memory_limit = '{quote_path_literal(str(memory_limit))}'"
+            )
+        src_sql = quote_path_literal(os.path.abspath(src_path))
+        reader = dconn.execute(
+            f"SELECT * FROM read_json('{src_sql}', format = '{fmt}')"
+        ).to_arrow_reader(row_group_rows)
+        write_json_batches(reader, out_path, row_group_rows, write_options)
+        return f"duckdb {layout}"
+    finally:
+        dconn.close()
+
+
+def xlsx_column(values):
+    """Arrow array for one block column; mixed cell types fall back to text."""
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if v is None else str(v) for v in values], pa.string())
+
+
+def xlsx_column_type(types, nulls, text):
+    """Final type of a sheet column from the types of its blocks (pandas-like)."""
+    types = {t for t in types if not pa.types.is_null(t)}
+    if not types:
+        return pa.float64()  # all NaN
+    if all(pa.types.is_integer(t) for t in types):
+        return pa.float64() if nulls else pa.int64()
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64()
+    if all(pa.types.is_timestamp(t) for t in types):
+        return pa.timestamp("us")
+    if len(types) == 1:
+        typ = types.pop()
+        if not (pa.types.is_string(typ) or pa.types.is_large_string(typ)):
+            return typ  # bool, time, ...
+    return text
+
+
+def convert_xlsx_streaming(
+    src_path,
+    out_path,
+    sheet=0,
+    row_group_rows=DEFAULT_ROW_GROUP_ROWS,
+    block_rows=DEFAULT_XLSX_BLOCK_ROWS,
+    write_options=None,
+):
+    """
+    One sheet (name or index) -> Parquet without loading the workbook: rows
+    come from openpyxl read_only mode and every block_rows rows are spooled
+    as a small Parquet part; the parts are then cast to the sheet's final
+    types and written as row groups. Header is the first row; trailing empty
+    rows and cells beyond the header are ignored. Returns row count.
+    """
+    wb = openpyxl.load_workbook(
+        src_path, read_only=True, data_only=True, keep_links=False
+    )
+    parts_dir = tempfile.mkdtemp(prefix=".tmp_xlsx_", dir=os.path.dirname(out_path))
+    try:
+        ws = wb[sheet] if isinstance(sheet, str) else wb.worksheets[int(sheet)]
+        ws.reset_dimensions()  # some writers store a wrong sheet size
+        rows_iter = ws.iter_rows(values_only=True)
+        header = list(next(rows_iter, None) or ())
+        while header and header[-1] is None:
+            header.pop()
+        names = pandas_column_names([None if h is None else str(h) for h in header])
+        width = len(names)
+
+        parts, types, nulls = [], [set() for _ in names], [False] * width
+        block, empty = [], 0
+
+        def spool():
+            columns = [xlsx_column(list(c)) for c in zip(*block)]
+            for i, col in enumerate(columns):
+                types[i].add(col.type)
+                nulls[i] = nulls[i] or col.null_count > 0
+            path = os.path.join(parts_dir, f"{len(parts):06d}.parquet")
+            pq.write_table(pa.table(columns, names=names), path)
+            parts.append(path)
+            block.clear()
+
+        for row in rows_iter:
+            row = tuple(row[:width]) + (None,) * (width - len(row))
+            if all(v is None for v in row):
+                empty += 1  # kept only if data follows
+                continue
+            block.extend([(None,) * width] * empty)
+            empty = 0
+            block.append(row)
+            if len(block) >= block_rows:
+                spool()
+        if block:
+            spool()
+
+        text = pandas_string_type()
+        schema = pa.schema(
+            pa.field(n, xlsx_column_type(types[i], nulls[i], text) if parts else text)
+            for i, n in enumerate(names)
+        )
+
+        def cast_parts():
+            for path in parts:
+                table = pq.read_table(path)
+                columns = [pc.cast(c, f.type) for c, f in zip(table.columns, schema)]
+                yield from pa.table(columns, schema=schema).to_batches()
+
+        with pq.ParquetWriter(
+            out_path, schema, **(write_options or DEFAULT_WRITE_OPTIONS)
+        ) as writer:
+            return write_row_groups(writer, cast_parts(), schema, row_group_rows)
+    finally:
+        wb.close()
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+
+def split_workbook(src_path, sheets, out_dir, options=None):
+    """
+    Convert several sheets of one workbook in parallel (one process per
+    sheet). sheets maps sheet name -> logical_source_file; each sheet is
+    written to <out_dir>/<logical_source_file>.parquet with the workbook's
+    codec, level, dictionary columns and row group size (sort_by is left to
+    the sheet's own parquet config). Returns {sheet: parquet path}; raises
+    when a sheet is missing or fails.
+    """
+    options = dict(convert_options(), **(options or {}))
+    write_options = parquet_write_options(options)
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = {}
+    for sheet, logical in sheets.items():
+        dest = os.path.join(out_dir, f"{logical}.parquet")
+        tmp = os.path.join(out_dir, f".tmp_{uuid.uuid4().hex}.parquet")
+        jobs[sheet] = (dest, tmp)
+    try:
+        workers = min(len(jobs), options["sheet_workers"] or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max(workers, 1)) as pool:
+            futures = {
+                sheet: pool.submit(
+                    convert_xlsx_streaming,
+                    src_path,
+                    tmp,
+                    sheet,
+                    options["row_group_rows"],
+                    write_options=write_options,
+                )
+                for sheet, (_, tmp) in jobs.items()
+            }
+            for sheet, fut in futures.items():
+                try:
+                    fut.result()
+                except Exception as e:
+                    raise RuntimeError(f"sheet '{sheet}': {e}") from e
+        for dest, tmp in jobs.values():
+            os.replace(tmp, dest)
+        return {sheet: dest for sheet, (dest, _) in jobs.items()}
+    finally:
+        for _, tmp in jobs.values():
+            try:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            except Exception:
+                pass
+
+
+def reuse_parquet(parquet_path, dest_path):
+    """Place an existing parquet at dest_path (clone_file); returns the method."""
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    tmp_path = os.path.join(
+        os.path.dirname(dest_path), f".tmp_{uuid.uuid4().hex}.parquet"
+    )
+    try:
+        method = clone_file(parquet_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+        return method
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_to_pandas(src_path, src_type, sheet=0):
     # read input into pandas DataFrame
     if src_type == "csv":
-        df = pd.read_csv(src_path, low_memory=False)
-    elif src_type in ("xlsx", "xls", "excel"):
-        df = pd.read_excel(src_path, sheet_name=0)
+        with open_source(src_path) as fh:
+            return pd.read_csv(fh, low_memory=False)
+    elif src_type in EXCEL_TYPES:
+        return pd.read_excel(src_path, sheet_name=sheet)
     elif src_type == "json":
-        try:
-            df = pd.read_json(src_path, lines=True)
-        except ValueError:
-            df = pd.read_json(src_path)
+        lines = json_layout(src_path) == "ndjson"
+        with open_source(src_path) as fh:
+            return pd.read_json(fh, lines=lines)
     elif src_type == "parquet":
-        df = pd.read_parquet(src_path)
+        return pd.read_parquet(src_path)
     else:
         raise Exception(f"Unsupported source type for convert: {src_type}")
 
+
+def convert_to_parquet(src_path, dest_path, src_type, options=None):
+    """Write src_path as Parquet at dest_path; returns how (engine, hardlink, ...)."""
+    options = dict(convert_options(), **(options or {}))
     os.makedirs(os.path.dirname(dest_path), exist_ok=True)
     tmp_name = f".tmp_{uuid.uuid4().hex}.parquet"
     tmp_path = os.path.join(os.path.dirname(dest_path), tmp_name)
+    sort_by = options["sort_by"]
+    # with sort_by the converters write an unsorted snappy file first
+    out_path = (
+        os.path.join(os.path.dirname(dest_path), f".tmp_{uuid.uuid4().hex}.parquet")
+        if sort_by
+        else tmp_path
+    )
+    write_options = DEFAULT_WRITE_OPTIONS if sort_by else parquet_write_options(options)
+    engine = options["engine"]
+    codec = resolver.compression_of(src_path)
+    if codec and src_type not in ("csv", "json"):
+        raise ValueError(
+            f"Compressed {src_type} sources are not supported ({codec}); only csv and json"
+        )
+    if engine == "duckdb" and codec not in DUCKDB_COMPRESSIONS:
+        engine = "arrow"  # DuckDB cannot decompress it, the arrow readers stream it
+    method = engine
     try:
-        df.to_parquet(tmp_path, engine="pyarrow", compression="snappy", index=False)
+        plan, reason = None, None
+        layout = json_layout(src_path) if src_type == "json" else None
+        if src_type == "parquet":
+            plan, reason = parquet_passthrough_check(
+                src_path, options["passthrough_codecs"]
+            )
+            if plan == "passthrough" and (
+                sort_by or options["dictionary_columns"] is not None
+            ):
+                plan, reason = "reencode", "layout policy"
+        if plan == "passthrough":
+            method = clone_file(src_path, tmp_path)
+        elif plan == "reencode" and sort_by:
+            out_path = src_path  # the sort pass below rewrites it
+            method = f"re-encode ({reason})"
+        elif plan == "reencode":
+            reencode_parquet(
+                src_path, out_path, options["row_group_rows"], write_options
+            )
+            method = f"re-encode ({reason})"
+        elif src_type == "csv" and options.get("pinned_types"):
+            convert_csv_streaming(
+                src_path,
+                out_path,
+                options["block_size_mb"],
+                options["row_group_rows"],
+                options["pinned_types"],
+                options["null_values"],
+                options["date_formats"],
+                write_options,
+            )
+            method = "arrow (pinned schema)"
+        elif src_type == "csv" and engine == "arrow":
+            convert_csv_streaming(
+                src_path,
+                out_path,
+                options["block_size_mb"],
+                options["row_group_rows"],
+                write_options=write_options,
+            )
+        elif (
+            src_type in ("xlsx", "excel") and resolver.source_type_of(src_path) != "xls"
+        ):
+            # every engine: pd.read_excel would hold the whole sheet in memory
+            convert_xlsx_streaming(
+                src_path,
+                out_path,
+                options["sheet"],
+                options["row_group_rows"],
+                write_options=write_options,
+            )
+            method = "openpyxl streaming"
+        elif engine == "arrow" and (
+            # JSON arrays are streamed by DuckDB, which needs a codec it reads
+            layout == "ndjson"
+            or (layout == "array" and codec in DUCKDB_COMPRESSIONS)
+        ):
+            method = convert_json_streaming(
+                src_path,
+                out_path,
+                layout,
+                options["block_size_mb"],
+                options["row_group_rows"],
+                options.get("schema_key"),
+                options["threads"],
+                options["memory_limit"],
+                write_options,
+            )
+        elif src_type in ("csv", "json") and engine == "duckdb":
+            convert_with_duckdb(
+                src_path,
+                out_path,
+                src_type,
+                options["threads"],
+                options["memory_limit"],
+                options["row_group_rows"],
+                options["sample_size"],
+                write_options["compression"],
+                write_options.get("compression_level"),
+            )
+        else:
+            read_to_pandas(src_path, src_type, options["sheet"]).to_parquet(
+                out_path,
+                engine="pyarrow",
+                index=False,
+                row_group_size=options["row_group_rows"],
+                **write_options,
+            )
+            method = "pandas" if not reason else f"pandas ({reason})"
+        if sort_by:
+            sort_parquet(
+                out_path,
+                tmp_path,
+                sort_by,
+                options["row_group_rows"],
+                parquet_write_options(options),
+                options["threads"],
+                options["memory_limit"],
+            )
+            method = f"{method}, sorted by {', '.join(sort_by)}"
         os.replace(tmp_path, dest_path)
+        return method
     finally:
-        try:
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
-        except Exception:
-            pass
+        for path in {tmp_path, out_path} - {src_path}:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except Exception:
+                pass
 
 
 # -----------------------------
-# Main flow
+# Stage API
 # -----------------------------
-def main():
-    if len(sys.argv) != 3:
-        print(
-            "Usage: python convert_to_parquet.py <client_schema> <physical_file_name>"
-        )
-        sys.exit(2)
+def stage_result(status, physical_file_name, error=None, **extra):
+    """
+    Structured result returned by run_convert (shared shape with the other stages):
+    stage, status (SUCCESS | FAILED), physical_file_name, parquet_name, parquet_path,
+    total_rows and error.
+    """
+    result = {
+        "stage": "convert_to_parquet",
+        "status": status,
+        "physical_file_name": physical_file_name,
+        "parquet_name": None,
+        "parquet_path": None,
+        "total_rows": None,
+        "error": error,
+    }
+    result.update(extra)
+    return result
 
-    client_schema = sys.argv[1]
-    physical_file_name = sys.argv[2]
+
+def run_convert(client_schema, physical_file_name):
+    """
+    Convert raw/<client>/<ss>/success/<physical_file_name> to Parquet under
+    data/<client>/<ss>/incoming and record parquet_name in batch_info.
+    Never raises for expected failures; returns stage_result(...) instead.
+    """
     start_time = datetime.now()
     job_name = "Convert to Parquet"
 
     batch_id = extract_batch_id(physical_file_name)
     if not batch_id:
-        print(f"❌ Cannot extract batch_id from file name: {physical_file_name}")
-        sys.exit(1)
+        msg = f"Cannot extract batch_id from file name: {physical_file_name}"
+        print(f"❌ {msg}")
+        return stage_result("FAILED", physical_file_name, msg)
 
     batch_info_path = os.path.join(
         "batch_info",
@@ -234,36 +1346,31 @@ def main():
         "incoming",
         f"batch_output_{client_schema}_{batch_id}.json",
     )
-    if not os.path.exists(batch_info_path):
-        print(f"❌ Batch info not found: {batch_info_path}")
-        sys.exit(1)
-
     try:
-        batch_info = read_json_retry(batch_info_path)
+        batch_info, file_entry = manifest_store.load_file_entry(
+            client_schema, batch_id, physical_file_name, batch_info_path, tolerant=True
+        )
     except Exception as e:
-        print(f"❌ Failed to parse batch_info {batch_info_path}: {e}")
-        sys.exit(1)
+        msg = f"Failed to load batch_info {batch_info_path}: {e}"
+        print(f"❌ {msg}")
+        return stage_result("FAILED", physical_file_name, msg)
 
-    if not isinstance(batch_info, dict):
-        batch_info = {
-            "client_schema": client_schema,
-            "client_id": None,
-            "batch_id": batch_id,
-            "files": [],
-        }
+    if batch_info is None:
+        msg = f"Batch info not found: {batch_info_path}"
+        print(f"❌ {msg}")
+        return stage_result("FAILED", physical_file_name, msg)
 
     client_id = batch_info.get("client_id")
     if client_id is None:
-        print(f"❌ client_id not found in batch_info {batch_info_path}")
-        sys.exit(1)
+        msg = f"client_id not found in batch_info {batch_info_path}"
+        print(f"❌ {msg}")
+        return stage_result("FAILED", physical_file_name, msg)
 
-    file_entry = find_file_entry(batch_info, physical_file_name)
     if not file_entry:
-        # don't exit immediately: allow convert to continue but warn
+        # don't exit immediately: source_system/source_type check below decides
         print(
-            f"⚠️ File {physical_file_name} not explicitly found inside batch_info {batch_info_path}. Will try tolerant matching."
+            f"⚠️ File {physical_file_name} not found inside batch_info {batch_info_path}, even with tolerant matching."
         )
-        # continue, but logical may be None
         logical = None
         source_system = None
         source_type = None
@@ -272,25 +1379,14 @@ def main():
         source_system = (file_entry.get("source_system") or "").lower()
         source_type = (file_entry.get("source_type") or "").lower()
 
-    # If missing source_system/source_type from exact entry, try to infer from batch_info entries
-    if not source_system or not source_type:
-        # try a tolerant lookup
-        for f in batch_info.get("files") or []:
-            if (
-                str(f.get("physical_file_name", "")).lower()
-                == str(physical_file_name).lower()
-            ):
-                source_system = (f.get("source_system") or "").lower()
-                source_type = (f.get("source_type") or "").lower()
-                logical = logical or f.get("logical_source_file")
-                break
+    file_audit_id = (file_entry or {}).get("file_audit_id")
+    file_received_time = (file_entry or {}).get("file_received_time")
 
     # final validation of inferred values
     if not source_system or not source_type:
-        print(
-            f"❌ Unable to determine source_system/source_type for {physical_file_name}"
-        )
-        sys.exit(1)
+        msg = f"Unable to determine source_system/source_type for {physical_file_name}"
+        print(f"❌ {msg}")
+        return stage_result("FAILED", physical_file_name, msg)
 
     src_path = os.path.join(
         "raw", client_schema, source_system, "success", physical_file_name
@@ -298,25 +1394,19 @@ def main():
     if not os.path.exists(src_path):
         msg = f"Source file not found at expected location: {src_path}"
         print(f"❌ {msg}")
-        try:
-            conn = get_connection()
-            insert_job_execution_log(
-                conn,
-                client_id,
-                job_name,
-                "FAILED",
-                msg,
-                physical_file_name,
-                batch_id,
-                start_time,
-                datetime.now(),
-            )
-            conn.close()
-        except Exception:
-            pass
-        sys.exit(1)
+        insert_job_execution_log(
+            client_id,
+            job_name,
+            "FAILED",
+            msg,
+            physical_file_name,
+            batch_id,
+            start_time,
+            datetime.now(),
+        )
+        return stage_result("FAILED", physical_file_name, msg)
 
-    base = os.path.splitext(physical_file_name)[0]
+    base = resolver.split_ext(physical_file_name)[0]
     if logical:
         parquet_base = logical
     else:
@@ -327,189 +1417,147 @@ def main():
         "data", client_schema, source_system, "incoming", parquet_name
     )
 
-    conn = None
     try:
-        conn = get_connection()
-    except Exception as e:
-        print(f"❌ DB connection failed: {e}")
-        sys.exit(1)
-
-    try:
-        convert_to_parquet(src_path, dest_path, source_type)
+        options = convert_options((file_entry or {}).get("source_config"))
+        if logical:
+            # JSON schema cache key (see convert_json_streaming)
+            options["schema_key"] = (client_schema, source_system, logical)
+        reuse = (file_entry or {}).get("reuse_parquet")
+        if reuse and os.path.exists(reuse):
+            # same content as an already loaded file (dedup_policy reuse)
+            method = (
+                f"reuse {reuse_parquet(reuse, dest_path)} {os.path.basename(reuse)}"
+            )
+        else:
+            if source_type == "csv" and options["pin_schema"] and file_entry:
+                options["pinned_types"] = pinned_column_types(
+                    client_schema, client_id, file_entry
+                )
+            method = convert_to_parquet(src_path, dest_path, source_type, options)
+        # what was actually written (passthrough/reuse keep the source layout)
+        layout = parquet_layout(dest_path)
+        written = not method.startswith("reuse") and method not in (
+            "hardlink",
+            "reflink",
+            "copy",
+        )
+        if written and options["compression_level"] not in (None, ""):
+            layout["compression_level"] = int(options["compression_level"])
     except Exception as e:
         err = str(e)
         print(f"❌ Conversion FAILED for {physical_file_name}: {err}")
         traceback.print_exc()
-        try:
-            affected = update_file_audit_convert_status(
-                conn,
-                client_id,
-                physical_file_name,
-                source_system,
-                source_type,
-                logical,
-                batch_id,
-                "FAILED",
-            )
-            if affected == 0:
-                print(
-                    "⚠️ Warning: file_audit_log update affected 0 rows (no exact match)."
-                )
-        except Exception as e2:
-            print(f"⚠️ Failed to update file_audit_log: {e2}")
-        try:
-            insert_job_execution_log(
-                conn,
-                client_id,
-                job_name,
-                "FAILED",
-                err,
-                physical_file_name,
-                batch_id,
-                start_time,
-                datetime.now(),
-            )
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
-        sys.exit(1)
-
-    # success update DB audit
-    try:
-        affected = update_file_audit_convert_status(
-            conn,
+        update_file_audit_convert_status(
             client_id,
             physical_file_name,
             source_system,
             source_type,
             logical,
             batch_id,
-            "SUCCESS",
+            "FAILED",
+            file_audit_id=file_audit_id,
+            file_received_time=file_received_time,
         )
-        if affected == 0:
-            print("⚠️ Warning: file_audit_log update affected 0 rows (no exact match).")
-    except Exception as e:
-        print(f"⚠️ Failed to update file_audit_log: {e}")
-
-    # robust update batch_info with retries and tolerant matching
-    max_attempts = 6
-    sleep_backoff = 0.12
-    write_ok = False
-    for attempt in range(max_attempts):
-        try:
-            current = read_json_retry(batch_info_path)
-        except Exception:
-            current = {
-                "client_schema": client_schema,
-                "client_id": client_id,
-                "batch_id": batch_id,
-                "files": [],
-            }
-
-        if not isinstance(current, dict):
-            current = {
-                "client_schema": client_schema,
-                "client_id": client_id,
-                "batch_id": batch_id,
-                "files": [],
-            }
+        insert_job_execution_log(
+            client_id,
+            job_name,
+            "FAILED",
+            err,
+            physical_file_name,
+            batch_id,
+            start_time,
+            datetime.now(),
+        )
+        return stage_result("FAILED", physical_file_name, err)
 
-        files = current.setdefault("files", [])
-        target_lower = (physical_file_name or "").lower()
-        logical_lower = (logical or "").lower()
-        base_target = _normalize_name_for_match(physical_file_name)
-        updated = False
-
-        # 1) try exact (case-insensitive) match
-        for f in files:
-            if str(f.get("physical_file_name", "")).lower() == target_lower:
-                f["parquet_name"] = parquet_name
-                updated = True
-                break
-
-        # 2) try matching by logical_source_file (case-insensitive)
-        if not updated and logical_lower:
-            for f in files:
-                if str(f.get("logical_source_file", "")).lower() == logical_lower:
-                    f["parquet_name"] = parquet_name
-                    updated = True
-                    break
-
-        # 3) try matching by base name without BATCH suffix
-        if not updated:
-            for f in files:
-                f_base = _normalize_name_for_match(str(f.get("physical_file_name", "")))
-                if f_base and f_base == base_target:
-                    f["parquet_name"] = parquet_name
-                    updated = True
-                    break
-
-        # 4) if still not found, append a merged / informative entry
-        if not updated:
-            files.append(
-                {
-                    "physical_file_name": physical_file_name,
-                    "logical_source_file": logical,
-                    "source_system": source_system,
-                    "source_type": source_type,
-                    "parquet_name": parquet_name,
-                }
-            )
+    # success update DB audit
+    update_file_audit_convert_status(
+        client_id,
+        physical_file_name,
+        source_system,
+        source_type,
+        logical,
+        batch_id,
+        "SUCCESS",
+        file_audit_id=file_audit_id,
+        file_received_time=file_received_time,
+    )
 
-        # attempt to write; if concurrent writer wins, retry
-        try:
-            write_json_atomic(batch_info_path, current)
-            write_ok = True
-            break
-        except Exception:
-            time.sleep(sleep_backoff)
-            sleep_backoff *= 1.3
-            continue
+    # per-entry upsert in the manifest store (tolerant matching lives there);
+    # no full batch_info rewrite, so concurrent converts cannot lose updates
+    write_ok = False
+    try:
+        manifest_store.set_parquet_name(
+            client_schema,
+            batch_id,
+            physical_file_name,
+            parquet_name,
+            logical_source_file=logical,
+            source_system=source_system,
+            source_type=source_type,
+            extra={"parquet_layout": layout},
+        )
+        write_ok = True
+    except Exception as e:
+        print(f"⚠️ manifest store error: {e}")
 
+    warn_msg = None
     if not write_ok:
-        warn_msg = f"Failed to write batch_info after {max_attempts} attempts for {physical_file_name}"
+        warn_msg = (
+            f"Failed to record parquet_name in batch_info for {physical_file_name}"
+        )
         print(f"⚠️ {warn_msg}")
-        try:
-            insert_job_execution_log(
-                conn,
-                client_id,
-                job_name,
-                "WARNING",
-                warn_msg,
-                parquet_name,
-                batch_id,
-                start_time,
-                datetime.now(),
-            )
-        except Exception:
-            pass
+        insert_job_execution_log(
+            client_id,
+            job_name,
+            "WARNING",
+            warn_msg,
+            parquet_name,
+            batch_id,
+            start_time,
+            datetime.now(),
+        )
     else:
         # success log
-        try:
-            insert_job_execution_log(
-                conn,
-                client_id,
-                job_name,
-                "SUCCESS",
-                None,
-                parquet_name,
-                batch_id,
-                start_time,
-                datetime.now(),
-            )
-        except Exception:
-            pass
-        print(f"✅ Converted {physical_file_name} -> {dest_path}")
+        insert_job_execution_log(
+            client_id,
+            job_name,
+            "SUCCESS",
+            None,
+            parquet_name,
+            batch_id,
+            start_time,
+            datetime.now(),
+        )
+        print(f"✅ Converted {physical_file_name} -> {dest_path} ({method})")
+
+    return stage_result(
+        "SUCCESS",
+        physical_file_name,
+        warn_msg,
+        parquet_name=parquet_name,
+        parquet_path=dest_path,
+        batch_info_written=write_ok,
+    )
 
-    try:
-        conn.close()
-    except Exception:
-        pass
 
-    sys.exit(0)
+# -----------------------------
+# Main flow
+# -----------------------------
+def main():
+    if len(sys.argv) != 3:
+        print(
+            "Usage: python convert_to_parquet.py <client_schema> <physical_file_name>"
+        )
+        sys.exit(2)
+
+    client_schema, physical_file_name = sys.argv[1], sys.argv[2]
+    result = run_convert(client_schema, physical_file_name)
+    # standalone run: publish the updated manifest for the next CLI stage
+    batch_id = extract_batch_id(physical_file_name)
+    if batch_id and result.get("batch_info_written"):
+        manifest_store.export_json(client_schema, batch_id)
+    sys.exit(0 if result["status"] == "SUCCESS" else 1)
 
 
 if __name__ == "__main__":
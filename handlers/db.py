@@ -0,0 +1,209 @@
+import os
+import time
+import atexit
+import threading
+import weakref
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# -----------------------------
+# DB config via dotenv
+# -----------------------------
+DB_PORT = os.getenv("DB_PORT")
+if DB_PORT is None:
+    raise ValueError("DB_PORT not set in .env")
+
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST"),
+    "port": int(DB_PORT),
+    "dbname": os.getenv("DB_NAME"),
+    "user": os.getenv("DB_USER"),
+    "password": os.getenv("DB_PASSWORD"),
+}
+
+# -----------------------------
+# Connection pools (shared by every stage)
+# -----------------------------
+# One pool per stage ("batch", "convert", "validate", "load", "silver", "gold",
+# "mv") and per process: client worker processes are forked, and a libpq socket
+# must never be used from two processes. get_connection() blocks while the
+# stage pool is exhausted, which also caps how many connections a busy stage
+# can take from the server. release() returns a connection after rolling back
+# any open transaction and resetting autocommit. A connection idle for longer
+# than DB_POOL_CHECK_IDLE seconds is probed with SELECT 1 before reuse and
+# replaced if the server dropped it.
+#
+# Pool size per stage: env DB_POOL_<STAGE> (e.g. DB_POOL_LOAD=2), else the
+# size set with configure(), else DB_POOL_SIZE (default 4). A thread may hold
+# two connections of one stage (run_procedure next to the log connection), so
+# keep every pool at 2 or more.
+
+DEFAULT_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+HEALTH_CHECK_IDLE_SECONDS = float(os.getenv("DB_POOL_CHECK_IDLE", "30"))
+POOL_WAIT_SECONDS = float(os.getenv("DB_POOL_WAIT", "60"))
+
+_lock = threading.Lock()
+_pools = {}  # (pid, stage) -> pool dict
+_sizes = {}  # stage -> size requested via configure()
+_checked_out = {}  # id(conn) -> (pool, weakref.finalize)
+
+
+def pool_size(stage):
+    env = os.getenv(f"DB_POOL_{stage.upper()}")
+    return max(1, int(env or _sizes.get(stage) or DEFAULT_POOL_SIZE))
+
+
+def configure(stage, size):
+    """
+    Request a pool size for stage (ignored when DB_POOL_<STAGE> is set). An
+    existing pool only grows.
+    """
+    with _lock:
+        _sizes[stage] = max(_sizes.get(stage) or 0, int(size))
+        pool = _pools.get((os.getpid(), stage))
+    if pool is not None:
+        _grow(pool, pool_size(stage))
+
+
+def _grow(pool, size):
+    with _lock:
+        extra = size - pool["size"]
+        if extra <= 0:
+            return
+        pool["size"] = size
+    for _ in range(extra):
+        pool["slots"].release()
+
+
+def _get_pool(stage):
+    key = (os.getpid(), stage)
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None:
+            size = pool_size(stage)
+            pool = {
+                "stage": stage,
+                "size": size,
+                "slots": threading.Semaphore(size),
+                "idle": deque(),  # (conn, returned_at)
+            }
+            _pools[key] = pool
+    return pool
+
+
+def _connect():
+    missing = [k for k, v in DB_CONFIG.items() if v in (None, "")]
+    if missing:
+        raise ValueError(f"Missing DB config values: {missing}")
+    return psycopg2.connect(**DB_CONFIG)
+
+
+def _discard(conn):
+    try:
+        if not conn.closed:
+            conn.close()
+    except Exception:
+        pass
+
+
+def is_healthy(conn):
+    """Cheap liveness probe; leaves the connection idle."""
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
+def get_connection(stage="batch"):
+    """
+    Check out a psycopg2 connection from the stage pool. Give it back with
+    release(conn) (not conn.close()).
+    """
+    pool = _get_pool(stage)
+    if not pool["slots"].acquire(timeout=POOL_WAIT_SECONDS):
+        raise PoolError(
+            f"DB pool '{stage}' habis ({pool['size']} koneksi) setelah {POOL_WAIT_SECONDS}s"
+        )
+    try:
+        conn = None
+        while conn is None:
+            with _lock:
+                item = pool["idle"].pop() if pool["idle"] else None
+            if item is None:
+                conn = _connect()
+                continue
+            candidate, returned_at = item
+            fresh = time.monotonic() - returned_at < HEALTH_CHECK_IDLE_SECONDS
+            if (fresh and not candidate.closed) or is_healthy(candidate):
+                conn = candidate
+            else:
+                _discard(candidate)
+    except Exception:
+        pool["slots"].release()
+        raise
+    # a connection dropped without release() (error path) still frees its slot
+    finalizer = weakref.finalize(conn, pool["slots"].release)
+    with _lock:
+        _checked_out[id(conn)] = (pool, finalizer)
+    return conn
+
+
+def release(conn):
+    """Return conn to its pool. Safe to call twice and with None."""
+    if conn is None:
+        return
+    with _lock:
+        entry = _checked_out.pop(id(conn), None)
+    if entry is None:
+        return
+    pool, finalizer = entry
+    finalizer.detach()
+
+    reusable = not conn.closed and pool is _pools.get((os.getpid(), pool["stage"]))
+    if reusable:
+        try:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                reusable = False
+            else:
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+        except Exception:
+            reusable = False
+
+    if reusable:
+        with _lock:
+            pool["idle"].append((conn, time.monotonic()))
+    else:
+        _discard(conn)
+    pool["slots"].release()
+
+
+def close_all():
+    """Close idle connections of this process's pools (checked-out ones are left alone)."""
+    pid = os.getpid()
+    with _lock:
+        pools = [p for (p_pid, _), p in _pools.items() if p_pid == pid]
+    for pool in pools:
+        while True:
+            with _lock:
+                item = pool["idle"].pop() if pool["idle"] else None
+            if item is None:
+                break
+            _discard(item[0])
+
+
+atexit.register(close_all)
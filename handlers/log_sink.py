@@ -0,0 +1,416 @@
+import os
+import json
+import atexit
+import threading
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError
+
+import db
+
+# -----------------------------
+# Log sink (buffered audit/log writes)
+# -----------------------------
+# Stage helpers used to run one INSERT/UPDATE plus its own commit per log
+# record (6-10 commits per file just for logging). They now call record() /
+# update_file_audit(), which only append to an in-memory buffer; flush()
+# writes everything with execute_values and a single commit: when a stage of a
+# file ends (batch_processing.run_stage), when a silver/gold/MV stage ends, at
+# batch end and at exit. Records of files running in parallel share one flush,
+# and file_audit_log status updates are coalesced per file into one row of an
+# UPDATE ... FROM (VALUES ...). They target the audit row by file_audit_id
+# plus file_received_time (both stored in the manifest entry at intake; the
+# pair is the PK of the partitioned table, so the probe hits one partition).
+# file_audit_id alone still works for entries without the time, and the old
+# multi-column match is only used when the id is unknown (stage run
+# standalone, older manifests).
+#
+# When the DB cannot be reached the pending records are appended to a local
+# JSON-lines spool (env LOG_SINK_SPOOL) and replayed by the next flush that
+# succeeds, in any process. Buffers belong to one process: a forked worker
+# starts with empty buffers. A buffer that reaches LOG_SINK_MAX_ROWS records
+# is flushed by the record() call that filled it. A record the DB rejects
+# (e.g. a value too long for its column) is printed and dropped, so it cannot
+# block the rest of the buffer or the spool.
+
+SPOOL_PATH = os.getenv("LOG_SINK_SPOOL", os.path.join("logs", "log_sink_spool.jsonl"))
+MAX_ROWS = int(os.getenv("LOG_SINK_MAX_ROWS", "1000"))
+
+# insertable tables (schema tools) and their columns
+TABLE_COLUMNS = {
+    "job_execution_log": (
+        "client_id",
+        "job_name",
+        "status",
+        "error_message",
+        "file_name",
+        "batch_id",
+        "start_time",
+        "end_time",
+    ),
+    "mapping_validation_log": (
+        "client_id",
+        "missing_columns",
+        "extra_columns",
+        "expected_columns",
+        "received_columns",
+        "file_name",
+        "batch_id",
+        "timestamp",
+    ),
+    "row_validation_log": (
+        "client_id",
+        "file_name",
+        "column_name",
+        "error_type",
+        "error_detail",
+        "batch_id",
+        "timestamp",
+    ),
+    "load_error_log": (
+        "client_id",
+        "error_detail",
+        "stage",
+        "file_name",
+        "batch_id",
+        "timestamp",
+    ),
+    "file_audit_log": (
+        "convert_status",
+        "mapping_validation_status",
+        "row_validation_status",
+        "load_status",
+        "total_rows",
+        "valid_rows",
+        "invalid_rows",
+        "processed_by",
+        "logical_source_file",
+        "physical_file_name",
+        "batch_id",
+        "file_received_time",
+        "source_type",
+        "source_system",
+        "config_validation_status",
+        "client_id",
+    ),
+}
+
+# columns added by optional migrations: written only when a buffered row of
+# the flush sets them (content_hash: sql/tools/file_audit_content_hash.sql)
+OPTIONAL_COLUMNS = {"file_audit_log": ("content_hash",)}
+
+# time columns filled with the record time (not the flush time) when missing;
+# they are NOT NULL partition keys once sql/tools/log_partitioning.sql ran
+RECORD_TIME_COLUMNS = {
+    "job_execution_log": "start_time",
+    "mapping_validation_log": "timestamp",
+    "row_validation_log": "timestamp",
+    "load_error_log": "timestamp",
+    "file_audit_log": "file_received_time",
+}
+
+# file_audit_log rows without a known file_audit_id are matched on these columns
+AUDIT_KEY = (
+    "client_id",
+    "physical_file_name",
+    "source_system",
+    "source_type",
+    "logical_source_file",
+    "batch_id",
+)
+AUDIT_SET_COLUMNS = (
+    "convert_status",
+    "mapping_validation_status",
+    "row_validation_status",
+    "load_status",
+    "total_rows",
+)
+
+_lock = threading.Lock()  # buffers
+_flush_lock = threading.Lock()  # one writer (and spool user) per process
+_state = {"pid": None, "inserts": {}, "updates": {}, "count": 0}
+
+
+def _buffers():
+    """Current process's buffers (call with _lock held)."""
+    pid = os.getpid()
+    if _state["pid"] != pid:
+        _state.update(pid=pid, inserts={}, updates={}, count=0)
+    return _state
+
+
+def _take():
+    with _lock:
+        state = _buffers()
+        inserts, updates = state["inserts"], state["updates"]
+        state.update(inserts={}, updates={}, count=0)
+    return inserts, updates
+
+
+def _add(inserts, updates, other_inserts, other_updates):
+    for table, rows in other_inserts.items():
+        inserts.setdefault(table, []).extend(rows)
+    for key, values in other_updates.items():
+        updates.setdefault(key, {}).update(values)
+
+
+def record(table, row):
+    """Buffer one INSERT into tools.<table>; row maps column -> value."""
+    if table not in TABLE_COLUMNS:
+        raise ValueError(f"log_sink: unknown table {table}")
+    row = dict(row)
+    time_column = RECORD_TIME_COLUMNS.get(table)
+    if time_column and row.get(time_column) is None:
+        row[time_column] = datetime.now()
+    with _lock:
+        state = _buffers()
+        state["inserts"].setdefault(table, []).append(row)
+        state["count"] += 1
+        full = state["count"] >= MAX_ROWS
+    if full:
+        flush()
+
+
+def update_file_audit(
+    client_id,
+    physical_file_name,
+    source_system,
+    source_type,
+    logical_source_file,
+    batch_id,
+    file_audit_id=None,
+    file_received_time=None,
+    **values,
+):
+    """
+    Buffer a tools.file_audit_log update (values: AUDIT_SET_COLUMNS) for the
+    row with file_audit_id (and file_received_time, when known), or, when the
+    id is None, the row(s) matching the AUDIT_KEY columns. Updates of one file
+    are merged, the last value per column wins.
+    """
+    unknown = set(values) - set(AUDIT_SET_COLUMNS)
+    if unknown:
+        raise ValueError(f"log_sink: unknown file_audit_log columns {sorted(unknown)}")
+    if file_audit_id is not None and file_received_time is not None:
+        k = (int(file_audit_id), str(file_received_time))
+    elif file_audit_id is not None:
+        k = (int(file_audit_id),)
+    else:
+        k = (
+            client_id,
+            physical_file_name,
+            source_system,
+            source_type,
+            logical_source_file,
+            batch_id,
+        )
+    with _lock:
+        state = _buffers()
+        pending = state["updates"].setdefault(k, {})
+        if not pending:
+            state["count"] += 1
+        pending.update(values)
+        full = state["count"] >= MAX_ROWS
+    if full:
+        flush()
+
+
+# -----------------------------
+# Writing
+# -----------------------------
+def _quote(column):
+    return f'"{column}"' if column == "timestamp" else column
+
+
+def _write(conn, inserts, updates):
+    """All inserts, then the coalesced audit updates, in one transaction."""
+    unmatched = []
+    with conn.cursor() as cur:
+        # file_audit_log first: buffered updates may target a buffered insert
+        for table in sorted(inserts, key=lambda t: t != "file_audit_log"):
+            rows = inserts[table]
+            if not rows:
+                continue
+            cols = TABLE_COLUMNS[table] + tuple(
+                c
+                for c in OPTIONAL_COLUMNS.get(table, ())
+                if any(r.get(c) is not None for r in rows)
+            )
+            execute_values(
+                cur,
+                f"INSERT INTO tools.{table} ({', '.join(_quote(c) for c in cols)}) VALUES %s",
+                [tuple(r.get(c) for c in cols) for r in rows],
+                page_size=1000,
+            )
+        # keyed by (file_audit_id, file_received_time), (file_audit_id,) or
+        # by the AUDIT_KEY tuple; one UPDATE per key shape
+        for size in (2, 1, len(AUDIT_KEY)):
+            keys = [k for k in updates if len(k) == size]
+            if keys:
+                unmatched += _update_audit(cur, keys, updates)
+    conn.commit()
+    for k in unmatched:
+        if len(k) == len(AUDIT_KEY):
+            target = f"{k[1]} ({k[5]})"
+        else:
+            target = f"file_audit_id={k[0]}"
+        print(
+            f"⚠️ Warning: file_audit_log update affected 0 rows (no exact match): {target}"
+        )
+
+
+def _update_audit(cur, keys, updates):
+    """One UPDATE ... FROM (VALUES ...) for keys of one shape; returns the keys that matched no row."""
+    if len(keys[0]) == 2:
+        key_columns = ("file_audit_id", "file_received_time")
+        key_template = "%s::int, %s::timestamp"
+    elif len(keys[0]) == 1:
+        key_columns = ("file_audit_id",)
+        key_template = "%s::int"
+    else:
+        key_columns = AUDIT_KEY
+        key_template = "%s::int, %s::text, %s::text, %s::text, %s::text, %s::text"
+    match = " AND ".join(f"a.{c} = v.{c}" for c in key_columns)
+    # by id the id alone identifies the key (the time comes back as a datetime)
+    returned = key_columns[:1] if len(key_columns) <= 2 else key_columns
+    values = [k + tuple(updates[k].get(c) for c in AUDIT_SET_COLUMNS) for k in keys]
+    # None means "not set by this flush": keep the stored value
+    matched = execute_values(
+        cur,
+        f"""
+        UPDATE tools.file_audit_log AS a
+        SET convert_status = COALESCE(v.convert_status, a.convert_status),
+            mapping_validation_status = COALESCE(v.mapping_validation_status, a.mapping_validation_status),
+            row_validation_status = COALESCE(v.row_validation_status, a.row_validation_status),
+            load_status = COALESCE(v.load_status, a.load_status),
+            total_rows = COALESCE(v.total_rows, a.total_rows)
+        FROM (VALUES %s) AS v({", ".join(key_columns + AUDIT_SET_COLUMNS)})
+        WHERE {match}
+        RETURNING {", ".join(f"v.{c}" for c in returned)}
+        """,
+        values,
+        template=f"({key_template}, %s::text, %s::text, %s::text, %s::text, %s::int)",
+        page_size=len(values),
+        fetch=True,
+    )
+    found = {tuple(r) for r in matched}
+    return [k for k in keys if k[: len(returned)] not in found]
+
+
+def _write_each(conn, inserts, updates):
+    """Slow path after a rejected flush: one transaction per record."""
+    items = [({table: [row]}, {}) for table, rows in inserts.items() for row in rows]
+    items += [({}, {k: values}) for k, values in updates.items()]
+    for one_insert, one_update in items:
+        try:
+            _write(conn, one_insert, one_update)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
+        except Exception as e:
+            conn.rollback()
+            print(
+                f"❌ log sink: record ditolak DB, dilewati: {str(e).strip()} {one_insert or one_update}"
+            )
+
+
+def _spool(inserts, updates):
+    lines = [
+        json.dumps({"table": table, "row": row}, default=str)
+        for table, rows in inserts.items()
+        for row in rows
+    ]
+    lines += [
+        json.dumps({"key": list(k), "set": values}, default=str)
+        for k, values in updates.items()
+    ]
+    if not lines:
+        return
+    os.makedirs(os.path.dirname(SPOOL_PATH) or ".", exist_ok=True)
+    # one append per flush, so concurrent writers do not interleave lines
+    with open(SPOOL_PATH, "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _claim_spool():
+    """Move the spool aside (atomic) and parse it; (inserts, updates, claimed path)."""
+    if not os.path.exists(SPOOL_PATH):
+        return {}, {}, None
+    claimed = f"{SPOOL_PATH}.{os.getpid()}.replay"
+    try:
+        os.replace(SPOOL_PATH, claimed)
+    except FileNotFoundError:
+        return {}, {}, None  # another process took it
+    inserts, updates = {}, {}
+    with open(claimed, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                print(f"⚠️ log spool: baris rusak dilewati: {line[:200]}")
+                continue
+            if "table" in item:
+                inserts.setdefault(item["table"], []).append(item["row"])
+            else:
+                updates.setdefault(tuple(item["key"]), {}).update(item["set"])
+    return inserts, updates, claimed
+
+
+def flush():
+    """
+    Write every buffered record (plus any spooled backlog) in one transaction.
+    Never raises: on failure the records go to the spool. Returns True when
+    nothing is left pending.
+    """
+    with _flush_lock:
+        inserts, updates = _take()
+        claimed = None
+        try:
+            spooled_inserts, spooled_updates, claimed = _claim_spool()
+        except Exception as e:
+            print(f"⚠️ log spool tidak bisa dibaca ({SPOOL_PATH}): {e}")
+        else:
+            if claimed:
+                # spooled records are older: apply them first
+                _add(spooled_inserts, spooled_updates, inserts, updates)
+                inserts, updates = spooled_inserts, spooled_updates
+        if not inserts and not updates:
+            return True
+
+        conn = None
+        try:
+            conn = db.get_connection("log")
+            try:
+                _write(conn, inserts, updates)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                raise
+            except psycopg2.Error:
+                conn.rollback()
+                _write_each(conn, inserts, updates)
+            ok = True
+        except (psycopg2.Error, PoolError, OSError, ValueError) as e:
+            ok = False
+            try:
+                _spool(inserts, updates)
+                print(
+                    f"⚠️ log sink: DB tidak tersedia ({str(e).strip()}); log disimpan di {SPOOL_PATH}"
+                )
+            except Exception as e2:
+                print(
+                    f"❌ log sink: gagal menulis spool {SPOOL_PATH}: {e2}; log hilang"
+                )
+        finally:
+            db.release(conn)
+        if claimed:
+            try:
+                os.remove(claimed)
+            except OSError:
+                pass
+        return ok
+
+
+atexit.register(flush)
@@ -0,0 +1,678 @@
+import os
+import json
+import sqlite3
+import tempfile
+from datetime import datetime
+
+import resolver
+
+# -----------------------------
+# Manifest store (batch_info backend)
+# -----------------------------
+# batch_output_<client>_<batch>.json used to be read, patched and rewritten in
+# full by every writer. The store keeps one row per file entry in a per-client
+# SQLite database (WAL mode), so an upsert touches one row inside a
+# transaction. The JSON file stays the exchange format: it is imported when it
+# changed on disk (operator edit, restart/reprocessing) and exported once the
+# ingest stages are done, for silver/gold/refresh_mv and the webapp.
+
+MANIFEST_DB_NAME = "manifest.db"
+BUSY_TIMEOUT_MS = 30000
+
+TOP_LEVEL_KEYS = ("client_schema", "client_id", "batch_id", "files")
+FILE_KEYS = (
+    "physical_file_name",
+    "logical_source_file",
+    "source_system",
+    "source_type",
+    "target_schema",
+    "target_table",
+    "source_config",
+    "parquet_name",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batch (
+    batch_id       TEXT PRIMARY KEY,
+    client_schema  TEXT,
+    client_id      INTEGER,
+    extra_json     TEXT,
+    json_stamp     TEXT,
+    updated_at     TEXT
+);
+CREATE TABLE IF NOT EXISTS file_entry (
+    batch_id             TEXT NOT NULL,
+    seq                  INTEGER NOT NULL,
+    physical_file_name   TEXT NOT NULL,
+    logical_source_file  TEXT,
+    source_system        TEXT,
+    source_type          TEXT,
+    target_schema        TEXT,
+    target_table         TEXT,
+    source_config        TEXT,
+    parquet_name         TEXT,
+    extra_json           TEXT,
+    PRIMARY KEY (batch_id, physical_file_name)
+);
+CREATE TABLE IF NOT EXISTS schema_cache (
+    source_system        TEXT NOT NULL,
+    logical_source_file  TEXT NOT NULL,
+    kind                 TEXT NOT NULL,
+    schema_blob          BLOB,
+    updated_at           TEXT,
+    PRIMARY KEY (source_system, logical_source_file, kind)
+);
+"""
+
+
+def batch_info_path(client_schema, batch_id, folder="incoming"):
+    return os.path.join(
+        "batch_info",
+        client_schema,
+        folder,
+        f"batch_output_{client_schema}_{batch_id}.json",
+    )
+
+
+def manifest_db_path(client_schema):
+    return os.path.join("batch_info", client_schema, MANIFEST_DB_NAME)
+
+
+def connect(client_schema):
+    """
+    Open the client's manifest database (autocommit; writers use BEGIN IMMEDIATE).
+    One connection per call keeps it safe across threads and processes.
+    """
+    path = manifest_db_path(client_schema)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    columns = {r["name"] for r in conn.execute("PRAGMA table_info(schema_cache)")}
+    if columns and "source_system" not in columns:
+        # pre-source_system cache layout; it is only a cache, rebuild it
+        conn.execute("DROP TABLE schema_cache")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# -----------------------------
+# Helpers
+# -----------------------------
+
+
+def _json_stamp(json_path):
+    try:
+        st = os.stat(json_path)
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def _dump(value):
+    return None if value is None else json.dumps(value, ensure_ascii=False)
+
+
+def _load(text):
+    return None if text is None else json.loads(text)
+
+
+def _row_to_entry(row):
+    entry = _load(row["extra_json"]) or {}
+    for k in FILE_KEYS:
+        entry[k] = row[k]
+    entry["source_config"] = _load(row["source_config"])
+    return entry
+
+
+def _insert_entry(conn, batch_id, entry):
+    seq = conn.execute(
+        "SELECT COALESCE(MAX(seq), 0) + 1 FROM file_entry WHERE batch_id = ?",
+        (batch_id,),
+    ).fetchone()[0]
+    extra = {k: v for k, v in entry.items() if k not in FILE_KEYS}
+    conn.execute(
+        """
+        INSERT INTO file_entry (
+            batch_id, seq, physical_file_name, logical_source_file, source_system,
+            source_type, target_schema, target_table, source_config, parquet_name,
+            extra_json
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            batch_id,
+            seq,
+            entry.get("physical_file_name"),
+            entry.get("logical_source_file"),
+            entry.get("source_system"),
+            entry.get("source_type"),
+            entry.get("target_schema"),
+            entry.get("target_table"),
+            _dump(entry.get("source_config")),
+            entry.get("parquet_name"),
+            _dump(extra) if extra else None,
+        ),
+    )
+
+
+def _merge_extra(conn, batch_id, physical_file_name, values):
+    """Merge values into the entry's extra keys; False if the entry is unknown."""
+    row = conn.execute(
+        "SELECT extra_json FROM file_entry WHERE batch_id = ? AND physical_file_name = ?",
+        (batch_id, physical_file_name),
+    ).fetchone()
+    if row is None:
+        return False
+    extra = _load(row["extra_json"]) or {}
+    extra.update(values)
+    conn.execute(
+        "UPDATE file_entry SET extra_json = ? WHERE batch_id = ? AND physical_file_name = ?",
+        (_dump(extra), batch_id, physical_file_name),
+    )
+    return True
+
+
+def _touch_batch(conn, batch_id):
+    conn.execute(
+        "UPDATE batch SET updated_at = ? WHERE batch_id = ?",
+        (datetime.now().isoformat(timespec="seconds"), batch_id),
+    )
+
+
+# -----------------------------
+# JSON import / export
+# -----------------------------
+
+
+def import_json(client_schema, batch_id, json_path=None, conn=None):
+    """
+    Replace the stored batch with the content of its JSON file.
+    Returns True if the JSON existed and was imported.
+    """
+    json_path = json_path or batch_info_path(client_schema, batch_id)
+    own = conn is None
+    conn = conn or connect(client_schema)
+    try:
+        stamp = _json_stamp(json_path)
+        if stamp is None:
+            return False
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            data = {}
+        extra = {k: v for k, v in data.items() if k not in TOP_LEVEL_KEYS}
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM file_entry WHERE batch_id = ?", (batch_id,))
+            conn.execute(
+                """
+                INSERT INTO batch (batch_id, client_schema, client_id, extra_json, json_stamp, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (batch_id) DO UPDATE SET
+                    client_schema = excluded.client_schema,
+                    client_id = excluded.client_id,
+                    extra_json = excluded.extra_json,
+                    json_stamp = excluded.json_stamp,
+                    updated_at = excluded.updated_at
+                """,
+                (
+                    batch_id,
+                    data.get("client_schema") or client_schema,
+                    data.get("client_id"),
+                    _dump(extra) if extra else None,
+                    stamp,
+                    datetime.now().isoformat(timespec="seconds"),
+                ),
+            )
+            seen = set()
+            for entry in data.get("files") or []:
+                name = entry.get("physical_file_name")
+                if not name or name in seen:
+                    continue
+                seen.add(name)
+                _insert_entry(conn, batch_id, entry)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+    finally:
+        if own:
+            conn.close()
+
+
+def sync_from_json(client_schema, batch_id, json_path=None, conn=None):
+    """Import the JSON only if it changed on disk since the last import/export."""
+    json_path = json_path or batch_info_path(client_schema, batch_id)
+    own = conn is None
+    conn = conn or connect(client_schema)
+    try:
+        stamp = _json_stamp(json_path)
+        if stamp is None:
+            return False
+        row = conn.execute(
+            "SELECT json_stamp FROM batch WHERE batch_id = ?", (batch_id,)
+        ).fetchone()
+        if row is not None and row["json_stamp"] == stamp:
+            return False
+        return import_json(client_schema, batch_id, json_path, conn=conn)
+    finally:
+        if own:
+            conn.close()
+
+
+def export_json(client_schema, batch_id, json_path=None):
+    """Write the stored batch back to the batch_output_*.json layout (one write)."""
+    json_path = json_path or batch_info_path(client_schema, batch_id)
+    conn = connect(client_schema)
+    try:
+        data = get_batch(client_schema, batch_id, conn=conn)
+        if data is None:
+            return False
+        dirn = os.path.dirname(json_path)
+        os.makedirs(dirn, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_batchinfo_", dir=dirn, text=True)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, json_path)
+        except Exception:
+            try:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            except Exception:
+                pass
+            raise
+        conn.execute(
+            "UPDATE batch SET json_stamp = ? WHERE batch_id = ?",
+            (_json_stamp(json_path), batch_id),
+        )
+        return True
+    finally:
+        conn.close()
+
+
+# -----------------------------
+# Reads
+# -----------------------------
+
+
+def get_batch(client_schema, batch_id, conn=None):
+    """Return the batch in batch_info JSON layout, or None if unknown."""
+    own = conn is None
+    conn = conn or connect(client_schema)
+    try:
+        row = conn.execute(
+            "SELECT * FROM batch WHERE batch_id = ?", (batch_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        data = {
+            "client_schema": row["client_schema"],
+            "client_id": row["client_id"],
+            "batch_id": batch_id,
+            "files": [
+                _row_to_entry(r)
+                for r in conn.execute(
+                    "SELECT * FROM file_entry WHERE batch_id = ? ORDER BY seq",
+                    (batch_id,),
+                )
+            ],
+        }
+        data.update(_load(row["extra_json"]) or {})
+        return data
+    finally:
+        if own:
+            conn.close()
+
+
+def get_file_entry(client_schema, batch_id, physical_file_name, conn=None):
+    """Exact physical_file_name lookup on the primary key."""
+    own = conn is None
+    conn = conn or connect(client_schema)
+    try:
+        row = conn.execute(
+            "SELECT * FROM file_entry WHERE batch_id = ? AND physical_file_name = ?",
+            (batch_id, physical_file_name),
+        ).fetchone()
+        return _row_to_entry(row) if row is not None else None
+    finally:
+        if own:
+            conn.close()
+
+
+def load_file_entry(
+    client_schema, batch_id, physical_file_name, json_path=None, tolerant=False
+):
+    """
+    (batch_header, file_entry) for a stage without loading every file entry.
+    batch_header is the batch_info layout with "files" left empty; it is None
+    when the batch is unknown. With tolerant=True a miss on the exact name falls
+    back to resolver.resolve_entry over the batch.
+    """
+    conn = connect(client_schema)
+    try:
+        sync_from_json(client_schema, batch_id, json_path, conn=conn)
+        row = conn.execute(
+            "SELECT * FROM batch WHERE batch_id = ?", (batch_id,)
+        ).fetchone()
+        if row is None:
+            return None, None
+        header = {
+            "client_schema": row["client_schema"],
+            "client_id": row["client_id"],
+            "batch_id": batch_id,
+            "files": [],
+        }
+        header.update(_load(row["extra_json"]) or {})
+
+        entry = get_file_entry(client_schema, batch_id, physical_file_name, conn=conn)
+        if entry is None and tolerant:
+            files = get_batch(client_schema, batch_id, conn=conn)["files"]
+            entry = resolver.resolve_entry(
+                resolver.build_manifest_index(files), physical_file_name
+            )
+        return header, entry
+    finally:
+        conn.close()
+
+
+def load_batch(client_schema, batch_id, json_path=None):
+    """
+    Batch info for a stage: picks up JSON changes first, then reads the store.
+    Returns None when neither the store nor the JSON know the batch.
+    """
+    conn = connect(client_schema)
+    try:
+        sync_from_json(client_schema, batch_id, json_path, conn=conn)
+        return get_batch(client_schema, batch_id, conn=conn)
+    finally:
+        conn.close()
+
+
+# -----------------------------
+# Writes
+# -----------------------------
+
+
+def init_batch(client_schema, batch_id, client_id):
+    """Create (or refresh top-level fields of) a batch without touching its files."""
+    conn = connect(client_schema)
+    try:
+        conn.execute(
+            """
+            INSERT INTO batch (batch_id, client_schema, client_id, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (batch_id) DO UPDATE SET
+                client_schema = excluded.client_schema,
+                client_id = excluded.client_id,
+                updated_at = excluded.updated_at
+            """,
+            (
+                batch_id,
+                client_schema,
+                client_id,
+                datetime.now().isoformat(timespec="seconds"),
+            ),
+        )
+    finally:
+        conn.close()
+
+
+def upsert_file_entry(client_schema, batch_id, entry):
+    """
+    Atomic per-entry upsert keyed by physical_file_name. FILE_KEYS are
+    written and an existing parquet_name is kept when the new one is None;
+    other keys (e.g. file_audit_id) are merged into the stored extras when not None.
+    """
+    clean = {k: entry.get(k) for k in FILE_KEYS}
+    extra = {k: v for k, v in entry.items() if k not in FILE_KEYS and v is not None}
+    conn = connect(client_schema)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.execute(
+                """
+                UPDATE file_entry SET
+                    logical_source_file = ?,
+                    source_system = ?,
+                    source_type = ?,
+                    target_schema = ?,
+                    target_table = ?,
+                    source_config = ?,
+                    parquet_name = COALESCE(?, parquet_name)
+                WHERE batch_id = ? AND physical_file_name = ?
+                """,
+                (
+                    clean["logical_source_file"],
+                    clean["source_system"],
+                    clean["source_type"],
+                    clean["target_schema"],
+                    clean["target_table"],
+                    _dump(clean["source_config"]),
+                    clean["parquet_name"],
+                    batch_id,
+                    clean["physical_file_name"],
+                ),
+            )
+            if cur.rowcount == 0:
+                _insert_entry(conn, batch_id, dict(clean, **extra))
+            elif extra:
+                _merge_extra(conn, batch_id, clean["physical_file_name"], extra)
+            _touch_batch(conn, batch_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+
+def set_parquet_name(
+    client_schema,
+    batch_id,
+    physical_file_name,
+    parquet_name,
+    logical_source_file=None,
+    source_system=None,
+    source_type=None,
+    extra=None,
+):
+    """
+    Record parquet_name for a file entry located with resolver.resolve_entry
+    (physical name, logical_source_file, base name without batch suffix);
+    otherwise append a new entry. extra keys (e.g. parquet_layout) are merged
+    into the entry.
+    Returns the physical_file_name of the entry that was updated or added.
+    """
+    conn = connect(client_schema)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT physical_file_name, logical_source_file FROM file_entry WHERE batch_id = ? ORDER BY seq",
+                (batch_id,),
+            ).fetchall()
+            entry = resolver.resolve_entry(
+                resolver.build_manifest_index([dict(r) for r in rows]),
+                physical_file_name,
+                logical_source_file,
+            )
+            matched = entry["physical_file_name"] if entry else None
+
+            if matched is not None:
+                conn.execute(
+                    "UPDATE file_entry SET parquet_name = ? WHERE batch_id = ? AND physical_file_name = ?",
+                    (parquet_name, batch_id, matched),
+                )
+                if extra:
+                    _merge_extra(conn, batch_id, matched, extra)
+            else:
+                matched = physical_file_name
+                _insert_entry(
+                    conn,
+                    batch_id,
+                    {
+                        "physical_file_name": physical_file_name,
+                        "logical_source_file": logical_source_file,
+                        "source_system": source_system,
+                        "source_type": source_type,
+                        "parquet_name": parquet_name,
+                        **(extra or {}),
+                    },
+                )
+            _touch_batch(conn, batch_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return matched
+    finally:
+        conn.close()
+
+
+def record_checkpoint(
+    client_schema,
+    batch_id,
+    physical_file_name,
+    stage,
+    status,
+    input_fingerprint=None,
+    output_fingerprint=None,
+):
+    """
+    Store the outcome of one stage under file_entry["checkpoints"][stage]
+    together with the input (and output) fingerprints it ran against.
+    Kept with the entry's extra keys, so it survives JSON export/import.
+    """
+    conn = connect(client_schema)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT extra_json FROM file_entry WHERE batch_id = ? AND physical_file_name = ?",
+                (batch_id, physical_file_name),
+            ).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return False
+            extra = _load(row["extra_json"]) or {}
+            checkpoints = extra.setdefault("checkpoints", {})
+            checkpoints[stage] = {
+                "status": status,
+                "input": input_fingerprint,
+                "output": output_fingerprint,
+                "at": datetime.now().isoformat(timespec="seconds"),
+            }
+            conn.execute(
+                "UPDATE file_entry SET extra_json = ? WHERE batch_id = ? AND physical_file_name = ?",
+                (_dump(extra), batch_id, physical_file_name),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+    finally:
+        conn.close()
+
+
+def set_file_audit_id(
+    client_schema, batch_id, physical_file_name, file_audit_id, file_received_time=None
+):
+    """
+    Store the tools.file_audit_log primary key on the file entry (extra keys
+    file_audit_id and file_received_time, the partition key), so stages update
+    their audit row by id.
+    """
+    conn = connect(client_schema)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            found = _merge_extra(
+                conn,
+                batch_id,
+                physical_file_name,
+                {
+                    "file_audit_id": file_audit_id,
+                    "file_received_time": file_received_time,
+                },
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return found
+    finally:
+        conn.close()
+
+
+# -----------------------------
+# Schema cache (per source_system + logical_source_file)
+# -----------------------------
+# Converters store the schema they inferred for a logical source (serialized
+# by the caller, e.g. an Arrow IPC schema) so later files of the same source
+# skip inference. kind separates the users ("json", ...).
+
+
+def get_cached_schema(
+    client_schema, source_system, logical_source_file, kind, max_age=None
+):
+    """
+    Cached schema bytes for (source_system, logical_source_file, kind), or
+    None (also when older than max_age seconds).
+    """
+    conn = connect(client_schema)
+    try:
+        row = conn.execute(
+            "SELECT schema_blob, updated_at FROM schema_cache "
+            "WHERE source_system = ? AND logical_source_file = ? AND kind = ?",
+            (source_system or "", logical_source_file, kind),
+        ).fetchone()
+        if not row or not row["schema_blob"]:
+            return None
+        if max_age is not None:
+            age = datetime.now() - datetime.fromisoformat(row["updated_at"])
+            if age.total_seconds() > max_age:
+                return None
+        return bytes(row["schema_blob"])
+    finally:
+        conn.close()
+
+
+def set_cached_schema(
+    client_schema, source_system, logical_source_file, kind, schema_blob
+):
+    """Store (or with None, drop) the cached schema of a logical source."""
+    conn = connect(client_schema)
+    try:
+        if schema_blob is None:
+            conn.execute(
+                "DELETE FROM schema_cache "
+                "WHERE source_system = ? AND logical_source_file = ? AND kind = ?",
+                (source_system or "", logical_source_file, kind),
+            )
+        else:
+            conn.execute(
+                """
+                INSERT INTO schema_cache (source_system, logical_source_file, kind, schema_blob, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (source_system, logical_source_file, kind) DO UPDATE SET
+                    schema_blob = excluded.schema_blob,
+                    updated_at = excluded.updated_at
+                """,
+                (
+                    source_system or "",
+                    logical_source_file,
+                    kind,
+                    sqlite3.Binary(schema_blob),
+                    datetime.now().isoformat(timespec="seconds"),
+                ),
+            )
+    finally:
+        conn.close()
@@ -0,0 +1,162 @@
+import os
+
+# -----------------------------
+# Shared file / config / manifest resolver
+# -----------------------------
+# One set of matching rules for batch_processing (start, restart, reprocessing),
+# convert_to_parquet and the manifest store. Lookups go through dict indexes
+# built once per batch, so matching stays O(1) per file.
+
+BATCH_SUFFIX_PREFIX = "_BATCH"
+
+# compressed raw files: outer extension -> codec (convert_to_parquet.open_source)
+COMPRESSION_EXTS = {".gz": "gzip", ".bz2": "bz2", ".zst": "zstd", ".zip": "zip"}
+
+
+def split_ext(filename: str):
+    """os.path.splitext keeping a compression suffix: 'a.csv.gz' -> ('a', '.csv.gz')."""
+    name, ext = os.path.splitext(filename)
+    if ext.lower() in COMPRESSION_EXTS:
+        name, inner = os.path.splitext(name)
+        return name, inner + ext
+    return name, ext
+
+
+def compression_of(filename: str):
+    """Codec of a compressed raw file name ('gzip', 'bz2', 'zstd', 'zip') or None."""
+    return COMPRESSION_EXTS.get(os.path.splitext(filename or "")[1].lower())
+
+
+def source_type_of(filename: str) -> str:
+    """Extension without the compression suffix: 'a.csv.gz' -> 'csv', 'a.zip' -> ''."""
+    name, ext = os.path.splitext(filename or "")
+    if ext.lower() in COMPRESSION_EXTS:
+        ext = os.path.splitext(name)[1]
+    return ext.lower().lstrip(".")
+
+
+def normalize_name(s: str):
+    if s is None:
+        return ""
+    base = split_ext(s)[0]
+    return base.strip().lower().replace(" ", "_").replace("-", "_")
+
+
+def strip_batch_suffix(filename: str) -> str:
+    """Remove trailing _BATCH###### before extension, if present."""
+    if not filename:
+        return filename
+    name, ext = split_ext(filename)
+    up = name.upper()
+    # exact _BATCH (unlikely) or _BATCHNNNNNN
+    if up.endswith(BATCH_SUFFIX_PREFIX) and len(name) >= len(BATCH_SUFFIX_PREFIX) + 6:
+        return name[: -len(BATCH_SUFFIX_PREFIX)] + ext
+    if "_BATCH" in up:
+        base, suf = name.rsplit("_", 1)
+        if suf.upper().startswith("BATCH") and len(suf) >= 11 and suf[5:].isdigit():
+            return base + ext
+    return filename
+
+
+def match_key(file_name):
+    """Normalized name without extension and batch suffix: 'Cust Info_BATCH000001.csv' -> 'cust_info'."""
+    return normalize_name(strip_batch_suffix(file_name or ""))
+
+
+def _lower(s):
+    return str(s or "").lower()
+
+
+# -----------------------------
+# Config index: (source_system, source_type, logical_norm) -> config
+# -----------------------------
+
+
+def build_config_index(configs):
+    """First active config wins for a key, same as the old linear scans."""
+    index = {}
+    for cfg in configs:
+        if not cfg.get("logical_norm"):
+            continue
+        key = (
+            _lower(cfg.get("source_system")),
+            _lower(cfg.get("source_type")),
+            cfg["logical_norm"],
+        )
+        index.setdefault(key, cfg)
+    return index
+
+
+def resolve_config(config_index, file_name, source_system, source_type):
+    """Config for a raw/physical file name (batch suffix ignored), or None."""
+    return config_index.get(
+        (_lower(source_system), _lower(source_type), match_key(file_name))
+    )
+
+
+# -----------------------------
+# Manifest index: batch_info["files"] keyed by physical / parquet / logical name
+# -----------------------------
+
+
+def build_manifest_index(files):
+    index = {
+        "physical": {},
+        "physical_ci": {},
+        "parquet": {},
+        "parquet_ci": {},
+        "parquet_key": {},
+        "logical_ci": {},
+        "match_key": {},
+    }
+    for f in files or []:
+        if not isinstance(f, dict):
+            continue
+        phys = f.get("physical_file_name")
+        if phys:
+            index["physical"].setdefault(phys, f)
+            index["physical_ci"].setdefault(_lower(phys), f)
+            index["match_key"].setdefault(match_key(phys), f)
+        pn = f.get("parquet_name")
+        if pn:
+            index["parquet"].setdefault(str(pn), f)
+            index["parquet_ci"].setdefault(_lower(pn), f)
+            index["parquet_key"].setdefault(match_key(pn), f)
+        logical = f.get("logical_source_file")
+        if logical:
+            index["logical_ci"].setdefault(_lower(logical), f)
+    return index
+
+
+def find_entry(index, physical_file_name):
+    """Exact physical_file_name lookup (what the validate/load stages require)."""
+    return index["physical"].get(physical_file_name)
+
+
+def resolve_entry(index, physical_file_name, logical_source_file=None):
+    """
+    Tolerant lookup: exact physical name, case-insensitive physical name,
+    logical_source_file, then base name without batch suffix.
+    """
+    return (
+        index["physical"].get(physical_file_name)
+        or index["physical_ci"].get(_lower(physical_file_name))
+        or (
+            index["logical_ci"].get(_lower(logical_source_file))
+            if logical_source_file
+            else None
+        )
+        or index["match_key"].get(match_key(physical_file_name))
+    )
+
+
+def resolve_parquet(index, parquet_name):
+    """
+    Manifest entry owning a parquet file: exact, case-insensitive, then base
+    name without batch suffix (e.g. a parquet renamed outside the pipeline).
+    """
+    return (
+        index["parquet"].get(parquet_name)
+        or index["parquet_ci"].get(_lower(parquet_name))
+        or index["parquet_key"].get(match_key(parquet_name))
+    )
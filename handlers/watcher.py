@@ -0,0 +1,130 @@
+import os
+import time
+
+# inotify is optional (Linux only); without it the watcher polls with scandir
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# -----------------------------
+# Incoming watcher (micro-batches for watch mode)
+# -----------------------------
+# A file is "settled" once its size and mtime have not changed for
+# settle_seconds. Settled files are cut into micro-batches when either
+# max_files are ready or the oldest ready file has waited window_seconds.
+# inotify only wakes the loop early; the scandir snapshot stays the source
+# of truth, so both backends behave the same.
+
+INOTIFY_MASK = 0
+if inotify_simple is not None:
+    INOTIFY_MASK = (
+        inotify_simple.flags.CREATE
+        | inotify_simple.flags.MODIFY
+        | inotify_simple.flags.CLOSE_WRITE
+        | inotify_simple.flags.MOVED_TO
+    )
+
+
+def incoming_dirs(client_schema, source_systems):
+    return [os.path.join("raw", client_schema, ss, "incoming") for ss in source_systems]
+
+
+def snapshot(dirs):
+    """{path: (size, mtime_ns)} for regular, non-hidden files in dirs."""
+    state = {}
+    for d in dirs:
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    # skip partial uploads that use dot-temp names
+                    if entry.name.startswith(".") or not entry.is_file():
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    state[entry.path] = (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            continue
+    return state
+
+
+def open_inotify(dirs):
+    """Return an inotify handle watching dirs, or None (not Linux / not installed)."""
+    if inotify_simple is None:
+        return None
+    try:
+        ino = inotify_simple.INotify()
+        for d in dirs:
+            os.makedirs(d, exist_ok=True)
+            ino.add_watch(d, INOTIFY_MASK)
+        return ino
+    except OSError as e:
+        print(f"⚠️ inotify tidak tersedia ({e}); fallback ke polling")
+        return None
+
+
+def iter_micro_batches(
+    dirs,
+    settle_seconds=2.0,
+    max_files=50,
+    window_seconds=5.0,
+    poll_interval=1.0,
+    should_stop=None,
+):
+    """
+    Yield lists of settled file paths (sorted) forever, or until should_stop()
+    returns True. The caller is expected to move yielded files out of incoming;
+    a file left behind unchanged is not yielded again.
+    """
+    ino = open_inotify(dirs)
+    print(
+        f"👀 Watching {len(dirs)} folder ({'inotify' if ino else 'polling'}), "
+        f"settle={settle_seconds}s max_files={max_files} window={window_seconds}s"
+    )
+    pending = {}  # path -> (size, mtime_ns, last_change_ts)
+    ready_since = {}  # path -> ts it became settled
+    handed_out = {}  # path -> (size, mtime_ns) already yielded
+    try:
+        while not (should_stop and should_stop()):
+            now = time.monotonic()
+            state = snapshot(dirs)
+
+            for path in list(pending):
+                if path not in state:
+                    pending.pop(path, None)
+                    ready_since.pop(path, None)
+            for path in list(handed_out):
+                if path not in state:
+                    handed_out.pop(path, None)
+
+            for path, sig in state.items():
+                if handed_out.get(path) == sig:
+                    continue
+                prev = pending.get(path)
+                if prev is None or prev[:2] != sig:
+                    pending[path] = (sig[0], sig[1], now)
+                    ready_since.pop(path, None)
+                elif path not in ready_since and now - prev[2] >= settle_seconds:
+                    ready_since[path] = now
+
+            ready = sorted(ready_since, key=lambda p: (ready_since[p], p))
+            if ready and (
+                len(ready) >= max_files or now - ready_since[ready[0]] >= window_seconds
+            ):
+                batch = sorted(ready[:max_files])
+                for path in batch:
+                    handed_out[path] = pending.pop(path)[:2]
+                    ready_since.pop(path, None)
+                yield batch
+                continue
+
+            if ino is not None:
+                # block until something changes (or poll_interval passes)
+                ino.read(timeout=int(poll_interval * 1000))
+            else:
+                time.sleep(poll_interval)
+    finally:
+        if ino is not None:
+            ino.close()
@@ -5,30 +5,22 @@ import json
 import psycopg2
 import shutil
 from datetime import datetime
-from dotenv import load_dotenv
+
+# db lives in handlers/ (shared DB pools)
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "handlers"
+    ),
+)
+import db  # noqa: E402
+import log_sink  # noqa: E402
+import batch_queue  # noqa: E402
 
 
 # =========================
 # Utilities (align dengan pola existing)
 # =========================
-def load_single_batch_file_from_success(client_schema):
-    folder_path = os.path.join("batch_info", client_schema, "success")
-    json_files = [f for f in os.listdir(folder_path) if f.lower().endswith('.json')]
-
-    if len(json_files) == 0:
-        raise FileNotFoundError(f"Tidak ada file JSON batch di folder {folder_path}")
-    if len(json_files) > 1:
-        raise RuntimeError(
-            f"Lebih dari 1 file JSON batch ditemukan di folder {folder_path}, harap hanya ada 1 file."
-        )
-
-    file_name = json_files[0]
-    file_path = os.path.join(folder_path, file_name)
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-    return data, file_name, file_path
-
-
 def get_client_id(cur, client_schema):
     cur.execute("""
         SELECT client_id FROM tools.client_reference WHERE client_schema = %s
@@ -64,15 +56,23 @@ def get_active_integrations(client_id, conn):
         return [{"proc_name": r[0], "table_type": r[1], "run_order": r[2]} for r in rows]
 
 
-def insert_job_execution_log(conn, job_name, client_id, status, start_time, end_time,
-                             error_message, file_name, batch_id):
-    with conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO tools.job_execution_log (
-                job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """, (job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id))
-    conn.commit()
+def insert_job_execution_log(
+    job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id
+):
+    # buffered; log_sink.flush() runs when the stage ends
+    log_sink.record(
+        "job_execution_log",
+        {
+            "job_name": job_name,
+            "client_id": client_id,
+            "status": status,
+            "start_time": start_time,
+            "end_time": end_time,
+            "error_message": error_message,
+            "file_name": file_name,
+            "batch_id": batch_id,
+        },
+    )
 
 
 def run_procedure(proc_name, client_schema, batch_id):
@@ -83,7 +83,7 @@ def run_procedure(proc_name, client_schema, batch_id):
     """
     proc_conn = None
     try:
-        proc_conn = psycopg2.connect(**DB_CONFIG)
+        proc_conn = db.get_connection("gold")
         proc_conn.autocommit = True
         with proc_conn.cursor() as cur:
             print(f"Menjalankan: CALL {proc_name}('{client_schema}', '{batch_id}', {proc_name}, NULL, NULL)")
@@ -106,7 +106,7 @@ def run_procedure(proc_name, client_schema, batch_id):
         return False, str(e)
     finally:
         if proc_conn:
-            proc_conn.close()
+            db.release(proc_conn)
 
 
 def move_file_to(target_dir_name, src_path, client_schema):
@@ -114,13 +114,14 @@ def move_file_to(target_dir_name, src_path, client_schema):
     target_dir_name ∈ {'archive','failed'}
     Source file saat ini ada di: batch_info/<client_schema>/success
     """
-    base_folder = os.path.join("batch_info", client_schema)
+    base_folder = os.path.dirname(os.path.dirname(src_path))
     target_folder = os.path.join(base_folder, target_dir_name)
     os.makedirs(target_folder, exist_ok=True)
     file_name = os.path.basename(src_path)
     dest_path = os.path.join(target_folder, file_name)
     shutil.move(src_path, dest_path)
     print(f"File {file_name} dipindah ke {target_dir_name}")
+    return dest_path
 
 
 def update_batch_file_with_procedures(dest_path, procedures):
@@ -213,43 +214,44 @@ def insert_integration_log_skip(conn, client_id, proc_name, batch_id, failed_det
 
 
 # =========================
-# Main Orchestrator
+# Stage API
 # =========================
-def main():
-    load_dotenv()
-    if len(sys.argv) < 2:
-        print("Usage: python gold_integration.py <client_schema>")
-        sys.exit(1)
-
-    client_schema = sys.argv[1]
-    DB_PORT = os.getenv("DB_PORT")
-    if DB_PORT is None:
-        raise ValueError("DB_PORT not set in .env")
-
-    global DB_CONFIG
-    DB_CONFIG = {
-        'host': os.getenv('DB_HOST'),
-        'port': int(DB_PORT),
-        'dbname': os.getenv('DB_NAME'),
-        'user': os.getenv('DB_USER'),
-        'password': os.getenv('DB_PASSWORD'),
+def stage_result(status, batch_id, batch_info_path, error=None):
+    """Hasil satu run gold; batch_info_path = lokasi JSON setelah dipindah."""
+    return {
+        "stage": "gold",
+        "status": status,
+        "batch_id": batch_id,
+        "batch_info_path": batch_info_path,
+        "error": error,
     }
 
+
+def run_gold_integration(client_schema, file_path):
+    """
+    Jalankan integrasi dimension lalu fact (dependency-aware) untuk batch JSON
+    di file_path, lalu pindahkan ke archive/ atau failed/.
+    Returns stage_result(...); tidak pernah memanggil sys.exit.
+    """
+    file_name = os.path.basename(file_path)
     try:
-        batch_info, file_name, file_path = load_single_batch_file_from_success(client_schema)
+        with open(file_path, "r") as f:
+            batch_info = json.load(f)
     except Exception as e:
-        print(f"Error membaca batch file dari success: {e}")
-        sys.exit(1)
+        print(f"Error membaca batch file: {e}")
+        return stage_result("FAILED", None, file_path, f"Error membaca batch file: {e}")
 
     batch_id = batch_info.get('batch_id')
     if not batch_id:
         print("batch_id tidak ditemukan di file batch info")
-        sys.exit(1)
+        return stage_result(
+            "FAILED", None, file_path, "batch_id tidak ditemukan di file batch info"
+        )
 
     job_name = "gold_integration.py"
     start_time = datetime.now()
 
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = db.get_connection("gold")
     try:
         with conn.cursor() as cur:
             client_id = get_client_id(cur, client_schema)
@@ -295,41 +297,37 @@ def main():
         procedures_run = dim_procs + fact_procs
 
         if all_success:
-            insert_job_execution_log(conn, job_name, client_id, "SUCCESS",
+            insert_job_execution_log(job_name, client_id, "SUCCESS",
                                      start_time, end_time, None, file_name, batch_id)
-            conn.commit()
-            move_file_to("archive", file_path, client_schema)
+            dest_path = move_file_to("archive", file_path, client_schema)
             try:
-                dest_path = os.path.join("batch_info", client_schema, "archive", file_name)
                 update_batch_file_with_procedures(dest_path, procedures_run)
             except Exception as e:
                 print(f"[WARN] Gagal update batch file dengan integration_procedure: {e}")
+            return stage_result("SUCCESS", batch_id, dest_path)
         else:
-            insert_job_execution_log(conn, job_name, client_id, "FAILED",
+            insert_job_execution_log(job_name, client_id, "FAILED",
                                      start_time, end_time, final_error_msg, file_name, batch_id)
-            conn.commit()
-            move_file_to("failed", file_path, client_schema)
+            dest_path = move_file_to("failed", file_path, client_schema)
             try:
-                dest_path = os.path.join("batch_info", client_schema, "failed", file_name)
                 update_batch_file_with_procedures(dest_path, procedures_run)
             except Exception as e:
                 print(f"[WARN] Gagal update batch file dengan integration_procedure: {e}")
-            sys.exit(1)
+            return stage_result("FAILED", batch_id, dest_path, final_error_msg)
 
     except Exception as e:
         end_time = datetime.now()
         try:
             insert_job_execution_log(
-                conn, job_name, client_id if 'client_id' in locals() else None,
+                job_name, client_id if 'client_id' in locals() else None,
                 "FAILED", start_time, end_time, str(e), file_name, batch_id
             )
             conn.rollback()
         except Exception:
             pass
         print(f"[FATAL] {e}")
-        move_file_to("failed", file_path, client_schema)
+        dest_path = move_file_to("failed", file_path, client_schema)
         try:
-            dest_path = os.path.join("batch_info", client_schema, "failed", file_name)
             procedures_run = []
             if 'dim_procs' in locals():
                 procedures_run += dim_procs
@@ -338,9 +336,34 @@ def main():
             update_batch_file_with_procedures(dest_path, procedures_run)
         except Exception as e2:
             print(f"[WARN] Gagal update batch file (fatal path) dengan integration_procedure: {e2}")
-        sys.exit(1)
+        return stage_result("FAILED", batch_id, dest_path, str(e))
     finally:
-        conn.close()
+        db.release(conn)
+        log_sink.flush()
+
+
+# =========================
+# Main Orchestrator
+# =========================
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python gold_integration.py <client_schema>")
+        sys.exit(1)
+
+    client_schema = sys.argv[1]
+    try:
+        queue = batch_queue.load_batch_queue(client_schema, "success")
+    except Exception as e:
+        print(f"Error membaca batch file dari success: {e}")
+        sys.exit(1)
+
+    # dependency fact -> dimension dicek per batch, jadi antrian diproses
+    # satu batch per pass, urut batch_id
+    print(f"[INFO] Antrian gold: {len(queue)} batch")
+    results = [run_gold_integration(client_schema, path) for _, _, path in queue]
+    for r in results:
+        print(f"[INFO]   {r['batch_id']}: {r['status']}")
+    sys.exit(0 if all(r["status"] == "SUCCESS" for r in results) else 1)
 
 
 if __name__ == "__main__":
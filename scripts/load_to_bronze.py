@@ -1,42 +1,33 @@
 import os
 import sys
 import re
-import json
 import tempfile
 import shutil
 import duckdb
-import psycopg2
+import pyarrow as pa
 import pyarrow.parquet as pq
 import gc
 import time
 import traceback
 from datetime import datetime
-from dotenv import load_dotenv
 
-# load environment variables
-load_dotenv()
-
-# -----------------------------
-# DB config via dotenv
-# -----------------------------
-DB_PORT = os.getenv("DB_PORT")
-if DB_PORT is None:
-    raise ValueError("DB_PORT not set in .env")
-
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST"),
-    "port": int(DB_PORT),
-    "dbname": os.getenv("DB_NAME"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-}
+# manifest_store and db live in handlers/ (shared batch_info backend, DB pools)
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "handlers"
+    ),
+)
+import db  # noqa: E402
+import log_sink  # noqa: E402
+import manifest_store  # noqa: E402
 
 
 # -----------------------------
 # Helpers
 # -----------------------------
 def get_connection():
-    return psycopg2.connect(**DB_CONFIG)
+    return db.get_connection("load")
 
 
 def extract_batch_id(filename: str):
@@ -138,7 +129,6 @@ def validate_target_table_columns(
 
 
 def update_file_audit_load_status(
-    conn,
     client_id,
     physical_file_name,
     source_system,
@@ -147,53 +137,27 @@ def update_file_audit_load_status(
     batch_id,
     status,
     total_rows=None,
+    file_audit_id=None,
+    file_received_time=None,
 ):
-    cur = conn.cursor()
-    if total_rows is None:
-        sql = """
-            UPDATE tools.file_audit_log
-            SET load_status = %s
-            WHERE client_id=%s AND physical_file_name=%s AND source_system=%s AND source_type=%s AND logical_source_file=%s AND batch_id=%s
-        """
-        cur.execute(
-            sql,
-            (
-                status,
-                client_id,
-                physical_file_name,
-                source_system,
-                source_type,
-                logical_source_file,
-                batch_id,
-            ),
-        )
-    else:
-        sql = """
-            UPDATE tools.file_audit_log
-            SET load_status = %s, total_rows = %s
-            WHERE client_id=%s AND physical_file_name=%s AND source_system=%s AND source_type=%s AND logical_source_file=%s AND batch_id=%s
-        """
-        cur.execute(
-            sql,
-            (
-                status,
-                total_rows,
-                client_id,
-                physical_file_name,
-                source_system,
-                source_type,
-                logical_source_file,
-                batch_id,
-            ),
-        )
-    affected = cur.rowcount
-    conn.commit()
-    cur.close()
-    return affected
+    # buffered; written by log_sink.flush() when the stage ends
+    values = {"load_status": status}
+    if total_rows is not None:
+        values["total_rows"] = total_rows
+    log_sink.update_file_audit(
+        client_id,
+        physical_file_name,
+        source_system,
+        source_type,
+        logical_source_file,
+        batch_id,
+        file_audit_id=file_audit_id,
+        file_received_time=file_received_time,
+        **values,
+    )
 
 
 def insert_job_execution_log(
-    conn,
     client_id,
     job_name,
     status,
@@ -203,38 +167,32 @@ def insert_job_execution_log(
     start_time,
     end_time,
 ):
-    cur = conn.cursor()
-    sql = """
-      INSERT INTO tools.job_execution_log
-      (client_id, job_name, status, error_message, file_name, batch_id, start_time, end_time)
-      VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
-    """
-    cur.execute(
-        sql,
-        (
-            client_id,
-            job_name,
-            status,
-            error_message,
-            file_name,
-            batch_id,
-            start_time,
-            end_time,
-        ),
+    log_sink.record(
+        "job_execution_log",
+        {
+            "client_id": client_id,
+            "job_name": job_name,
+            "status": status,
+            "error_message": error_message,
+            "file_name": file_name,
+            "batch_id": batch_id,
+            "start_time": start_time,
+            "end_time": end_time,
+        },
     )
-    conn.commit()
-    cur.close()
 
 
-def insert_load_error_log(conn, client_id, error_detail, stage, file_name, batch_id):
-    cur = conn.cursor()
-    sql = """
-      INSERT INTO tools.load_error_log (client_id, error_detail, stage, file_name, batch_id)
-      VALUES (%s,%s,%s,%s,%s)
-    """
-    cur.execute(sql, (client_id, error_detail, stage, file_name, batch_id))
-    conn.commit()
-    cur.close()
+def insert_load_error_log(client_id, error_detail, stage, file_name, batch_id):
+    log_sink.record(
+        "load_error_log",
+        {
+            "client_id": client_id,
+            "error_detail": error_detail,
+            "stage": stage,
+            "file_name": file_name,
+            "batch_id": batch_id,
+        },
+    )
 
 
 # -----------------------------
@@ -263,15 +221,30 @@ def is_id_candidate(col_name: str) -> bool:
 
 
 # -----------------------------
-# Main
+# Stage API
 # -----------------------------
-def main():
-    if len(sys.argv) != 3:
-        print("Usage: python load_to_bronze.py <client_schema> <physical_file_name>")
-        sys.exit(2)
-
-    client_schema = sys.argv[1]
-    physical_file_name = sys.argv[2]
+def stage_result(status, physical_file_name, error=None, **extra):
+    """
+    Structured result returned by run_load_to_bronze (same shape as the other stages).
+    """
+    result = {
+        "stage": "load_to_bronze",
+        "status": status,
+        "physical_file_name": physical_file_name,
+        "parquet_name": None,
+        "parquet_path": None,
+        "total_rows": None,
+        "error": error,
+    }
+    result.update(extra)
+    return result
+
+
+def run_load_to_bronze(client_schema, physical_file_name):
+    """
+    Load the batch Parquet into its bronze table (DELETE by dwh_batch_id + COPY),
+    then archive the Parquet. Returns stage_result(...); never calls sys.exit.
+    """
     start_time = datetime.now()
     job_name = "Load To Bronze"
     stage = "load_to_bronze"
@@ -279,7 +252,7 @@ def main():
     batch_id = extract_batch_id(physical_file_name)
     if not batch_id:
         print("❌ cannot extract batch_id")
-        sys.exit(1)
+        return stage_result("FAILED", physical_file_name, "cannot extract batch_id")
 
     batch_info_path = os.path.join(
         "batch_info",
@@ -287,43 +260,53 @@ def main():
         "incoming",
         f"batch_output_{client_schema}_{batch_id}.json",
     )
-    if not os.path.exists(batch_info_path):
-        print(f"❌ batch_info not found: {batch_info_path}")
-        sys.exit(1)
-
-    with open(batch_info_path, "r") as f:
-        batch_info = json.load(f)
-
-    file_entry = next(
-        (
-            x
-            for x in batch_info.get("files", [])
-            if x.get("physical_file_name") == physical_file_name
-        ),
-        None,
+    batch_info, file_entry = manifest_store.load_file_entry(
+        client_schema, batch_id, physical_file_name, batch_info_path
     )
+    if batch_info is None:
+        print(f"❌ batch_info not found: {batch_info_path}")
+        return stage_result(
+            "FAILED", physical_file_name, f"batch_info not found: {batch_info_path}"
+        )
+
     if not file_entry:
         print(f"❌ file {physical_file_name} not found in batch_info")
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"file {physical_file_name} not found in batch_info",
+        )
 
     parquet_name = file_entry.get("parquet_name")
     logical_source_file = file_entry.get("logical_source_file")
     source_system = (file_entry.get("source_system") or "").lower()
     source_type = (file_entry.get("source_type") or "").lower()
+    file_audit_id = file_entry.get("file_audit_id")
+    file_received_time = file_entry.get("file_received_time")
     target_schema = file_entry.get("target_schema")
     target_table = file_entry.get("target_table")
     client_id = batch_info.get("client_id")
 
     if not parquet_name or not target_schema or not target_table:
         print("❌ missing metadata (parquet_name/target_schema/target_table)")
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            "missing metadata (parquet_name/target_schema/target_table)",
+            parquet_name=parquet_name,
+        )
 
     parquet_path = os.path.join(
         "data", client_schema, source_system, "incoming", parquet_name
     )
     if not os.path.exists(parquet_path):
         print(f"❌ parquet not found: {parquet_path}")
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"parquet not found: {parquet_path}",
+            parquet_name=parquet_name,
+        )
 
     # initialize handles so finally can always cleanup
     conn = None
@@ -343,9 +326,8 @@ def main():
         if not mappings:
             msg = "Column mapping not found for this file"
             print("❌", msg)
-            insert_load_error_log(conn, client_id, msg, stage, parquet_name, batch_id)
+            insert_load_error_log(client_id, msg, stage, parquet_name, batch_id)
             update_file_audit_load_status(
-                conn,
                 client_id,
                 physical_file_name,
                 source_system,
@@ -353,9 +335,10 @@ def main():
                 logical_source_file,
                 batch_id,
                 "FAILED",
+                file_audit_id=file_audit_id,
+                file_received_time=file_received_time,
             )
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -366,8 +349,10 @@ def main():
                 datetime.now(),
             )
             cur.close()
-            conn.close()
-            sys.exit(1)
+            db.release(conn)
+            return stage_result(
+                "FAILED", physical_file_name, msg, parquet_name=parquet_name
+            )
 
         source_cols = [m[0] for m in mappings]
         target_cols = [m[1] for m in mappings]
@@ -377,12 +362,12 @@ def main():
         try:
             pf = pq.ParquetFile(parquet_path)
             parquet_actual_cols = list(pf.schema.names)
+            parquet_types = {f.name: f.type for f in pf.schema_arrow}
         except Exception as e:
             msg = f"Failed to read parquet schema: {e}"
             print("❌", msg)
-            insert_load_error_log(conn, client_id, msg, stage, parquet_name, batch_id)
+            insert_load_error_log(client_id, msg, stage, parquet_name, batch_id)
             update_file_audit_load_status(
-                conn,
                 client_id,
                 physical_file_name,
                 source_system,
@@ -390,9 +375,10 @@ def main():
                 logical_source_file,
                 batch_id,
                 "FAILED",
+                file_audit_id=file_audit_id,
+                file_received_time=file_received_time,
             )
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -403,8 +389,10 @@ def main():
                 datetime.now(),
             )
             cur.close()
-            conn.close()
-            sys.exit(1)
+            db.release(conn)
+            return stage_result(
+                "FAILED", physical_file_name, msg, parquet_name=parquet_name
+            )
         finally:
             # release pyarrow object right away
             pf = None
@@ -428,9 +416,8 @@ def main():
                 missing_sources
             )
             print("❌", msg)
-            insert_load_error_log(conn, client_id, msg, stage, parquet_name, batch_id)
+            insert_load_error_log(client_id, msg, stage, parquet_name, batch_id)
             update_file_audit_load_status(
-                conn,
                 client_id,
                 physical_file_name,
                 source_system,
@@ -438,9 +425,10 @@ def main():
                 logical_source_file,
                 batch_id,
                 "FAILED",
+                file_audit_id=file_audit_id,
+                file_received_time=file_received_time,
             )
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -451,8 +439,10 @@ def main():
                 datetime.now(),
             )
             cur.close()
-            conn.close()
-            sys.exit(1)
+            db.release(conn)
+            return stage_result(
+                "FAILED", physical_file_name, msg, parquet_name=parquet_name
+            )
 
         # 3) Validate target table columns exist AND fetch types
         required_target_cols = list(target_cols)
@@ -463,9 +453,8 @@ def main():
         if missing_target:
             msg = "Target table missing columns: " + ",".join(missing_target)
             print("❌", msg)
-            insert_load_error_log(conn, client_id, msg, stage, parquet_name, batch_id)
+            insert_load_error_log(client_id, msg, stage, parquet_name, batch_id)
             update_file_audit_load_status(
-                conn,
                 client_id,
                 physical_file_name,
                 source_system,
@@ -473,9 +462,10 @@ def main():
                 logical_source_file,
                 batch_id,
                 "FAILED",
+                file_audit_id=file_audit_id,
+                file_received_time=file_received_time,
             )
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -486,8 +476,10 @@ def main():
                 datetime.now(),
             )
             cur.close()
-            conn.close()
-            sys.exit(1)
+            db.release(conn)
+            return stage_result(
+                "FAILED", physical_file_name, msg, parquet_name=parquet_name
+            )
 
         # 4) Use DuckDB to export CSV
         try:
@@ -495,9 +487,8 @@ def main():
         except Exception as e:
             msg = f"Failed to start DuckDB: {e}"
             print("❌", msg)
-            insert_load_error_log(conn, client_id, msg, stage, parquet_name, batch_id)
+            insert_load_error_log(client_id, msg, stage, parquet_name, batch_id)
             update_file_audit_load_status(
-                conn,
                 client_id,
                 physical_file_name,
                 source_system,
@@ -505,9 +496,10 @@ def main():
                 logical_source_file,
                 batch_id,
                 "FAILED",
+                file_audit_id=file_audit_id,
+                file_received_time=file_received_time,
             )
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -518,8 +510,10 @@ def main():
                 datetime.now(),
             )
             cur.close()
-            conn.close()
-            sys.exit(1)
+            db.release(conn)
+            return stage_result(
+                "FAILED", physical_file_name, msg, parquet_name=parquet_name
+            )
 
         abs_parquet = os.path.abspath(parquet_path)
         parquet_path_sql = quote_path_literal(abs_parquet)
@@ -529,8 +523,11 @@ def main():
         for src_raw, tgt in zip(source_cols, target_cols):
             actual_col = required_to_actual[src_raw]
             tgt_lower = tgt.lower()
+            # integer columns (pinned schema, see convert_to_parquet) load as-is
+            if pa.types.is_integer(parquet_types.get(actual_col, pa.null())):
+                sel = f"{quote_ident(actual_col)} AS {quote_ident(tgt)}"
             # decide whether to cast: use stricter is_id_candidate
-            if is_id_candidate(tgt_lower):
+            elif is_id_candidate(tgt_lower):
                 tgt_type = col_types.get(tgt_lower)
                 # if DB side is text/char, do not cast (preserve original)
                 if tgt_type and ("char" in tgt_type or "text" in tgt_type):
@@ -605,7 +602,6 @@ def main():
 
         # 7) success update
         update_file_audit_load_status(
-            conn,
             client_id,
             physical_file_name,
             source_system,
@@ -614,9 +610,10 @@ def main():
             batch_id,
             "SUCCESS",
             total_rows,
+            file_audit_id=file_audit_id,
+            file_received_time=file_received_time,
         )
         insert_job_execution_log(
-            conn,
             client_id,
             job_name,
             "SUCCESS",
@@ -648,7 +645,7 @@ def main():
         except Exception:
             pass
         try:
-            conn.close()
+            db.release(conn)
         except Exception:
             pass
 
@@ -662,51 +659,49 @@ def main():
         print(
             f"✅ Loaded {total_rows} rows into {target_schema}.{target_table} (batch {batch_id})."
         )
-        sys.exit(0)
+        return stage_result(
+            "SUCCESS",
+            physical_file_name,
+            parquet_name=parquet_name,
+            parquet_path=parquet_path,
+            total_rows=total_rows,
+        )
 
     except Exception as e:
         err_msg = f"Unhandled error in load_to_bronze: {e}"
         print("❌", err_msg)
         traceback.print_exc()
         # best-effort logging
+        insert_load_error_log(client_id, err_msg, stage, parquet_name, batch_id)
+        update_file_audit_load_status(
+            client_id,
+            physical_file_name,
+            source_system,
+            source_type,
+            logical_source_file,
+            batch_id,
+            "FAILED",
+            file_audit_id=file_audit_id,
+            file_received_time=file_received_time,
+        )
+        insert_job_execution_log(
+            client_id,
+            job_name,
+            "FAILED",
+            err_msg,
+            parquet_name,
+            batch_id,
+            start_time,
+            datetime.now(),
+        )
         try:
             if conn:
-                insert_load_error_log(
-                    conn, client_id, err_msg, stage, parquet_name, batch_id
-                )
-                try:
-                    update_file_audit_load_status(
-                        conn,
-                        client_id,
-                        physical_file_name,
-                        source_system,
-                        source_type,
-                        logical_source_file,
-                        batch_id,
-                        "FAILED",
-                    )
-                except Exception:
-                    pass
-                try:
-                    insert_job_execution_log(
-                        conn,
-                        client_id,
-                        job_name,
-                        "FAILED",
-                        err_msg,
-                        parquet_name,
-                        batch_id,
-                        start_time,
-                        datetime.now(),
-                    )
-                except Exception:
-                    pass
                 try:
                     conn.rollback()
                 except Exception:
                     pass
                 try:
-                    conn.close()
+                    db.release(conn)
                 except Exception:
                     pass
         except Exception:
@@ -742,7 +737,21 @@ def main():
         except Exception:
             pass
 
-        sys.exit(1)
+        return stage_result(
+            "FAILED", physical_file_name, err_msg, parquet_name=parquet_name
+        )
+
+
+# -----------------------------
+# Main
+# -----------------------------
+def main():
+    if len(sys.argv) != 3:
+        print("Usage: python load_to_bronze.py <client_schema> <physical_file_name>")
+        sys.exit(2)
+
+    result = run_load_to_bronze(sys.argv[1], sys.argv[2])
+    sys.exit(0 if result["status"] == "SUCCESS" else 1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+import os
+import re
+import sys
+import gzip
+import argparse
+from datetime import date
+
+# db lives in handlers/ (shared DB pools)
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "handlers"
+    ),
+)
+import db  # noqa: E402
+
+# -----------------------------
+# Log retention (monthly partitions, see sql/tools/log_partitioning.sql)
+# -----------------------------
+# Per log table: create the partitions for the coming months (so new rows do
+# not pile up in <table>_default), then detach and drop every monthly partition
+# that ends before the retention cutoff. With --archive-dir the partition is
+# first exported to <archive-dir>/<partition>.csv.gz; with --keep-detached it
+# is only detached and stays as a plain table in schema tools. The detach runs
+# in its own short transaction with a lock timeout, so a busy table is skipped
+# instead of blocking the pipeline; export and drop happen after it.
+
+LOG_TABLES = (
+    "file_audit_log",
+    "job_execution_log",
+    "integration_log",
+    "mv_refresh_log",
+    "transformation_log",
+    "row_validation_log",
+)
+
+BOUND_RE = re.compile(r"TO \('(\d{4})-(\d{2})-(\d{2})")
+
+
+def add_months(d, months):
+    total = d.year * 12 + d.month - 1 + months
+    return date(total // 12, total % 12 + 1, 1)
+
+
+def list_partitions(cur, table):
+    """[(partition_name, upper_bound_date)] of tools.<table>, DEFAULT excluded."""
+    cur.execute(
+        """
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        ORDER BY c.relname
+        """,
+        (f"tools.{table}",),
+    )
+    partitions = []
+    for name, bound in cur.fetchall():
+        m = BOUND_RE.search(bound or "")
+        if m:
+            partitions.append((name, date(*map(int, m.groups()))))
+    return partitions
+
+
+def is_partitioned(cur, table):
+    cur.execute(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+        (f"tools.{table}",),
+    )
+    return cur.fetchone() is not None
+
+
+def archive_partition(conn, partition, archive_dir):
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{partition}.csv.gz")
+    tmp_path = path + ".tmp"
+    with conn.cursor() as cur, gzip.open(tmp_path, "wt", encoding="utf-8") as fh:
+        cur.copy_expert(
+            f'COPY tools."{partition}" TO STDOUT WITH (FORMAT CSV, HEADER)', fh
+        )
+    os.replace(tmp_path, path)
+    return path
+
+
+def run_retention(
+    keep_months,
+    months_ahead=3,
+    archive_dir=None,
+    keep_detached=False,
+    dry_run=False,
+    lock_timeout="10s",
+):
+    """
+    Apply retention to every partitioned log table. Partitions whose upper
+    bound is on or before the first day of (current month - keep_months) are
+    removed. Returns {table: {"created": n, "removed": [names], "skipped": [names]}}.
+    """
+    cutoff = add_months(date.today().replace(day=1), -keep_months)
+    print(f"Retensi log: simpan {keep_months} bulan, partisi < {cutoff} dihapus")
+    summary = {}
+
+    conn = db.get_connection("batch")
+    try:
+        for table in LOG_TABLES:
+            result = {"created": 0, "removed": [], "skipped": []}
+            summary[table] = result
+            with conn.cursor() as cur:
+                if not is_partitioned(cur, table):
+                    print(
+                        f"⚠️ tools.{table} belum dipartisi (jalankan sql/tools/log_partitioning.sql), dilewati"
+                    )
+                    conn.rollback()
+                    continue
+
+                if not dry_run:
+                    cur.execute(
+                        "SELECT tools.create_log_partitions(%s, CURRENT_DATE, %s)",
+                        (table, months_ahead + 1),
+                    )
+                    result["created"] = cur.fetchone()[0]
+                    conn.commit()
+
+                expired = [
+                    name
+                    for name, upper in list_partitions(cur, table)
+                    if upper <= cutoff
+                ]
+                conn.rollback()
+
+            for partition in expired:
+                if dry_run:
+                    print(f"[dry-run] tools.{partition} akan dihapus")
+                    result["removed"].append(partition)
+                    continue
+                try:
+                    # detach first and commit: the parent lock is held only briefly
+                    with conn.cursor() as cur:
+                        cur.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+                        cur.execute(
+                            f'ALTER TABLE tools."{table}" DETACH PARTITION tools."{partition}"'
+                        )
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    result["skipped"].append(partition)
+                    print(f"❌ Gagal detach tools.{partition}: {e}")
+                    continue
+                try:
+                    if archive_dir:
+                        path = archive_partition(conn, partition, archive_dir)
+                        print(f"Arsip tools.{partition} -> {path}")
+                    if not keep_detached:
+                        with conn.cursor() as cur:
+                            cur.execute(f'DROP TABLE tools."{partition}"')
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    result["skipped"].append(partition)
+                    print(
+                        f"❌ Gagal arsip/drop tools.{partition}: {e}; "
+                        f"partisi sudah di-detach dan tetap ada sebagai tabel biasa"
+                    )
+                    continue
+                result["removed"].append(partition)
+                action = "di-detach" if keep_detached else "dihapus"
+                print(f"✅ tools.{partition} {action}")
+    finally:
+        db.release(conn)
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Retensi tabel log: buat partisi bulan berikutnya, detach/drop partisi lama"
+    )
+    parser.add_argument(
+        "keep_months",
+        type=int,
+        help="jumlah bulan penuh yang disimpan (selain bulan berjalan)",
+    )
+    parser.add_argument(
+        "--months-ahead",
+        type=int,
+        default=int(os.getenv("LOG_PARTITION_MONTHS_AHEAD", "3")),
+        help="partisi yang dibuat di depan bulan berjalan (default 3)",
+    )
+    parser.add_argument(
+        "--archive-dir",
+        default=os.getenv("LOG_ARCHIVE_DIR"),
+        help="ekspor partisi ke <dir>/<partisi>.csv.gz sebelum dihapus",
+    )
+    parser.add_argument(
+        "--keep-detached",
+        action="store_true",
+        help="hanya detach; partisi tetap ada sebagai tabel biasa",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="tampilkan saja, tanpa perubahan"
+    )
+    args = parser.parse_args()
+    if args.keep_months < 0:
+        parser.error("keep_months harus >= 0")
+
+    summary = run_retention(
+        args.keep_months,
+        months_ahead=args.months_ahead,
+        archive_dir=args.archive_dir,
+        keep_detached=args.keep_detached,
+        dry_run=args.dry_run,
+    )
+    failed = False
+    for table, r in summary.items():
+        print(
+            f"  {table}: partisi baru={r['created']} dihapus={len(r['removed'])} gagal={len(r['skipped'])}"
+        )
+        failed = failed or bool(r["skipped"])
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,19 @@
 import os
 import sys
 import json
-import psycopg2
 import shutil
 from datetime import datetime
-from dotenv import load_dotenv
 
-
-def load_single_batch_file(client_schema):
-    folder_path = os.path.join("batch_info", client_schema, "archive")
-    json_files = [f for f in os.listdir(folder_path) if f.lower().endswith(".json")]
-
-    if len(json_files) == 0:
-        raise FileNotFoundError(f"Tidak ada file JSON batch di folder {folder_path}")
-    if len(json_files) > 1:
-        raise RuntimeError(
-            f"Lebih dari 1 file JSON batch ditemukan di folder {folder_path}, harap hanya ada 1 file."
-        )
-
-    file_name = json_files[0]
-    file_path = os.path.join(folder_path, file_name)
-    with open(file_path, "r") as f:
-        data = json.load(f)
-    return data, file_name, file_path
+# db lives in handlers/ (shared DB pools)
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "handlers"
+    ),
+)
+import db  # noqa: E402
+import log_sink  # noqa: E402
+import batch_queue  # noqa: E402
 
 
 def get_client_id(cur, client_schema):
@@ -59,24 +50,28 @@ def get_active_mvs(client_id, conn):
 
 
 def insert_job_execution_log(
-    conn, job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id
+    job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id
 ):
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO tools.job_execution_log (
-                job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """,
-            (job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id),
-        )
-    conn.commit()
+    # buffered; log_sink.flush() runs when the stage ends
+    log_sink.record(
+        "job_execution_log",
+        {
+            "job_name": job_name,
+            "client_id": client_id,
+            "status": status,
+            "start_time": start_time,
+            "end_time": end_time,
+            "error_message": error_message,
+            "file_name": file_name,
+            "batch_id": batch_id,
+        },
+    )
 
 
 def run_procedure(proc_name, client_schema, batch_id):
     proc_conn = None
     try:
-        proc_conn = psycopg2.connect(**DB_CONFIG)
+        proc_conn = db.get_connection("mv")
         proc_conn.autocommit = True
         with proc_conn.cursor() as cur:
             proc_fullname = f"tools.refresh_{proc_name}"
@@ -90,13 +85,17 @@ def run_procedure(proc_name, client_schema, batch_id):
         return False, str(e)
     finally:
         if proc_conn:
-            proc_conn.close()
+            db.release(proc_conn)
 
 
-def update_batch_file_with_procs(file_path, proc_names):
+def update_batch_file_with_procs(file_path, proc_names, refresh_batch_id=None):
     with open(file_path, "r") as f:
         data = json.load(f)
 
+    # batch yang di-coalesce ikut refresh milik batch lain
+    if refresh_batch_id and refresh_batch_id != data.get("batch_id"):
+        data["refresh_coalesced_into"] = refresh_batch_id
+
     key_base = "refresh_procedure"
     if key_base not in data:
         data[key_base] = proc_names
@@ -119,43 +118,76 @@ def move_file(src_path, client_schema, status):
     dest_path = os.path.join(target_folder, file_name)
     shutil.move(src_path, dest_path)
     print(f"File {file_name} dipindah ke {target_folder}")
-
-
-def main():
-    load_dotenv()
-    if len(sys.argv) < 2:
-        print("Usage: python refresh_mv.py <client_schema>")
-        sys.exit(1)
-
-    client_schema = sys.argv[1]
-    DB_PORT = os.getenv("DB_PORT")
-    if DB_PORT is None:
-        raise ValueError("DB_PORT not set in .env")
-
-    global DB_CONFIG
-    DB_CONFIG = {
-        "host": os.getenv("DB_HOST"),
-        "port": int(DB_PORT),
-        "dbname": os.getenv("DB_NAME"),
-        "user": os.getenv("DB_USER"),
-        "password": os.getenv("DB_PASSWORD"),
+    return dest_path
+
+
+# -----------------------------
+# Stage API
+# -----------------------------
+def stage_result(status, batch_id, batch_info_path, error=None):
+    """Result of one MV refresh run; batch_info_path is where the JSON ended up."""
+    return {
+        "stage": "mv",
+        "status": status,
+        "batch_id": batch_id,
+        "batch_info_path": batch_info_path,
+        "error": error,
     }
 
-    try:
-        batch_info, file_name, file_path = load_single_batch_file(client_schema)
-    except Exception as e:
-        print(f"Error membaca batch file: {e}")
-        sys.exit(1)
 
-    batch_id = batch_info.get("batch_id")
-    if not batch_id:
-        print("batch_id tidak ditemukan di file batch info")
-        sys.exit(1)
+def run_refresh_mv(client_schema, file_path):
+    """
+    Refresh the active materialized views for the batch JSON at file_path,
+    then move it to refreshed/ or failed/. Returns stage_result(...); never
+    calls sys.exit.
+    """
+    return run_refresh_mv_batches(client_schema, [file_path])[0]
+
+
+def run_refresh_mv_batches(client_schema, file_paths):
+    """
+    Refresh the active materialized views once for several pending batches.
+    REFRESH MATERIALIZED VIEW rebuilds the whole view, so one pass under the
+    newest batch_id covers every batch in the queue. Each JSON is then moved
+    to refreshed/ or failed/. Returns one stage_result per file_path, in the
+    same order; never calls sys.exit.
+    """
+    results = {}
+    batches = []  # (batch_id, file_path)
+    for file_path in file_paths:
+        try:
+            with open(file_path, "r") as f:
+                batch_info = json.load(f)
+        except Exception as e:
+            print(f"Error membaca batch file: {e}")
+            results[file_path] = stage_result(
+                "FAILED", None, file_path, f"Error membaca batch file: {e}"
+            )
+            continue
+        batch_id = batch_info.get("batch_id")
+        if not batch_id:
+            print("batch_id tidak ditemukan di file batch info")
+            results[file_path] = stage_result(
+                "FAILED", None, file_path, "batch_id tidak ditemukan di file batch info"
+            )
+            continue
+        batches.append((batch_id, file_path))
+
+    if not batches:
+        return [results[p] for p in file_paths]
+
+    batches.sort()
+    refresh_batch_id = batches[-1][0]
+    if len(batches) > 1:
+        print(
+            f"Coalesce {len(batches)} batch ({', '.join(b for b, _ in batches)}) "
+            f"-> satu refresh MV dengan batch_id {refresh_batch_id}"
+        )
 
     job_name = "refresh_mv.py"
     start_time = datetime.now()
 
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = db.get_connection("mv")
     try:
         with conn.cursor() as cur:
             client_id = get_client_id(cur, client_schema)
@@ -167,48 +199,80 @@ def main():
         error_messages = []
 
         for proc_name in proc_names:
-            is_success, error_message = run_procedure(proc_name, client_schema, batch_id)
+            is_success, error_message = run_procedure(
+                proc_name, client_schema, refresh_batch_id
+            )
             if not is_success:
                 all_success = False
                 error_messages.append(f"{proc_name} gagal: {error_message}")
 
         end_time = datetime.now()
         final_error_msg = "\n".join(error_messages) if error_messages else None
+        status = "SUCCESS" if all_success else "FAILED"
 
-        update_batch_file_with_procs(file_path, proc_names)
-
-        if all_success:
+        for batch_id, file_path in batches:
+            update_batch_file_with_procs(file_path, proc_names, refresh_batch_id)
             insert_job_execution_log(
-                conn, job_name, client_id, "SUCCESS", start_time, end_time, None, file_name, batch_id
+                job_name,
+                client_id,
+                status,
+                start_time,
+                end_time,
+                final_error_msg,
+                os.path.basename(file_path),
+                batch_id,
             )
-            conn.commit()
-            move_file(file_path, client_schema, "refreshed")
-        else:
-            insert_job_execution_log(
-                conn, job_name, client_id, "FAILED", start_time, end_time, final_error_msg, file_name, batch_id
+            dest_path = move_file(
+                file_path, client_schema, "refreshed" if all_success else "failed"
+            )
+            results[file_path] = stage_result(
+                status, batch_id, dest_path, final_error_msg
             )
-            conn.commit()
-            move_file(file_path, client_schema, "failed")
 
     except Exception as e:
         end_time = datetime.now()
-        insert_job_execution_log(
-            conn,
-            job_name,
-            client_id if "client_id" in locals() else None,
-            "FAILED",
-            start_time,
-            end_time,
-            str(e),
-            file_name,
-            batch_id,
-        )
         print(f"Error: {e}")
         conn.rollback()
-        move_file(file_path, client_schema, "failed")
-        sys.exit(1)
+        for batch_id, file_path in batches:
+            if file_path in results:
+                continue
+            insert_job_execution_log(
+                job_name,
+                client_id if "client_id" in locals() else None,
+                "FAILED",
+                start_time,
+                end_time,
+                str(e),
+                os.path.basename(file_path),
+                batch_id,
+            )
+            dest_path = move_file(file_path, client_schema, "failed")
+            results[file_path] = stage_result("FAILED", batch_id, dest_path, str(e))
     finally:
-        conn.close()
+        db.release(conn)
+        log_sink.flush()
+
+    return [results[p] for p in file_paths]
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python refresh_mv.py <client_schema>")
+        sys.exit(1)
+
+    client_schema = sys.argv[1]
+    try:
+        queue = batch_queue.load_batch_queue(client_schema, "archive")
+    except Exception as e:
+        print(f"Error membaca batch file: {e}")
+        sys.exit(1)
+
+    # seluruh antrian cukup satu kali refresh MV
+    print(f"Antrian refresh MV: {len(queue)} batch")
+    results = run_refresh_mv_batches(client_schema, [path for _, _, path in queue])
+    for r in results:
+        print(f"  {r['batch_id']}: {r['status']}")
+    sys.exit(0 if all(r["status"] == "SUCCESS" for r in results) else 1)
 
 
 if __name__ == "__main__":
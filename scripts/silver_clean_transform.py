@@ -1,28 +1,19 @@
 import os
 import sys
 import json
-import psycopg2
 import shutil
 from datetime import datetime
-from dotenv import load_dotenv
 
-
-def load_single_batch_file(client_schema):
-    folder_path = os.path.join("batch_info", client_schema, "incoming")
-    json_files = [f for f in os.listdir(folder_path) if f.lower().endswith('.json')]
-
-    if len(json_files) == 0:
-        raise FileNotFoundError(f"Tidak ada file JSON batch di folder {folder_path}")
-    if len(json_files) > 1:
-        raise RuntimeError(
-            f"Lebih dari 1 file JSON batch ditemukan di folder {folder_path}, harap hanya ada 1 file."
-        )
-
-    file_name = json_files[0]
-    file_path = os.path.join(folder_path, file_name)
-    with open(file_path, "r") as f:
-        data = json.load(f)
-    return data, file_name, file_path
+# db lives in handlers/ (shared DB pools)
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "handlers"
+    ),
+)
+import db  # noqa: E402
+import log_sink  # noqa: E402
+import batch_queue  # noqa: E402
 
 
 def get_client_id(cur, client_schema):
@@ -58,25 +49,75 @@ def get_active_procs(client_id, conn):
         return [row[0] for row in rows]
 
 
-def insert_job_execution_log(
-    conn, job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id
-):
+def get_bronze_batch_status(client_id, batch_ids, conn):
+    """Latest batch-level status batch_processing logged per batch_id: {batch_id: status}."""
     with conn.cursor() as cur:
         cur.execute(
             """
-            INSERT INTO tools.job_execution_log (
-                job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            SELECT DISTINCT ON (batch_id) batch_id, status
+            FROM tools.job_execution_log
+            WHERE client_id = %s
+              AND batch_id = ANY(%s)
+              AND file_name IS NULL
+              AND job_name IN ('Batch Processing Start', 'Batch Processing Restart', 'Batch Reprocessing')
+            ORDER BY batch_id, end_time DESC NULLS LAST
             """,
-            (job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id),
+            (client_id, list(batch_ids)),
         )
-    conn.commit()
+        return dict(cur.fetchall())
+
+
+def select_bronze_success(client_schema, queue):
+    """
+    Keep the queued batches whose bronze run ended SUCCESS. Other JSON stay in
+    incoming/ untouched: restart needs them there. Unreadable JSON stay queued
+    so run_silver_transform records them as FAILED.
+    """
+    batch_ids = [data.get("batch_id") for data, _, _ in queue if data.get("batch_id")]
+    if not batch_ids:
+        return queue
+    conn = db.get_connection("silver")
+    try:
+        with conn.cursor() as cur:
+            client_id = get_client_id(cur, client_schema)
+        statuses = get_bronze_batch_status(client_id, batch_ids, conn)
+    finally:
+        db.release(conn)
+    selected = []
+    for item in queue:
+        batch_id = item[0].get("batch_id")
+        if batch_id and statuses.get(batch_id) != "SUCCESS":
+            print(
+                f"  {batch_id}: dilewati (status bronze {statuses.get(batch_id) or 'tidak ada'}), JSON tetap di incoming"
+            )
+            continue
+        selected.append(item)
+    return selected
+
+
+def insert_job_execution_log(
+    job_name, client_id, status, start_time, end_time, error_message, file_name, batch_id
+):
+    # buffered; log_sink.flush() runs when the stage ends
+    log_sink.record(
+        "job_execution_log",
+        {
+            "job_name": job_name,
+            "client_id": client_id,
+            "status": status,
+            "start_time": start_time,
+            "end_time": end_time,
+            "error_message": error_message,
+            "file_name": file_name,
+            "batch_id": batch_id,
+        },
+    )
 
 
 def run_procedure(proc_name, client_schema, batch_id, client_id):
     proc_conn = None
     try:
-        proc_conn = psycopg2.connect(**DB_CONFIG)
+        proc_conn = db.get_connection("silver")
         proc_conn.autocommit = True
         with proc_conn.cursor() as cur:
             print(f"Menjalankan procedure: {proc_name}({client_schema}, {batch_id})")
@@ -96,7 +137,7 @@ def run_procedure(proc_name, client_schema, batch_id, client_id):
         return False, str(e)
     finally:
         if proc_conn:
-            proc_conn.close()
+            db.release(proc_conn)
 
 
 def update_batch_file_with_procs(file_path, proc_names):
@@ -124,43 +165,48 @@ def move_file(src_path, client_schema, status):
     dest_path = os.path.join(target_folder, file_name)
     shutil.move(src_path, dest_path)
     print(f"File {file_name} dipindah ke {target_folder}")
-
-
-def main():
-    load_dotenv()
-    if len(sys.argv) < 2:
-        print("Usage: python silver_clean_transform.py <client_schema>")
-        sys.exit(1)
-
-    client_schema = sys.argv[1]
-    DB_PORT = os.getenv("DB_PORT")
-    if DB_PORT is None:
-        raise ValueError("DB_PORT not set in .env")
-
-    global DB_CONFIG
-    DB_CONFIG = {
-        "host": os.getenv("DB_HOST"),
-        "port": int(DB_PORT),
-        "dbname": os.getenv("DB_NAME"),
-        "user": os.getenv("DB_USER"),
-        "password": os.getenv("DB_PASSWORD"),
+    return dest_path
+
+
+# -----------------------------
+# Stage API
+# -----------------------------
+def stage_result(status, batch_id, batch_info_path, error=None):
+    """Result of one silver run; batch_info_path is where the JSON ended up."""
+    return {
+        "stage": "silver",
+        "status": status,
+        "batch_id": batch_id,
+        "batch_info_path": batch_info_path,
+        "error": error,
     }
 
+
+def run_silver_transform(client_schema, file_path):
+    """
+    Run the active transformation procedures for the batch JSON at file_path,
+    then move it to success/ or failed/. Returns stage_result(...); never
+    calls sys.exit.
+    """
+    file_name = os.path.basename(file_path)
     try:
-        batch_info, file_name, file_path = load_single_batch_file(client_schema)
+        with open(file_path, "r") as f:
+            batch_info = json.load(f)
     except Exception as e:
         print(f"Error membaca batch file: {e}")
-        sys.exit(1)
+        return stage_result("FAILED", None, file_path, f"Error membaca batch file: {e}")
 
     batch_id = batch_info.get("batch_id")
     if not batch_id:
         print("batch_id tidak ditemukan di file batch info")
-        sys.exit(1)
+        return stage_result(
+            "FAILED", None, file_path, "batch_id tidak ditemukan di file batch info"
+        )
 
     job_name = "silver_clean_transform.py"
     start_time = datetime.now()
 
-    conn = psycopg2.connect(**DB_CONFIG)
+    conn = db.get_connection("silver")
     try:
         with conn.cursor() as cur:
             client_id = get_client_id(cur, client_schema)
@@ -184,21 +230,20 @@ def main():
 
         if all_success:
             insert_job_execution_log(
-                conn, job_name, client_id, "SUCCESS", start_time, end_time, None, file_name, batch_id
+                job_name, client_id, "SUCCESS", start_time, end_time, None, file_name, batch_id
             )
-            conn.commit()
-            move_file(file_path, client_schema, "SUCCESS")
+            dest_path = move_file(file_path, client_schema, "SUCCESS")
+            return stage_result("SUCCESS", batch_id, dest_path)
         else:
             insert_job_execution_log(
-                conn, job_name, client_id, "FAILED", start_time, end_time, final_error_msg, file_name, batch_id
+                job_name, client_id, "FAILED", start_time, end_time, final_error_msg, file_name, batch_id
             )
-            conn.commit()
-            move_file(file_path, client_schema, "FAILED")
+            dest_path = move_file(file_path, client_schema, "FAILED")
+            return stage_result("FAILED", batch_id, dest_path, final_error_msg)
 
     except Exception as e:
         end_time = datetime.now()
         insert_job_execution_log(
-            conn,
             job_name,
             client_id if "client_id" in locals() else None,
             "FAILED",
@@ -210,10 +255,33 @@ def main():
         )
         print(f"Error: {e}")
         conn.rollback()
-        move_file(file_path, client_schema, "FAILED")
-        sys.exit(1)
+        dest_path = move_file(file_path, client_schema, "FAILED")
+        return stage_result("FAILED", batch_id, dest_path, str(e))
     finally:
-        conn.close()
+        db.release(conn)
+        log_sink.flush()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python silver_clean_transform.py <client_schema>")
+        sys.exit(1)
+
+    client_schema = sys.argv[1]
+    try:
+        queue = batch_queue.load_batch_queue(client_schema, "incoming")
+        queue = select_bronze_success(client_schema, queue)
+    except Exception as e:
+        print(f"Error membaca batch file: {e}")
+        sys.exit(1)
+
+    # procedure transformasi per batch (DELETE/INSERT per dwh_batch_id):
+    # antrian diproses satu per satu, urut batch_id
+    print(f"Antrian silver: {len(queue)} batch")
+    results = [run_silver_transform(client_schema, path) for _, _, path in queue]
+    for r in results:
+        print(f"  {r['batch_id']}: {r['status']}")
+    sys.exit(0 if all(r["status"] == "SUCCESS" for r in results) else 1)
 
 
 if __name__ == "__main__":
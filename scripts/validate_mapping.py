@@ -1,33 +1,23 @@
 import os
 import sys
 import re
-import json
 import shutil
-import psycopg2
 import pyarrow.parquet as pq
 import gc
 import time
 import traceback
 from datetime import datetime
-from dotenv import load_dotenv
 
-# load environment variables
-load_dotenv()
-
-# -----------------------------
-# DB config via dotenv
-# -----------------------------
-DB_PORT = os.getenv("DB_PORT")
-if DB_PORT is None:
-    raise ValueError("DB_PORT not set in .env")
-
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST"),
-    "port": int(DB_PORT),
-    "dbname": os.getenv("DB_NAME"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-}
+# manifest_store and db live in handlers/ (shared batch_info backend, DB pools)
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "handlers"
+    ),
+)
+import db  # noqa: E402
+import log_sink  # noqa: E402
+import manifest_store  # noqa: E402
 
 
 # -----------------------------
@@ -35,9 +25,10 @@ DB_CONFIG = {
 # -----------------------------
 def get_connection():
     """
-    Use DB_CONFIG (loaded from .env) to create a psycopg2 connection.
+    Check out a connection from the shared "validate" pool; give it back with
+    db.release(conn).
     """
-    return psycopg2.connect(**DB_CONFIG)
+    return db.get_connection("validate")
 
 
 def extract_batch_id(filename: str):
@@ -58,13 +49,6 @@ def normalize_name(s: str):
     return base
 
 
-def find_file_entry(batch_info: dict, physical_file_name: str):
-    for f in batch_info.get("files", []):
-        if f.get("physical_file_name") == physical_file_name:
-            return f
-    return None
-
-
 def safe_move(src: str, dst: str, retries: int = 5, retry_delay: float = 0.25):
     """
     Robust move:
@@ -148,7 +132,6 @@ def get_column_mapping_columns(
 
 
 def update_file_audit_mapping_status(
-    conn,
     client_id,
     physical_file_name,
     source_system,
@@ -156,33 +139,24 @@ def update_file_audit_mapping_status(
     logical_source_file,
     batch_id,
     status,
+    file_audit_id=None,
+    file_received_time=None,
 ):
-    cur = conn.cursor()
-    sql = (
-        "UPDATE tools.file_audit_log SET mapping_validation_status = %s "
-        "WHERE client_id = %s AND physical_file_name = %s AND source_system = %s "
-        "AND source_type = %s AND logical_source_file = %s AND batch_id = %s"
-    )
-    cur.execute(
-        sql,
-        (
-            status,
-            client_id,
-            physical_file_name,
-            source_system,
-            source_type,
-            logical_source_file,
-            batch_id,
-        ),
+    # buffered; written by log_sink.flush() when the stage ends
+    log_sink.update_file_audit(
+        client_id,
+        physical_file_name,
+        source_system,
+        source_type,
+        logical_source_file,
+        batch_id,
+        file_audit_id=file_audit_id,
+        file_received_time=file_received_time,
+        mapping_validation_status=status,
     )
-    affected = cur.rowcount
-    conn.commit()
-    cur.close()
-    return affected
 
 
 def insert_job_execution_log(
-    conn,
     client_id,
     job_name,
     status,
@@ -192,75 +166,80 @@ def insert_job_execution_log(
     start_time,
     end_time,
 ):
-    cur = conn.cursor()
-    sql = (
-        "INSERT INTO tools.job_execution_log "
-        "(client_id, job_name, status, error_message, file_name, batch_id, start_time, end_time) "
-        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
-    )
-    cur.execute(
-        sql,
-        (
-            client_id,
-            job_name,
-            status,
-            error_message,
-            file_name,
-            batch_id,
-            start_time,
-            end_time,
-        ),
+    log_sink.record(
+        "job_execution_log",
+        {
+            "client_id": client_id,
+            "job_name": job_name,
+            "status": status,
+            "error_message": error_message,
+            "file_name": file_name,
+            "batch_id": batch_id,
+            "start_time": start_time,
+            "end_time": end_time,
+        },
     )
-    conn.commit()
-    cur.close()
 
 
 def insert_mapping_validation_log(
-    conn, client_id, missing, extra, expected, received, file_name, batch_id
+    client_id, missing, extra, expected, received, file_name, batch_id
 ):
-    cur = conn.cursor()
-    sql = (
-        "INSERT INTO tools.mapping_validation_log "
-        "(client_id, missing_columns, extra_columns, expected_columns, received_columns, file_name, batch_id) "
-        "VALUES (%s, %s, %s, %s, %s, %s, %s)"
-    )
-    cur.execute(
-        sql,
-        (
-            client_id,
-            missing,
-            extra,
-            expected,
-            received,
-            file_name,
-            batch_id,
-        ),
+    log_sink.record(
+        "mapping_validation_log",
+        {
+            "client_id": client_id,
+            "missing_columns": missing,
+            "extra_columns": extra,
+            "expected_columns": expected,
+            "received_columns": received,
+            "file_name": file_name,
+            "batch_id": batch_id,
+        },
     )
-    conn.commit()
-    cur.close()
 
 
 # -----------------------------
-# Main
+# Stage API
 # -----------------------------
-def main():
-    if len(sys.argv) != 3:
-        print("Usage: python validate_mapping.py <client_schema> <physical_file_name>")
-        sys.exit(2)
-
-    client_schema = sys.argv[1]
-    physical_file_name = sys.argv[2]
+def stage_result(status, physical_file_name, error=None, **extra):
+    """
+    Structured result returned by run_validate_mapping (same shape as the other stages).
+    """
+    result = {
+        "stage": "validate_mapping",
+        "status": status,
+        "physical_file_name": physical_file_name,
+        "parquet_name": None,
+        "parquet_path": None,
+        "total_rows": None,
+        "error": error,
+    }
+    result.update(extra)
+    return result
+
+
+def run_validate_mapping(client_schema, physical_file_name):
+    """
+    Compare the Parquet schema of a batch file with tools.column_mapping.
+    On mismatch the Parquet is moved to data/<client>/<ss>/failed.
+    Returns stage_result(...); never calls sys.exit.
+    """
     start_time = datetime.now()
     job_name = "Mapping Validation"
 
-    # <<< ensure pf exists in all branches by initializing early >>>
+    # <<< ensure pf/conn exist in all branches by initializing early >>>
     pf = None
+    conn = None
 
     # extract batch id
     batch_id = extract_batch_id(physical_file_name)
     if not batch_id:
         print(f"❌ Cannot extract batch_id from file name: {physical_file_name}")
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"Cannot extract batch_id from file name: {physical_file_name}",
+        )
 
     batch_info_path = os.path.join(
         "batch_info",
@@ -268,34 +247,47 @@ def main():
         "incoming",
         f"batch_output_{client_schema}_{batch_id}.json",
     )
-    if not os.path.exists(batch_info_path):
+    try:
+        batch_info, file_entry = manifest_store.load_file_entry(
+            client_schema, batch_id, physical_file_name, batch_info_path
+        )
+    except Exception as e:
+        print(f"❌ Failed to load batch_info: {e}")
+        traceback.print_exc()
+        return stage_result(
+            "FAILED", physical_file_name, f"Failed to load batch_info: {e}"
+        )
+    if batch_info is None:
         print(f"❌ Batch info not found: {batch_info_path}")
-        sys.exit(1)
-
-    with open(batch_info_path, "r") as bf:
-        try:
-            batch_info = json.load(bf)
-        except Exception as e:
-            print(f"❌ Failed to parse batch_info: {e}")
-            traceback.print_exc()
-            sys.exit(1)
+        return stage_result(
+            "FAILED", physical_file_name, f"Batch info not found: {batch_info_path}"
+        )
 
-    file_entry = find_file_entry(batch_info, physical_file_name)
     if not file_entry:
         print(
             f"❌ File {physical_file_name} not found inside batch_info {batch_info_path}"
         )
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"File {physical_file_name} not found inside batch_info {batch_info_path}",
+        )
 
     parquet_name = file_entry.get("parquet_name")
     logical_source_file = file_entry.get("logical_source_file")
     source_system = (file_entry.get("source_system") or "").lower()
     source_type = (file_entry.get("source_type") or "").lower()
+    file_audit_id = file_entry.get("file_audit_id")
+    file_received_time = file_entry.get("file_received_time")
     client_id = batch_info.get("client_id")
 
     if client_id is None:
         print(f"❌ client_id not found in batch_info {batch_info_path}")
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"client_id not found in batch_info {batch_info_path}",
+        )
 
     if not parquet_name:
         print(
@@ -303,9 +295,7 @@ def main():
         )
         # log failed job
         try:
-            conn = get_connection()
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -331,34 +321,32 @@ def main():
             except Exception:
                 pass
             move_parquet_to_failed(parquet_path, client_schema, source_system)
-            conn.close()
         except Exception:
             pass
-        sys.exit(1)
+        return stage_result("FAILED", physical_file_name, "parquet_name_missing")
 
     parquet_path = os.path.join(
         "data", client_schema, source_system, "incoming", parquet_name
     )
     if not os.path.exists(parquet_path):
         print(f"❌ Parquet not found: {parquet_path}")
-        try:
-            conn = get_connection()
-            insert_job_execution_log(
-                conn,
-                client_id,
-                job_name,
-                "FAILED",
-                f"parquet_missing:{parquet_path}",
-                physical_file_name,
-                batch_id,
-                start_time,
-                datetime.now(),
-            )
-            # cannot move because file missing
-            conn.close()
-        except Exception:
-            pass
-        sys.exit(1)
+        # cannot move because file missing
+        insert_job_execution_log(
+            client_id,
+            job_name,
+            "FAILED",
+            f"parquet_missing:{parquet_path}",
+            physical_file_name,
+            batch_id,
+            start_time,
+            datetime.now(),
+        )
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"parquet_missing:{parquet_path}",
+            parquet_name=parquet_name,
+        )
 
     # read parquet schema
     try:
@@ -368,9 +356,7 @@ def main():
         print(f"❌ Failed to read parquet schema: {e}")
         traceback.print_exc()
         try:
-            conn = get_connection()
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -388,15 +374,19 @@ def main():
             except Exception:
                 pass
             move_parquet_to_failed(parquet_path, client_schema, source_system)
-            conn.close()
         except Exception:
             pass
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"parquet_read_error:{e}",
+            parquet_name=parquet_name,
+        )
 
     # normalize parquet column names
     normalized_parquet_cols = set([normalize_name(c) for c in parquet_cols])
 
-    # fetch mapping from DB
+    # fetch mapping from DB (the only query; logging goes through log_sink)
     try:
         conn = get_connection()
         cur = conn.cursor()
@@ -407,40 +397,37 @@ def main():
     except Exception as e:
         print(f"❌ Failed to fetch column mapping from DB: {e}")
         traceback.print_exc()
+        insert_job_execution_log(
+            client_id,
+            job_name,
+            "FAILED",
+            f"db_error:{e}",
+            physical_file_name,
+            batch_id,
+            start_time,
+            datetime.now(),
+        )
+        # do NOT move parquet here — DB errors may be transient; but release pf if planning to move
         try:
-            if conn:
-                insert_job_execution_log(
-                    conn,
-                    client_id,
-                    job_name,
-                    "FAILED",
-                    f"db_error:{e}",
-                    physical_file_name,
-                    batch_id,
-                    start_time,
-                    datetime.now(),
-                )
-                # do NOT move parquet here — DB errors may be transient; but release pf if planning to move
-                try:
-                    if pf is not None:
-                        pf = None
-                    gc.collect()
-                except Exception:
-                    pass
-                conn.close()
+            if pf is not None:
+                pf = None
+            gc.collect()
         except Exception:
             pass
-        sys.exit(1)
+        return stage_result(
+            "FAILED", physical_file_name, f"db_error:{e}", parquet_name=parquet_name
+        )
+    finally:
+        db.release(conn)
 
     if not mapping_cols:
         # no mapping found
         print("❌ Column Mapping Not Found")
         try:
             insert_mapping_validation_log(
-                conn, client_id, "", "", "", "", physical_file_name, batch_id
+                client_id, "", "", "", "", physical_file_name, batch_id
             )
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -453,7 +440,6 @@ def main():
             # update file_audit_log as FAILED
             try:
                 update_file_audit_mapping_status(
-                    conn,
                     client_id,
                     physical_file_name,
                     source_system,
@@ -461,6 +447,8 @@ def main():
                     logical_source_file,
                     batch_id,
                     "FAILED",
+                    file_audit_id=file_audit_id,
+                    file_received_time=file_received_time,
                 )
             except Exception:
                 pass
@@ -472,10 +460,14 @@ def main():
             except Exception:
                 pass
             move_parquet_to_failed(parquet_path, client_schema, source_system)
-            conn.close()
         except Exception:
             pass
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            "Column Mapping Not Found",
+            parquet_name=parquet_name,
+        )
 
     normalized_mapping_cols = set([normalize_name(c) for c in mapping_cols])
 
@@ -495,7 +487,6 @@ def main():
         print("❌ Validation failed:", error_message)
         try:
             insert_mapping_validation_log(
-                conn,
                 client_id,
                 missing_csv,
                 extra_csv,
@@ -508,8 +499,7 @@ def main():
             print(f"⚠️ Failed to insert mapping_validation_log: {e}")
             traceback.print_exc()
         try:
-            affected = update_file_audit_mapping_status(
-                conn,
+            update_file_audit_mapping_status(
                 client_id,
                 physical_file_name,
                 source_system,
@@ -517,17 +507,14 @@ def main():
                 logical_source_file,
                 batch_id,
                 "FAILED",
+                file_audit_id=file_audit_id,
+                file_received_time=file_received_time,
             )
-            if affected == 0:
-                print(
-                    "⚠️ Warning: file_audit_log update affected 0 rows (no exact match)."
-                )
         except Exception as e:
             print(f"⚠️ Failed to update file_audit_log: {e}")
             traceback.print_exc()
         try:
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 status,
@@ -551,13 +538,13 @@ def main():
             move_parquet_to_failed(parquet_path, client_schema, source_system)
         except Exception:
             pass
-        conn.close()
-        sys.exit(1)
+        return stage_result(
+            "FAILED", physical_file_name, error_message, parquet_name=parquet_name
+        )
 
     # success
     try:
-        affected = update_file_audit_mapping_status(
-            conn,
+        update_file_audit_mapping_status(
             client_id,
             physical_file_name,
             source_system,
@@ -565,15 +552,14 @@ def main():
             logical_source_file,
             batch_id,
             "SUCCESS",
+            file_audit_id=file_audit_id,
+            file_received_time=file_received_time,
         )
-        if affected == 0:
-            print("⚠️ Warning: file_audit_log update affected 0 rows (no exact match).")
     except Exception as e:
         print(f"⚠️ Failed to update file_audit_log: {e}")
 
     try:
         insert_job_execution_log(
-            conn,
             client_id,
             job_name,
             "SUCCESS",
@@ -586,14 +572,25 @@ def main():
     except Exception as e:
         print(f"⚠️ Failed to insert job_execution_log: {e}")
 
-    # close connection
-    try:
-        conn.close()
-    except Exception:
-        pass
-
     print("✅ Validation passed: Parquet schema matches column mapping.")
-    sys.exit(0)
+    return stage_result(
+        "SUCCESS",
+        physical_file_name,
+        parquet_name=parquet_name,
+        parquet_path=parquet_path,
+    )
+
+
+# -----------------------------
+# Main
+# -----------------------------
+def main():
+    if len(sys.argv) != 3:
+        print("Usage: python validate_mapping.py <client_schema> <physical_file_name>")
+        sys.exit(2)
+
+    result = run_validate_mapping(sys.argv[1], sys.argv[2])
+    sys.exit(0 if result["status"] == "SUCCESS" else 1)
 
 
 if __name__ == "__main__":
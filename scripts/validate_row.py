@@ -1,32 +1,21 @@
 import os
 import sys
 import re
-import json
 import duckdb
-import psycopg2
 import pyarrow.parquet as pq
 import gc
 from datetime import datetime
-from dotenv import load_dotenv
 
-
-# load environment variables
-load_dotenv()
-
-# -----------------------------
-# DB config via dotenv
-# -----------------------------
-DB_PORT = os.getenv("DB_PORT")
-if DB_PORT is None:
-    raise ValueError("DB_PORT not set in .env")
-
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST"),
-    "port": int(DB_PORT),
-    "dbname": os.getenv("DB_NAME"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-}
+# manifest_store and db live in handlers/ (shared batch_info backend, DB pools)
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "handlers"
+    ),
+)
+import db  # noqa: E402
+import log_sink  # noqa: E402
+import manifest_store  # noqa: E402
 
 
 # -----------------------------
@@ -34,9 +23,10 @@ DB_CONFIG = {
 # -----------------------------
 def get_connection():
     """
-    Use DB_CONFIG (loaded from .env) to create a psycopg2 connection.
+    Check out a connection from the shared "validate" pool; give it back with
+    db.release(conn).
     """
-    return psycopg2.connect(**DB_CONFIG)
+    return db.get_connection("validate")
 
 
 def extract_batch_id(filename: str):
@@ -69,7 +59,6 @@ def get_required_columns(
 
 
 def update_file_audit_row_validation_status(
-    conn,
     client_id,
     physical_file_name,
     source_system,
@@ -77,33 +66,24 @@ def update_file_audit_row_validation_status(
     logical_source_file,
     batch_id,
     status,
+    file_audit_id=None,
+    file_received_time=None,
 ):
-    cur = conn.cursor()
-    sql = (
-        "UPDATE tools.file_audit_log SET row_validation_status = %s "
-        "WHERE client_id = %s AND physical_file_name = %s AND source_system = %s "
-        "AND source_type = %s AND logical_source_file = %s AND batch_id = %s"
-    )
-    cur.execute(
-        sql,
-        (
-            status,
-            client_id,
-            physical_file_name,
-            source_system,
-            source_type,
-            logical_source_file,
-            batch_id,
-        ),
+    # buffered; written by log_sink.flush() when the stage ends
+    log_sink.update_file_audit(
+        client_id,
+        physical_file_name,
+        source_system,
+        source_type,
+        logical_source_file,
+        batch_id,
+        file_audit_id=file_audit_id,
+        file_received_time=file_received_time,
+        row_validation_status=status,
     )
-    affected = cur.rowcount
-    conn.commit()
-    cur.close()
-    return affected
 
 
 def insert_job_execution_log(
-    conn,
     client_id,
     job_name,
     status,
@@ -113,43 +93,35 @@ def insert_job_execution_log(
     start_time,
     end_time,
 ):
-    cur = conn.cursor()
-    sql = (
-        "INSERT INTO tools.job_execution_log "
-        "(client_id, job_name, status, error_message, file_name, batch_id, start_time, end_time) "
-        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
-    )
-    cur.execute(
-        sql,
-        (
-            client_id,
-            job_name,
-            status,
-            error_message,
-            file_name,
-            batch_id,
-            start_time,
-            end_time,
-        ),
+    log_sink.record(
+        "job_execution_log",
+        {
+            "client_id": client_id,
+            "job_name": job_name,
+            "status": status,
+            "error_message": error_message,
+            "file_name": file_name,
+            "batch_id": batch_id,
+            "start_time": start_time,
+            "end_time": end_time,
+        },
     )
-    conn.commit()
-    cur.close()
 
 
 def insert_row_validation_log(
-    conn, client_id, file_name, column_name, error_type, error_detail, batch_id
+    client_id, file_name, column_name, error_type, error_detail, batch_id
 ):
-    cur = conn.cursor()
-    sql = (
-        "INSERT INTO tools.row_validation_log "
-        "(client_id, file_name, column_name, error_type, error_detail, batch_id) "
-        "VALUES (%s, %s, %s, %s, %s, %s)"
-    )
-    cur.execute(
-        sql, (client_id, file_name, column_name, error_type, error_detail, batch_id)
+    log_sink.record(
+        "row_validation_log",
+        {
+            "client_id": client_id,
+            "file_name": file_name,
+            "column_name": column_name,
+            "error_type": error_type,
+            "error_detail": error_detail,
+            "batch_id": batch_id,
+        },
     )
-    conn.commit()
-    cur.close()
 
 
 # -----------------------------
@@ -174,23 +146,41 @@ def build_normalized_expr(col_identifier: str) -> str:
 
 
 # -----------------------------
-# Main
+# Stage API
 # -----------------------------
-
-def main():
-    if len(sys.argv) != 3:
-        print("Usage: python validate_row.py <client_schema> <physical_file_name>")
-        sys.exit(2)
-
-    client_schema = sys.argv[1]
-    physical_file_name = sys.argv[2]
+def stage_result(status, physical_file_name, error=None, **extra):
+    """
+    Structured result returned by run_validate_row (same shape as the other stages).
+    """
+    result = {
+        "stage": "validate_row",
+        "status": status,
+        "physical_file_name": physical_file_name,
+        "parquet_name": None,
+        "parquet_path": None,
+        "total_rows": None,
+        "error": error,
+    }
+    result.update(extra)
+    return result
+
+
+def run_validate_row(client_schema, physical_file_name):
+    """
+    Null / duplicate checks (DuckDB) on the required columns of a batch Parquet.
+    Returns stage_result(...); never calls sys.exit.
+    """
     start_time = datetime.now()
     job_name = "Row Validation"
 
     batch_id = extract_batch_id(physical_file_name)
     if not batch_id:
         print(f"❌ Cannot extract batch_id from file name: {physical_file_name}")
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"Cannot extract batch_id from file name: {physical_file_name}",
+        )
 
     batch_info_path = os.path.join(
         "batch_info",
@@ -198,83 +188,84 @@ def main():
         "incoming",
         f"batch_output_{client_schema}_{batch_id}.json",
     )
-    if not os.path.exists(batch_info_path):
+    try:
+        batch_info, file_entry = manifest_store.load_file_entry(
+            client_schema, batch_id, physical_file_name, batch_info_path
+        )
+    except Exception as e:
+        print(f"❌ Failed to load batch_info: {e}")
+        return stage_result(
+            "FAILED", physical_file_name, f"Failed to load batch_info: {e}"
+        )
+    if batch_info is None:
         print(f"❌ Batch info not found: {batch_info_path}")
-        sys.exit(1)
-
-    with open(batch_info_path, "r") as bf:
-        try:
-            batch_info = json.load(bf)
-        except Exception as e:
-            print(f"❌ Failed to parse batch_info: {e}")
-            sys.exit(1)
-
-    file_entry = None
-    for f in batch_info.get("files", []):
-        if f.get("physical_file_name") == physical_file_name:
-            file_entry = f
-            break
+        return stage_result(
+            "FAILED", physical_file_name, f"Batch info not found: {batch_info_path}"
+        )
 
     if not file_entry:
         print(
             f"❌ File {physical_file_name} not found inside batch_info {batch_info_path}"
         )
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"File {physical_file_name} not found inside batch_info {batch_info_path}",
+        )
 
     parquet_name = file_entry.get("parquet_name")
     logical_source_file = file_entry.get("logical_source_file")
     source_system = (file_entry.get("source_system") or "").lower()
     source_type = (file_entry.get("source_type") or "").lower()
+    file_audit_id = file_entry.get("file_audit_id")
+    file_received_time = file_entry.get("file_received_time")
     client_id = batch_info.get("client_id")
 
     if client_id is None:
         print(f"❌ client_id not found in batch_info {batch_info_path}")
-        sys.exit(1)
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"client_id not found in batch_info {batch_info_path}",
+        )
 
     if not parquet_name:
         print(
             f"❌ parquet_name not present in batch_info for file {physical_file_name}. Has convert step run?"
         )
-        try:
-            conn = get_connection()
-            insert_job_execution_log(
-                conn,
-                client_id,
-                job_name,
-                "FAILED",
-                "parquet_name_missing",
-                physical_file_name,
-                batch_id,
-                start_time,
-                datetime.now(),
-            )
-            conn.close()
-        except Exception:
-            pass
-        sys.exit(1)
+        insert_job_execution_log(
+            client_id,
+            job_name,
+            "FAILED",
+            "parquet_name_missing",
+            physical_file_name,
+            batch_id,
+            start_time,
+            datetime.now(),
+        )
+        return stage_result("FAILED", physical_file_name, "parquet_name_missing")
 
     parquet_path = os.path.join(
         "data", client_schema, source_system, "incoming", parquet_name
     )
     if not os.path.exists(parquet_path):
         print(f"❌ Parquet not found: {parquet_path}")
-        try:
-            conn = get_connection()
-            insert_job_execution_log(
-                conn,
-                client_id,
-                job_name,
-                "FAILED",
-                f"parquet_missing:{parquet_path}",
-                physical_file_name,
-                batch_id,
-                start_time,
-                datetime.now(),
-            )
-            conn.close()
-        except Exception:
-            pass
-        sys.exit(1)
+        insert_job_execution_log(
+            client_id,
+            job_name,
+            "FAILED",
+            f"parquet_missing:{parquet_path}",
+            physical_file_name,
+            batch_id,
+            start_time,
+            datetime.now(),
+        )
+        return stage_result(
+            "FAILED",
+            physical_file_name,
+            f"parquet_missing:{parquet_path}",
+            parquet_name=parquet_name,
+        )
 
     # prepare resources
     conn = None
@@ -290,11 +281,14 @@ def main():
             cur, client_id, logical_source_file, source_system, source_type
         )
         cur.close()
+        cur = None
+        # the checks below run in DuckDB; logging goes through log_sink
+        db.release(conn)
+        conn = None
 
         if not required_cols:
             print("❌ Required Columns Not Found")
             insert_row_validation_log(
-                conn,
                 client_id,
                 parquet_name,
                 None,
@@ -303,7 +297,6 @@ def main():
                 batch_id,
             )
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -314,7 +307,6 @@ def main():
                 datetime.now(),
             )
             update_file_audit_row_validation_status(
-                conn,
                 client_id,
                 physical_file_name,
                 source_system,
@@ -322,8 +314,15 @@ def main():
                 logical_source_file,
                 batch_id,
                 "FAILED",
+                file_audit_id=file_audit_id,
+                file_received_time=file_received_time,
+            )
+            return stage_result(
+                "FAILED",
+                physical_file_name,
+                "Required Columns Not Found",
+                parquet_name=parquet_name,
             )
-            sys.exit(1)
 
         # Map normalized required -> actual parquet column names (use pyarrow to list columns)
         try:
@@ -333,7 +332,6 @@ def main():
             msg = f"Failed to read parquet schema for mapping: {e}"
             print(f"❌ {msg}")
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -343,7 +341,12 @@ def main():
                 start_time,
                 datetime.now(),
             )
-            sys.exit(1)
+            return stage_result(
+                "FAILED",
+                physical_file_name,
+                f"parquet_schema_error:{e}",
+                parquet_name=parquet_name,
+            )
 
         normalized_parquet_map = {normalize_name(c): c for c in parquet_actual_cols}
 
@@ -361,7 +364,6 @@ def main():
             msg = "Required columns missing in parquet: " + ",".join(missing_required_cols)
             print(f"❌ {msg}")
             insert_row_validation_log(
-                conn,
                 client_id,
                 parquet_name,
                 ",".join(missing_norm),
@@ -370,7 +372,6 @@ def main():
                 batch_id,
             )
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "FAILED",
@@ -381,7 +382,6 @@ def main():
                 datetime.now(),
             )
             update_file_audit_row_validation_status(
-                conn,
                 client_id,
                 physical_file_name,
                 source_system,
@@ -389,8 +389,12 @@ def main():
                 logical_source_file,
                 batch_id,
                 "FAILED",
+                file_audit_id=file_audit_id,
+                file_received_time=file_received_time,
+            )
+            return stage_result(
+                "FAILED", physical_file_name, msg, parquet_name=parquet_name
             )
-            sys.exit(1)
 
         actual_required_cols_in_parquet = [required_to_actual[normalize_name(c)] for c in required_cols]
 
@@ -439,7 +443,6 @@ def main():
             print(f"❌ {error_detail}")
             try:
                 insert_row_validation_log(
-                    conn,
                     client_id,
                     parquet_name,
                     ",".join([normalize_name(c) for c in required_cols]),
@@ -450,8 +453,7 @@ def main():
             except Exception as e:
                 print(f"⚠️ Failed to insert row_validation_log: {e}")
             try:
-                affected = update_file_audit_row_validation_status(
-                    conn,
+                update_file_audit_row_validation_status(
                     client_id,
                     physical_file_name,
                     source_system,
@@ -459,14 +461,13 @@ def main():
                     logical_source_file,
                     batch_id,
                     "FAILED",
+                    file_audit_id=file_audit_id,
+                    file_received_time=file_received_time,
                 )
-                if affected == 0:
-                    print("⚠️ Warning: file_audit_log update affected 0 rows (no exact match).")
             except Exception as e:
                 print(f"⚠️ Failed to update file_audit_log: {e}")
             try:
                 insert_job_execution_log(
-                    conn,
                     client_id,
                     job_name,
                     status,
@@ -478,12 +479,13 @@ def main():
                 )
             except Exception as e:
                 print(f"⚠️ Failed to insert job_execution_log: {e}")
-            sys.exit(1)
+            return stage_result(
+                "FAILED", physical_file_name, error_detail, parquet_name=parquet_name
+            )
 
         # success
         try:
-            affected = update_file_audit_row_validation_status(
-                conn,
+            update_file_audit_row_validation_status(
                 client_id,
                 physical_file_name,
                 source_system,
@@ -491,15 +493,14 @@ def main():
                 logical_source_file,
                 batch_id,
                 "SUCCESS",
+                file_audit_id=file_audit_id,
+                file_received_time=file_received_time,
             )
-            if affected == 0:
-                print("⚠️ Warning: file_audit_log update affected 0 rows (no exact match).")
         except Exception as e:
             print(f"⚠️ Failed to update file_audit_log: {e}")
 
         try:
             insert_job_execution_log(
-                conn,
                 client_id,
                 job_name,
                 "SUCCESS",
@@ -513,30 +514,28 @@ def main():
             print(f"⚠️ Failed to insert job_execution_log: {e}")
 
         print("✅ Row validation passed: no nulls or duplicates on required columns.")
-        sys.exit(0)
+        return stage_result(
+            "SUCCESS",
+            physical_file_name,
+            parquet_name=parquet_name,
+            parquet_path=parquet_path,
+        )
 
     except Exception as e:
         print(f"❌ Error in validate_row: {e}")
-        try:
-            if conn:
-                insert_job_execution_log(
-                    conn,
-                    client_id,
-                    job_name,
-                    "FAILED",
-                    f"error:{e}",
-                    parquet_name,
-                    batch_id,
-                    start_time,
-                    datetime.now(),
-                )
-                try:
-                    conn.close()
-                except Exception:
-                    pass
-        except Exception:
-            pass
-        sys.exit(1)
+        insert_job_execution_log(
+            client_id,
+            job_name,
+            "FAILED",
+            f"error:{e}",
+            parquet_name,
+            batch_id,
+            start_time,
+            datetime.now(),
+        )
+        return stage_result(
+            "FAILED", physical_file_name, f"error:{e}", parquet_name=parquet_name
+        )
 
     finally:
         # ensure resources are released — important on Windows where open file handles block moves
@@ -572,12 +571,24 @@ def main():
         try:
             if conn:
                 try:
-                    conn.close()
+                    db.release(conn)
                 except Exception:
                     pass
         except Exception:
             pass
 
 
+# -----------------------------
+# Main
+# -----------------------------
+def main():
+    if len(sys.argv) != 3:
+        print("Usage: python validate_row.py <client_schema> <physical_file_name>")
+        sys.exit(2)
+
+    result = run_validate_row(sys.argv[1], sys.argv[2])
+    sys.exit(0 if result["status"] == "SUCCESS" else 1)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,17 @@
+-- ============================================
+-- FILE AUDIT: CONTENT HASH (intake dedup)
+-- ============================================
+-- Migrasi satu kali (idempotent). batch_processing menyimpan hash isi file
+-- (BLAKE2b-256, hex) saat intake `start`; file dengan hash yang sama dengan
+-- file yang sudah sukses di-load untuk logical_source_file yang sama memakai
+-- ulang Parquet arsipnya atau dilewati (env DEDUP_POLICY).
+
+ALTER TABLE tools.file_audit_log
+    ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);
+
+-- find_loaded_duplicate: WHERE client_id, logical_source_file, content_hash,
+-- load_status = 'SUCCESS' ORDER BY file_received_time DESC LIMIT 1
+CREATE INDEX IF NOT EXISTS idx_file_audit_log_content_hash
+    ON tools.file_audit_log (client_id, logical_source_file, content_hash, file_received_time DESC)
+    INCLUDE (batch_id, physical_file_name, source_system)
+    WHERE content_hash IS NOT NULL AND load_status = 'SUCCESS';
@@ -0,0 +1,230 @@
+-- ============================================
+-- LOG TABLES: MONTHLY PARTITIONS + INDEXES
+-- ============================================
+-- Migrasi satu kali (idempotent; tabel yang sudah dipartisi dilewati).
+-- Tabel log diubah menjadi tabel partisi RANGE bulanan pada kolom waktunya:
+--   file_audit_log      -> file_received_time
+--   job_execution_log   -> start_time
+--   integration_log     -> start_time
+--   mv_refresh_log      -> start_time
+--   transformation_log  -> "timestamp"
+--   row_validation_log  -> "timestamp"
+-- Partisi bernama <tabel>_pYYYYMM, ditambah <tabel>_default untuk baris di luar
+-- rentang. Partisi bulan berikutnya dibuat (dan partisi lama di-detach/drop)
+-- oleh scripts/log_retention.py; jalankan bulanan (cron).
+--
+-- Primary key menjadi (id, kolom waktu): PostgreSQL mewajibkan kolom partisi
+-- ada di setiap unique constraint. Kolom waktu dibuat NOT NULL DEFAULT
+-- CURRENT_TIMESTAMP; baris lama yang NULL diisi waktu migrasi.
+-- Akibatnya lookup hanya dengan id tidak bisa di-prune: index setiap partisi
+-- (termasuk default) diperiksa. Pipeline karena itu menyimpan pasangan
+-- (file_audit_id, file_received_time) di manifest saat intake dan UPDATE
+-- status file_audit_log memakai keduanya (satu partisi).
+-- Seluruh file berjalan dalam satu transaksi; view yang bergantung pada tabel
+-- log harus di-drop dulu dan dibuat ulang setelahnya.
+
+BEGIN;
+
+-- Buat partisi bulanan p_months ke depan mulai bulan p_from. Baris yang sudah
+-- terlanjur masuk partisi default untuk bulan tsb. dipindah ke partisi baru.
+-- Return: jumlah partisi yang dibuat.
+CREATE OR REPLACE FUNCTION tools.create_log_partitions(
+    p_table  TEXT,
+    p_from   DATE,
+    p_months INTEGER
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_key     TEXT;
+    v_start   DATE := date_trunc('month', p_from)::date;
+    v_end     DATE;
+    v_name    TEXT;
+    v_created INTEGER := 0;
+BEGIN
+    SELECT a.attname
+    INTO v_key
+    FROM pg_partitioned_table pt
+    JOIN pg_attribute a
+      ON a.attrelid = pt.partrelid
+     AND a.attnum = pt.partattrs[0]
+    WHERE pt.partrelid = to_regclass(format('tools.%I', p_table));
+
+    IF v_key IS NULL THEN
+        RAISE EXCEPTION 'tools.% bukan tabel partisi', p_table;
+    END IF;
+
+    FOR i IN 1 .. p_months LOOP
+        v_end := (v_start + INTERVAL '1 month')::date;
+        v_name := format('%s_p%s', p_table, to_char(v_start, 'YYYYMM'));
+
+        IF to_regclass(format('tools.%I', v_name)) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE tools.%I (LIKE tools.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                v_name, p_table
+            );
+            IF to_regclass(format('tools.%I', p_table || '_default')) IS NOT NULL THEN
+                EXECUTE format(
+                    'WITH moved AS (DELETE FROM tools.%I WHERE %I >= %L AND %I < %L RETURNING *) '
+                    'INSERT INTO tools.%I SELECT * FROM moved',
+                    p_table || '_default', v_key, v_start, v_key, v_end, v_name
+                );
+            END IF;
+            EXECUTE format(
+                'ALTER TABLE tools.%I ATTACH PARTITION tools.%I FOR VALUES FROM (%L) TO (%L)',
+                p_table, v_name, v_start, v_end
+            );
+            v_created := v_created + 1;
+        END IF;
+
+        v_start := v_end;
+    END LOOP;
+
+    RETURN v_created;
+END;
+$$;
+
+-- Ubah satu tabel log menjadi tabel partisi bulanan pada p_key, salin isinya,
+-- lalu drop tabel lama. Sequence id dan foreign key dipertahankan.
+CREATE OR REPLACE PROCEDURE tools.partition_log_table(
+    p_table        TEXT,
+    p_key          TEXT,
+    p_months_ahead INTEGER DEFAULT 3
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_old    TEXT := p_table || '_unpartitioned';
+    v_oldreg REGCLASS;
+    v_id     TEXT;
+    v_seq    TEXT;
+    v_min    DATE;
+    v_months INTEGER;
+    r        RECORD;
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_partitioned_table
+        WHERE partrelid = to_regclass(format('tools.%I', p_table))
+    ) THEN
+        RAISE NOTICE 'tools.% sudah dipartisi, dilewati', p_table;
+        RETURN;
+    END IF;
+
+    SELECT a.attname
+    INTO v_id
+    FROM pg_index i
+    JOIN pg_attribute a
+      ON a.attrelid = i.indrelid
+     AND a.attnum = i.indkey[0]
+    WHERE i.indrelid = to_regclass(format('tools.%I', p_table))
+      AND i.indisprimary;
+
+    v_seq := pg_get_serial_sequence(format('tools.%I', p_table), v_id);
+
+    -- lepas nama constraint/index dari tabel lama agar bisa dipakai tabel baru
+    EXECUTE format('ALTER TABLE tools.%I RENAME TO %I', p_table, v_old);
+    v_oldreg := to_regclass(format('tools.%I', v_old));
+    FOR r IN
+        SELECT conname FROM pg_constraint
+        WHERE conrelid = v_oldreg AND contype IN ('p', 'u')
+    LOOP
+        EXECUTE format(
+            'ALTER TABLE tools.%I RENAME CONSTRAINT %I TO %I',
+            v_old, r.conname, left(r.conname, 40) || '_unpartitioned'
+        );
+    END LOOP;
+
+    EXECUTE format(
+        'UPDATE tools.%I SET %I = CURRENT_TIMESTAMP WHERE %I IS NULL',
+        v_old, p_key, p_key
+    );
+
+    EXECUTE format(
+        'CREATE TABLE tools.%I (LIKE tools.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+        'PARTITION BY RANGE (%I)',
+        p_table, v_old, p_key
+    );
+    EXECUTE format(
+        'ALTER TABLE tools.%I ALTER COLUMN %I SET DEFAULT CURRENT_TIMESTAMP, '
+        'ALTER COLUMN %I SET NOT NULL',
+        p_table, p_key, p_key
+    );
+    IF v_id IS NOT NULL THEN
+        EXECUTE format(
+            'ALTER TABLE tools.%I ADD CONSTRAINT %I PRIMARY KEY (%I, %I)',
+            p_table, p_table || '_pkey', v_id, p_key
+        );
+    END IF;
+    FOR r IN
+        SELECT conname, pg_get_constraintdef(oid) AS def
+        FROM pg_constraint
+        WHERE conrelid = v_oldreg AND contype = 'f'
+    LOOP
+        EXECUTE format('ALTER TABLE tools.%I ADD CONSTRAINT %I %s', p_table, r.conname, r.def);
+    END LOOP;
+
+    EXECUTE format(
+        'CREATE TABLE tools.%I PARTITION OF tools.%I DEFAULT',
+        p_table || '_default', p_table
+    );
+
+    EXECUTE format('SELECT min(%I)::date FROM tools.%I', p_key, v_old) INTO v_min;
+    v_min := date_trunc('month', COALESCE(v_min, CURRENT_DATE))::date;
+    v_months := (
+        (date_part('year', CURRENT_DATE) - date_part('year', v_min)) * 12
+        + date_part('month', CURRENT_DATE) - date_part('month', v_min)
+    )::int + 1 + p_months_ahead;
+    PERFORM tools.create_log_partitions(p_table, v_min, v_months);
+
+    EXECUTE format('INSERT INTO tools.%I SELECT * FROM tools.%I', p_table, v_old);
+
+    IF v_seq IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY tools.%I.%I', v_seq, p_table, v_id);
+    END IF;
+    EXECUTE format('DROP TABLE tools.%I', v_old);
+END;
+$$;
+
+CALL tools.partition_log_table('file_audit_log', 'file_received_time');
+CALL tools.partition_log_table('job_execution_log', 'start_time');
+CALL tools.partition_log_table('integration_log', 'start_time');
+CALL tools.partition_log_table('mv_refresh_log', 'start_time');
+CALL tools.partition_log_table('transformation_log', 'timestamp');
+CALL tools.partition_log_table('row_validation_log', 'timestamp');
+
+-- --------------------------------------------
+-- Index sesuai pola akses pipeline (dibuat di tabel induk, otomatis
+-- diturunkan ke setiap partisi termasuk partisi baru)
+-- --------------------------------------------
+
+-- restart/reprocessing: SELECT DISTINCT ON (physical_file_name) ... WHERE
+-- client_id, batch_id [, physical_file_name = ANY] ORDER BY file_received_time DESC
+-- (index-only), dan UPDATE status per file dari log_sink
+CREATE INDEX IF NOT EXISTS idx_file_audit_log_batch_file
+    ON tools.file_audit_log (client_id, batch_id, physical_file_name, file_received_time DESC NULLS LAST)
+    INCLUDE (logical_source_file, source_system, source_type, convert_status,
+             mapping_validation_status, row_validation_status, load_status);
+
+-- status job per batch (monitoring / webapp)
+CREATE INDEX IF NOT EXISTS idx_job_execution_log_batch
+    ON tools.job_execution_log (client_id, batch_id, start_time DESC)
+    INCLUDE (job_name, status);
+
+-- gold check_dependencies: WHERE client_id, batch_id, proc_name = ANY -> status
+CREATE INDEX IF NOT EXISTS idx_integration_log_batch_proc
+    ON tools.integration_log (client_id, batch_id, proc_name)
+    INCLUDE (status);
+
+CREATE INDEX IF NOT EXISTS idx_mv_refresh_log_batch
+    ON tools.mv_refresh_log (client_id, batch_id)
+    INCLUDE (proc_mv_name, status);
+
+CREATE INDEX IF NOT EXISTS idx_transformation_log_batch
+    ON tools.transformation_log (client_id, batch_id)
+    INCLUDE (target_table, status);
+
+CREATE INDEX IF NOT EXISTS idx_row_validation_log_batch_file
+    ON tools.row_validation_log (client_id, batch_id, file_name);
+
+COMMIT;